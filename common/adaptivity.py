@@ -0,0 +1,140 @@
+""" Adaptive mesh refinement following the interface and the Debye
+layers. """
+import dolfin as df
+from .cmd import info_cyan
+from .io import mpi_comm
+
+__author__ = "Gaute Linga"
+
+__all__ = ["MeshAdaptivity"]
+
+
+class MeshAdaptivity:
+    """ Periodically adapts the mesh to the solution.
+
+    The mesh is regenerated from the base mesh (the mesh of the problem)
+    by refining the cells where an indicator exceeds a threshold, level
+    by level up to max_level. Cells that are no longer marked are thereby
+    coarsened back towards the base mesh. The indicators are normalized
+    by their maximum, and can be combined:
+
+    interface: |grad phi|, large in a band around the interface.
+    charge: |sum_i z_i c_i|, large in the Debye layers.
+    error: the jumps of the gradients of the phase field, concentrations
+        and potential across the facets, an estimate of the local
+        interpolation error.
+
+    The settings are:
+
+    intv: Number of timesteps between adaptations.
+    indicators: List of the indicators to refine by.
+    threshold: Cells are refined where an indicator is above this
+        fraction of its maximum.
+    max_level: Maximal number of refinements of a base mesh cell.
+    """
+    def __init__(self, base_mesh, solutes, settings=None):
+        self.base_mesh = base_mesh
+        self.solutes = solutes
+        self.settings = dict(intv=10,
+                             indicators=["interface"],
+                             threshold=0.1,
+                             max_level=3)
+        if settings is not None:
+            self.settings.update(settings)
+        if isinstance(self.settings["indicators"], str):
+            self.settings["indicators"] = [self.settings["indicators"]]
+
+    def load_base_mesh(self, h5filename):
+        """ Use the base mesh stored in a checkpoint, if any. """
+        h5file = df.HDF5File(mpi_comm(), h5filename, "r")
+        if h5file.has_dataset("base_mesh"):
+            self.base_mesh = df.Mesh()
+            h5file.read(self.base_mesh, "base_mesh", False)
+        h5file.close()
+
+    def is_due(self, tstep):
+        return tstep % self.settings["intv"] == 0
+
+    def indicator_expressions(self, x_, mesh):
+        """ Returns the indicators as UFL expressions on the mesh of the
+        fields x_. """
+        exprs = []
+        for indicator in self.settings["indicators"]:
+            if indicator == "interface" and "phi" in x_:
+                exprs.append(df.sqrt(df.inner(df.grad(x_["phi"]),
+                                              df.grad(x_["phi"]))))
+            elif indicator == "charge" and self.solutes and \
+                    all(solute[0] in x_ for solute in self.solutes):
+                exprs.append(abs(sum([solute[1]*x_[solute[0]]
+                                      for solute in self.solutes])))
+            elif indicator == "error":
+                exprs.append(self.jump_indicator(x_, mesh))
+        return exprs
+
+    def jump_indicator(self, x_, mesh):
+        """ Returns the cellwise (DG0) norm of the jumps of the normal
+        gradients of the scalar fields, scaled by the cell size. """
+        fields = [field for field in ["phi", "V"] + [
+            solute[0] for solute in self.solutes] if field in x_]
+        Q = df.FunctionSpace(mesh, "DG", 0)
+        w = df.TestFunction(Q)
+        h = df.CellDiameter(mesh)
+        n = df.FacetNormal(mesh)
+        eta = df.Function(Q)
+        if fields:
+            df.assemble(sum([df.avg(h)*df.jump(df.grad(x_[field]), n)**2
+                             * df.avg(w)*df.dS for field in fields]),
+                        tensor=eta.vector())
+        eta.vector().set_local(abs(eta.vector().get_local())**0.5)
+        eta.vector().apply("insert")
+        return eta
+
+    def normalized_indicators(self, x_, mesh):
+        """ Returns the indicators as P1 functions on the old mesh,
+        normalized by their maxima. """
+        P1 = df.FunctionSpace(mesh, "CG", 1)
+        indicators = []
+        for expr in self.indicator_expressions(x_, mesh):
+            eta = df.project(expr, P1, solver_type="cg",
+                             preconditioner_type="jacobi")
+            eta_max = eta.vector().max()
+            if eta_max > df.DOLFIN_EPS:
+                eta.vector().set_local(
+                    abs(eta.vector().get_local())/eta_max)
+                eta.vector().apply("insert")
+                indicators.append(eta)
+        return indicators
+
+    def mark(self, mesh, indicators):
+        """ Mark the cells of mesh where an indicator is above the
+        threshold. """
+        markers = df.MeshFunction("bool", mesh, mesh.topology().dim(), False)
+        Q = df.FunctionSpace(mesh, "DG", 0)
+        cell_dofs = Q.dofmap().entity_dofs(mesh, mesh.topology().dim())
+        for eta_old in indicators:
+            eta = df.Function(df.FunctionSpace(mesh, "CG", 1))
+            df.LagrangeInterpolator.interpolate(eta, eta_old)
+            eta_cell = df.interpolate(eta, Q).vector().get_local()
+            markers.array()[:] |= \
+                eta_cell[cell_dofs] > self.settings["threshold"]
+        return markers
+
+    def adapt(self, mesh, x_):
+        """ Returns the new mesh adapted to the fields x_ on mesh. """
+        timer = df.Timer("Adapt mesh")
+        indicators = self.normalized_indicators(x_, mesh)
+        new_mesh = self.base_mesh
+        for level in range(self.settings["max_level"]):
+            markers = self.mark(new_mesh, indicators)
+            if df.MPI.sum(mpi_comm(), float(markers.array().sum())) == 0:
+                break
+            new_mesh = df.refine(new_mesh, markers)
+        timer.stop()
+        info_cyan("Adapted mesh: {0:d} cells (base mesh: {1:d}, "
+                  "previous: {2:d})".format(
+                      new_mesh.num_entities_global(
+                          new_mesh.topology().dim()),
+                      self.base_mesh.num_entities_global(
+                          self.base_mesh.topology().dim()),
+                      mesh.num_entities_global(mesh.topology().dim())))
+        return new_mesh
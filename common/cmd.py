@@ -29,7 +29,7 @@ __all__ = ["convert", "str2list", "parseval", "parse_command_line",
 def convert(data):
     if isinstance(data, dict):
         return {convert(key): convert(value)
-                for key, value in data.iteritems()}
+                for key, value in data.items()}
     elif isinstance(data, list):
         return [convert(element) for element in data]
     # elif isinstance(data, unicode):
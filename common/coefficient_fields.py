@@ -0,0 +1,87 @@
+""" Material coefficients stored as finite element functions. """
+import dolfin as df
+import numpy as np
+from ufl.log import UFLException
+from .cmd import info_warning
+from .functions import unit_interval_filter
+
+__author__ = "Gaute Linga"
+
+__all__ = ["CoefficientFields"]
+
+
+COEFFICIENT_SPACES = dict(DG0=("DG", 0), P1=("CG", 1))
+
+
+class CoefficientFields:
+    """ Coefficients given as functions of a field (e.g. the phase field),
+    stored in a DG0 or P1 space.
+
+    The field is interpolated into the coefficient space, and the
+    coefficient laws are evaluated on the dof arrays with NumPy when
+    update() is called, typically once per timestep. The forms then only
+    contain the resulting functions, such that the cost of assembly (and
+    the estimated quadrature degree) does not depend on the complexity
+    of the laws. Laws that can not be evaluated with NumPy (ones using
+    UFL conditionals or functions, which reject arrays) are instead
+    applied to the interpolated field as UFL expressions.
+    """
+    def __init__(self, mesh, space="P1"):
+        if space not in COEFFICIENT_SPACES:
+            raise ValueError(
+                "Unknown coefficient space {}. Available: {}".format(
+                    space, ", ".join(sorted(COEFFICIENT_SPACES))))
+        family, degree = COEFFICIENT_SPACES[space]
+        self.Q = df.FunctionSpace(mesh, family, degree)
+        self.sources = []
+        self.fields = []
+        self.laws = []
+
+    def source_index(self, source):
+        """ Returns the index of the interpolated source field. """
+        for i, (src, _) in enumerate(self.sources):
+            if src is source:
+                return i
+        self.sources.append((source, df.Function(self.Q)))
+        self.sources[-1][1].interpolate(source)
+        return len(self.sources)-1
+
+    def add(self, source, law, filtered=False):
+        """ Returns the coefficient law(phi), where phi is the field source
+        interpolated into the coefficient space. If filtered, phi is
+        first restricted to the unit interval. """
+        i = self.source_index(source)
+        phi = self.sources[i][1]
+        try:
+            values = self.evaluate(law, filtered, phi.vector().get_local())
+        except (UFLException, TypeError):
+            info_warning("Coefficient law can not be evaluated with NumPy, "
+                         "and is kept as a UFL expression.")
+            return law(unit_interval_filter(phi) if filtered else phi)
+        f = df.Function(self.Q)
+        self.fields.append(f)
+        self.laws.append((i, law, filtered))
+        self.assign(f, values)
+        return f
+
+    def evaluate(self, law, filtered, phi):
+        """ Evaluate the law on the array phi. """
+        if filtered:
+            phi = np.clip(phi, -1., 1.)
+        values = law(phi)
+        if np.ndim(values) == 0:
+            values = np.full_like(phi, float(values))
+        return np.asarray(values, dtype=float)
+
+    def assign(self, f, values):
+        f.vector().set_local(values)
+        f.vector().apply("insert")
+
+    def update(self):
+        """ Re-interpolate the source fields and re-evaluate the laws. """
+        for source, phi in self.sources:
+            phi.interpolate(source)
+        for f, (i, law, filtered) in zip(self.fields, self.laws):
+            phi = self.sources[i][1]
+            self.assign(f, self.evaluate(law, filtered,
+                                         phi.vector().get_local()))
@@ -0,0 +1,247 @@
+""" Function spaces, work functions and boundary conditions on a mesh.
+These are created at startup, and recreated when the mesh changes. """
+import dolfin as df
+import numpy as np
+from .cmd import info_on_red
+
+__author__ = "Gaute Linga"
+
+__all__ = ["create_spaces", "create_functions",
+           "create_boundary_conditions", "initialize_functions",
+           "transfer_functions"]
+
+
+def create_spaces(mesh, elements, subproblems, constrained_domain=None):
+    """ Declare the function space of each subproblem, and map the fields
+    to their subspaces and subproblems. """
+    spaces = dict()
+    for name, subproblem in subproblems.items():
+        if len(subproblem) > 1:
+            spaces[name] = df.FunctionSpace(
+                mesh, df.MixedElement(
+                    [elements[s["element"]] for s in subproblem]),
+                constrained_domain=constrained_domain)
+        # If there is only one field in the subproblem, don't bother with
+        # the MixedElement.
+        elif len(subproblem) == 1:
+            spaces[name] = df.FunctionSpace(
+                mesh, elements[subproblem[0]["element"]],
+                constrained_domain=constrained_domain)
+        else:
+            info_on_red("Something went wrong here!")
+            exit("")
+
+    # dim = mesh.topology().dim()  # In case the velocity fields should be
+    #                              # segregated at some point
+    fields = []
+    field_to_subspace = dict()
+    field_to_subproblem = dict()
+    for name, subproblem in subproblems.items():
+        if len(subproblem) > 1:
+            for i, s in enumerate(subproblem):
+                field = s["name"]
+                fields.append(field)
+                field_to_subspace[field] = spaces[name].sub(i)
+                field_to_subproblem[field] = (name, i)
+        else:
+            field = subproblem[0]["name"]
+            fields.append(field)
+            field_to_subspace[field] = spaces[name]
+            field_to_subproblem[field] = (name, -1)
+
+    return dict(spaces=spaces, fields=fields,
+                field_to_subspace=field_to_subspace,
+                field_to_subproblem=field_to_subproblem)
+
+
+def create_functions(spaces, subproblems, time_scheme="BE"):
+    """ Create the test and trial functions, and the work functions of
+    the current and previous timesteps. w_2, the second previous
+    timestep, is only created for the BDF2 scheme. """
+    # Create overarching test and trial functions
+    test_functions = dict()
+    trial_functions = dict()
+    for name, subproblem in subproblems.items():
+        if len(subproblem) > 1:
+            test_functions[name] = df.TestFunctions(spaces[name])
+            trial_functions[name] = df.TrialFunctions(spaces[name])
+        else:
+            test_functions[name] = df.TestFunction(spaces[name])
+            trial_functions[name] = df.TrialFunction(spaces[name])
+
+    # Create work dictionaries for all subproblems
+    w_ = dict((subproblem, df.Function(space, name=subproblem))
+              for subproblem, space in spaces.items())
+    w_1 = dict((subproblem, df.Function(space, name=subproblem+"_1"))
+               for subproblem, space in spaces.items())
+    w_tmp = dict((subproblem, df.Function(space, name=subproblem+"_tmp"))
+                 for subproblem, space in spaces.items())
+    w_2 = None
+    if time_scheme == "BDF2":
+        w_2 = dict((subproblem, df.Function(space, name=subproblem+"_2"))
+                   for subproblem, space in spaces.items())
+
+    # Shortcuts to the fields
+    x_ = dict()
+    for name, subproblem in subproblems.items():
+        if len(subproblem) > 1:
+            w_loc = df.split(w_[name])
+            for i, field in enumerate(subproblem):
+                x_[field["name"]] = w_loc[i]
+        else:
+            x_[subproblem[0]["name"]] = w_[name]
+
+    return dict(test_functions=test_functions,
+                trial_functions=trial_functions,
+                w_=w_, w_1=w_1, w_tmp=w_tmp, w_2=w_2, x_=x_)
+
+
+def create_boundary_conditions(mesh, bcs_tuple, subproblems, fields,
+                               field_to_subspace, field_to_subproblem):
+    """ Mark the boundaries and create the Dirichlet (per subproblem) and
+    Neumann (per field) boundary conditions from the output of the
+    create_bcs function of the problem. Also returns the measures and the
+    normal. """
+    if len(bcs_tuple) == 3:
+        boundaries, bcs, bcs_pointwise = bcs_tuple
+    elif len(bcs_tuple) == 2:
+        boundaries, bcs = bcs_tuple
+        bcs_pointwise = None
+    else:
+        info_on_red("Wrong implementation of create_bcs.")
+        exit()
+
+    # Set up subdomains
+    subdomains = df.MeshFunction("size_t", mesh, mesh.topology().dim()-1)
+    subdomains.set_all(0)
+    boundary_to_mark = dict()
+    mark_to_boundary = dict()
+    for i, (boundary_name, markers) in enumerate(boundaries.items()):
+        for marker in markers:
+            marker.mark(subdomains, i+1)
+        boundary_to_mark[boundary_name] = i+1
+        mark_to_boundary[i] = boundary_name
+
+    # Set up dirichlet part of bcs
+    dirichlet_bcs = dict()
+    for subproblem_name in subproblems.keys():
+        dirichlet_bcs[subproblem_name] = []
+
+    # Neumann BCs (per field)
+    neumann_bcs = dict()
+    for field in fields:
+        neumann_bcs[field] = dict()
+
+    for boundary_name, bcs_fields in bcs.items():
+        for field, bc in bcs_fields.items():
+            subproblem_name = field_to_subproblem[field][0]
+            subspace = field_to_subspace[field]
+            mark = boundary_to_mark[boundary_name]
+            if bc.is_dbc():
+                dirichlet_bcs[subproblem_name].append(
+                    bc.dbc(subspace, subdomains, mark))
+            if bc.is_nbc():
+                neumann_bcs[field][boundary_name] = bc.nbc()
+
+    # Pointwise dirichlet bcs
+    if bcs_pointwise is not None:
+        for field, (value, c_code) in bcs_pointwise.items():
+            subproblem_name = field_to_subproblem[field][0]
+            subspace = field_to_subspace[field]
+            if not isinstance(value, df.Expression):
+                value = df.Constant(value)
+            dirichlet_bcs[subproblem_name].append(
+                df.DirichletBC(subspace, value, c_code, "pointwise"))
+
+    # Compute some mesh related stuff
+    dx = df.dx
+    ds = df.Measure("ds", domain=mesh, subdomain_data=subdomains)
+    normal = df.FacetNormal(mesh)
+
+    return dict(boundaries=boundaries, bcs=bcs, bcs_pointwise=bcs_pointwise,
+                subdomains=subdomains,
+                boundary_to_mark=boundary_to_mark,
+                mark_to_boundary=mark_to_boundary,
+                dirichlet_bcs=dirichlet_bcs, neumann_bcs=neumann_bcs,
+                dx=dx, ds=ds, normal=normal)
+
+
+def initialize_functions(w_init_fields, w_, w_1, subproblems):
+    """ Set w_ and w_1 to the initial state given per field in
+    w_init_fields, as returned by the initialize function of the problem.
+    Fields that are not given keep their value. """
+    if not w_init_fields:
+        return
+    for name, subproblem in subproblems.items():
+        w_init_vector = []
+        if len(subproblem) > 1:
+            for i, s in enumerate(subproblem):
+                field = s["name"]
+                # Only change initial state if it is given in
+                # w_init_fields.
+                if field in w_init_fields:
+                    w_init_field = w_init_fields[field]
+                else:
+                    # Otherwise take the default value of that field.
+                    w_init_field = w_[name].sub(i)
+                # Use df.project(df.as_vector(...)) with care...
+                num_subspaces = \
+                    w_init_field.function_space().num_sub_spaces()
+                if num_subspaces == 0:
+                    w_init_vector.append(w_init_field)
+                else:
+                    for j in range(num_subspaces):
+                        w_init_vector.append(w_init_field.sub(j))
+            # assert len(w_init_vector) == w_[name].value_size()
+            w_init = df.project(
+                df.as_vector(tuple(w_init_vector)),
+                w_[name].function_space(),
+                solver_type="gmres", preconditioner_type="default")
+        else:
+            field = subproblem[0]["name"]
+            if field in w_init_fields:
+                w_init_field = w_init_fields[field]
+            else:
+                # Take default value...
+                w_init_field = w_[name]
+            w_init = df.project(w_init_field, w_[name].function_space(),
+                                solver_type="gmres",
+                                preconditioner_type="default")
+        w_[name].interpolate(w_init)
+        w_1[name].interpolate(w_init)
+
+
+def transfer_subfunction(f_old, f_new):
+    """ Transfer the (non-mixed) function f_old into f_new. The global
+    (Real) dofs do not depend on the mesh, and are copied directly. """
+    if f_new.ufl_element().family() == "Real":
+        num_dofs = f_new.function_space().dim()
+        values = f_old.vector().gather(np.arange(num_dofs, dtype=np.intc))
+        start, end = f_new.vector().local_range()
+        f_new.vector().set_local(values[start:end])
+        f_new.vector().apply("insert")
+    else:
+        df.LagrangeInterpolator.interpolate(f_new, f_old)
+
+
+def transfer_functions(w_old, w_new):
+    """ Interpolate the work functions w_old into w_new, defined on
+    another (e.g. refined) mesh. The subspaces of mixed spaces are
+    transferred one by one, through their collapsed spaces. """
+    for name, f_new in w_new.items():
+        f_old = w_old[name]
+        V_old = f_old.function_space()
+        V_new = f_new.function_space()
+        if V_new.num_sub_spaces() == 0 or \
+                V_new.ufl_element().family() != "Mixed":
+            transfer_subfunction(f_old, f_new)
+            continue
+        num_subspaces = V_new.num_sub_spaces()
+        spaces_old = [V_old.sub(i).collapse() for i in range(num_subspaces)]
+        spaces_new = [V_new.sub(i).collapse() for i in range(num_subspaces)]
+        f_old_subs = [df.Function(V) for V in spaces_old]
+        f_new_subs = [df.Function(V) for V in spaces_new]
+        df.FunctionAssigner(spaces_old, V_old).assign(f_old_subs, f_old)
+        for f_old_sub, f_new_sub in zip(f_old_subs, f_new_subs):
+            transfer_subfunction(f_old_sub, f_new_sub)
+        df.FunctionAssigner(V_new, spaces_new).assign(f_new, f_new_subs)
@@ -0,0 +1,63 @@
+""" Tools for fixed-point iterations over coupled subproblems. """
+import numpy as np
+from mpi4py import MPI
+
+__author__ = "Gaute Linga"
+
+__all__ = ["AndersonAcceleration", "get_stacked", "set_stacked",
+           "global_norm"]
+
+
+def get_stacked(functions):
+    """ Returns the local dofs of the given functions as one array. """
+    return np.concatenate([f.vector().get_local() for f in functions])
+
+
+def set_stacked(functions, x):
+    """ Distribute the stacked array x back to the functions. """
+    offset = 0
+    for f in functions:
+        size = f.vector().local_size()
+        f.vector().set_local(x[offset:offset+size])
+        f.vector().apply("insert")
+        offset += size
+
+
+def global_norm(x):
+    """ Returns the l2 norm of the distributed array x. """
+    return np.sqrt(MPI.COMM_WORLD.allreduce(np.dot(x, x)))
+
+
+class AndersonAcceleration:
+    """ Anderson acceleration of the fixed-point iteration x = G(x).
+
+    Keeps the last depth differences of the iterates and residuals, and
+    returns the combination of the previous iterates that minimizes the
+    linearized residual.
+    """
+    def __init__(self, depth):
+        self.depth = depth
+        self.reset()
+
+    def reset(self):
+        """ Forget the history, e.g. at the beginning of a timestep. """
+        self.G = []
+        self.F = []
+
+    def apply(self, x, g):
+        """ Given the iterate x and g = G(x), returns the next iterate. """
+        self.G.append(g.copy())
+        self.F.append(g - x)
+        if len(self.F) > self.depth + 1:
+            self.G.pop(0)
+            self.F.pop(0)
+        m = len(self.F) - 1
+        if m == 0:
+            return g
+
+        dF = np.array([self.F[i+1] - self.F[i] for i in range(m)]).T
+        dG = np.array([self.G[i+1] - self.G[i] for i in range(m)]).T
+        gram = MPI.COMM_WORLD.allreduce(dF.T.dot(dF))
+        rhs = MPI.COMM_WORLD.allreduce(dF.T.dot(self.F[-1]))
+        gamma = np.linalg.lstsq(gram, rhs, rcond=None)[0]
+        return g - dG.dot(gamma)
@@ -0,0 +1,130 @@
+""" Helper functions for inspecting and manipulating UFL forms. """
+import dolfin as df
+import ufl
+from ufl.algorithms import extract_coefficients, \
+    estimate_total_polynomial_degree
+from ufl.classes import Sum
+from .cmd import info, info_warning
+
+__author__ = "Gaute Linga"
+
+__all__ = ["form_terms", "split_form", "get_quadrature_degree",
+           "estimate_quadrature_degree", "set_quadrature_degree",
+           "apply_quadrature_degree", "uses_mass_lumping", "mass_measure"]
+
+
+def form_terms(expr):
+    """ Split an integrand into its additive terms. """
+    if isinstance(expr, Sum):
+        terms = []
+        for operand in expr.ufl_operands:
+            terms.extend(form_terms(operand))
+        return terms
+    return [expr]
+
+
+def is_time_invariant(expr, frozen_ids):
+    """ Check if expr only depends on constants or frozen coefficients. """
+    return all(isinstance(f, df.Constant) or f.count() in frozen_ids
+               for f in extract_coefficients(expr))
+
+
+def split_form(form, frozen=()):
+    """ Split a form into a time-invariant and a time-dependent part.
+
+    A term is considered time-invariant if the only coefficients it
+    depends on are df.Constants or the coefficients listed in frozen
+    (e.g. the solution of a subproblem that is not being solved).
+    Returns the tuple (form_const, form_var), where either may be None.
+    """
+    frozen_ids = set(f.count() for f in frozen)
+    integrals_const = []
+    integrals_var = []
+    for integral in form.integrals():
+        for term in form_terms(integral.integrand()):
+            if is_time_invariant(term, frozen_ids):
+                integrals_const.append(integral.reconstruct(integrand=term))
+            else:
+                integrals_var.append(integral.reconstruct(integrand=term))
+    form_const = ufl.Form(integrals_const) if integrals_const else None
+    form_var = ufl.Form(integrals_var) if integrals_var else None
+    return form_const, form_var
+
+
+def get_quadrature_degree(quadrature_degree, name):
+    """ Returns the quadrature degree of the subproblem name.
+
+    quadrature_degree is either None (let UFL estimate the degree), a
+    degree used for all subproblems, or a dict of degrees per subproblem,
+    where the key "default" may give the degree of the rest.
+    """
+    if isinstance(quadrature_degree, dict):
+        return quadrature_degree.get(name, quadrature_degree.get("default"))
+    return quadrature_degree
+
+
+def estimate_quadrature_degree(form):
+    """ Returns the maximal quadrature degree UFL estimates for the
+    integrals of form. """
+    return max(estimate_total_polynomial_degree(integral.integrand())
+               for integral in form.integrals())
+
+
+def set_quadrature_degree(form, degree):
+    """ Returns form with the given quadrature degree for all integrals
+    that do not specify one themselves. """
+    if form is None or degree is None:
+        return form
+    integrals = []
+    for integral in form.integrals():
+        metadata = dict(integral.metadata())
+        metadata.setdefault("quadrature_degree", degree)
+        integrals.append(integral.reconstruct(metadata=metadata))
+    return ufl.Form(integrals)
+
+
+def apply_quadrature_degree(name, forms, degree):
+    """ Apply the quadrature degree to the forms, given as a list of
+    (label, form) pairs, and report the chosen and estimated degrees.
+    Returns the list of new forms. """
+    global_degree = df.parameters["form_compiler"]["quadrature_degree"]
+    if global_degree is not None and global_degree < 0:
+        global_degree = None
+    new_forms = []
+    for label, form in forms:
+        if form is not None:
+            estimated = estimate_quadrature_degree(form)
+            chosen = degree if degree is not None else global_degree
+            info("Quadrature degree of {} {}: {} (estimated {})".format(
+                name, label, chosen if chosen is not None else estimated,
+                estimated))
+        new_forms.append(set_quadrature_degree(form, degree))
+    return new_forms
+
+
+def uses_mass_lumping(mass_lumping, name):
+    """ Check if the time derivative terms of the subproblem name are
+    lumped. mass_lumping is either a bool for all subproblems, or a list
+    of the subproblems that are lumped. """
+    if isinstance(mass_lumping, (list, tuple)):
+        return name in mass_lumping
+    return bool(mass_lumping)
+
+
+def mass_measure(dx, lumped=False, degree=1):
+    """ Returns the measure of the mass (time derivative) terms.
+
+    If lumped, the terms are integrated with the vertex quadrature rule.
+    For P1 elements, this gives the diagonal matrix of the row sums of
+    the consistent mass matrix, which keeps the M-matrix property of the
+    discretization and hence prevents negative overshoots. For other
+    elements, the consistent mass is kept.
+    """
+    if not lumped:
+        return dx
+    if degree != 1:
+        info_warning("Mass lumping requires P1 elements; using the "
+                     "consistent mass matrix.")
+        return dx
+    return dx(scheme="vertex", degree=1,
+              metadata=dict(representation="quadrature"))
@@ -107,16 +107,34 @@ def create_initial_folders(folder, restart_folder, fields, tstep,
 def save_solution(tstep, t, T, mesh, w_, w_1, folder, newfolder,
                   save_intv, checkpoint_intv,
                   parameters, tstepfiles, subproblems,
+                  w_2=None, bdf=None, adaptivity=None,
+                  steady_state_controller=None,
                   **namespace):
     """ Save solution either to  """
     if tstep % save_intv == 0:
         # Save snapshot to xdmf
         save_xdmf(t, w_, subproblems, tstepfiles)
 
-    stop = check_if_kill(folder) or t >= T
+    # In steady state mode, the final time is not used
+    if steady_state_controller is None:
+        stop = check_if_kill(folder) or t >= T
+    else:
+        stop = check_if_kill(folder) or steady_state_controller.is_done()
     if tstep % checkpoint_intv == 0 or stop:
         # Save checkpoint
-        save_checkpoint(tstep, t, mesh, w_, w_1, newfolder, parameters)
+        # The second previous timestep is only meaningful once the
+        # BDF2 scheme has taken a step
+        dt_prev = None
+        if bdf is None or not bdf.is_second_order():
+            w_2 = None
+        else:
+            dt_prev = bdf.dt_prev
+        # The base mesh is needed to continue adapting the mesh
+        base_mesh = None
+        if adaptivity is not None:
+            base_mesh = adaptivity.base_mesh
+        save_checkpoint(tstep, t, mesh, w_, w_1, newfolder, parameters,
+                        w_2, base_mesh, dt_prev)
 
     return stop
 
@@ -153,14 +171,19 @@ def save_xdmf(t, w_, subproblems, tstepfiles):
                 tstepfiles[field].write(q, float(t))
 
 
-def save_checkpoint(tstep, t, mesh, w_, w_1, newfolder, parameters):
-    """ Save checkpoint files.
+def save_checkpoint(tstep, t, mesh, w_, w_1, newfolder, parameters,
+                    w_2=None, base_mesh=None, dt_prev=None):
+    """ Save checkpoint files. The solutions of the second previous
+    timestep, w_2, and the base mesh of an adaptive mesh are stored if
+    given, as is the size of the previous timestep, dt_prev, which the
+    BDF2 coefficients of the first step after a restart depend on.
 
     A part of this is taken from the Oasis code."""
     checkpointfolder = os.path.join(newfolder, "Checkpoint")
     parameters["num_processes"] = MPI_size
     parameters["t_0"] = t
     parameters["tstep"] = tstep
+    parameters["dt_prev"] = dt_prev
     parametersfile = os.path.join(checkpointfolder, "parameters.dat")
     parametersfile_old = parametersfile + ".old"
     if mpi_is_root():
@@ -180,12 +203,16 @@ def save_checkpoint(tstep, t, mesh, w_, w_1, newfolder, parameters):
     h5file.flush()
     info_red("Storing mesh")
     h5file.write(mesh, "mesh")
+    if base_mesh is not None:
+        h5file.write(base_mesh, "base_mesh")
     for field in w_:
         info_red("Storing subproblem: " + field)
         mpi_barrier()
         h5file.write(w_[field], "{}/current".format(field))
         if field in w_1:
             h5file.write(w_1[field], "{}/previous".format(field))
+        if w_2 is not None and field in w_2:
+            h5file.write(w_2[field], "{}/second_previous".format(field))
         mpi_barrier()
     h5file.close()
     # Since program is still running, delete the old files.
@@ -194,15 +221,27 @@ def save_checkpoint(tstep, t, mesh, w_, w_1, newfolder, parameters):
     remove_safe(parametersfile_old)
 
 
-def load_checkpoint(checkpointfolder, w_, w_1):
+def load_checkpoint(checkpointfolder, w_, w_1, w_2=None):
+    """ Load the solutions from checkpoint. The second previous timestep
+    is loaded into w_2 if given. Returns True if it was found for all
+    subproblems. """
+    w_2_loaded = False
     if checkpointfolder:
         h5filename = os.path.join(checkpointfolder, "fields.h5")
         h5file = HDF5File(mpi_comm(), h5filename, "r")
+        w_2_loaded = w_2 is not None
         for field in w_:
             info_red("Loading subproblem: {}".format(field))
             h5file.read(w_[field], "{}/current".format(field))
             h5file.read(w_1[field], "{}/previous".format(field))
+            if w_2 is not None:
+                if h5file.has_dataset("{}/second_previous".format(field)):
+                    h5file.read(w_2[field],
+                                "{}/second_previous".format(field))
+                else:
+                    w_2_loaded = False
         h5file.close()
+    return w_2_loaded
 
 
 def load_mesh(filename, subdir="mesh",
@@ -0,0 +1,51 @@
+""" Ahead-of-time compilation of the forms, and the location of the
+cache of compiled forms and expressions. """
+import dolfin as df
+import os
+from .cmd import info_cyan
+
+__author__ = "Gaute Linga"
+
+__all__ = ["set_jit_cache_dir", "precompile_solvers"]
+
+
+def set_jit_cache_dir(cache_dir):
+    """ Use cache_dir as the cache of compiled forms, expressions and
+    subdomains. The compiled modules are looked up by their signature
+    only, such that the cache can be moved, shared between the nodes of
+    a cluster, or built into a Docker image. The cache directory can also
+    be given through the DIJITSO_CACHE_DIR environment variable, and, for
+    the expressions and subdomains compiled by instant (dolfin 2017.2),
+    INSTANT_CACHE_DIR. """
+    if cache_dir is None:
+        return
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    os.environ["DIJITSO_CACHE_DIR"] = cache_dir
+    os.environ["INSTANT_CACHE_DIR"] = os.path.join(cache_dir, "instant")
+    info_cyan("Using compiled form cache: {}".format(cache_dir))
+
+
+def solver_forms(solvers):
+    """ Returns the forms of the solvers that are compiled when first
+    assembled. Solvers may be nested in dicts and lists.
+    df.LinearVariationalSolver and df.NonlinearVariationalSolver compile
+    their forms when created. """
+    forms = []
+    if isinstance(solvers, dict):
+        for solver in solvers.values():
+            forms.extend(solver_forms(solver))
+    elif isinstance(solvers, (list, tuple)):
+        for solver in solvers:
+            forms.extend(solver_forms(solver))
+    elif hasattr(solvers, "forms"):
+        forms.extend(solvers.forms())
+    return forms
+
+
+def precompile_solvers(solvers):
+    """ Compile all forms of the solvers, without assembling them.
+    Returns the number of forms. """
+    forms = solver_forms(solvers)
+    for form in forms:
+        df.Form(form)
+    return len(forms)
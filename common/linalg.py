@@ -0,0 +1,361 @@
+""" Linear solvers for the subproblems of the segregated solvers. """
+import dolfin as df
+import math
+import numpy as np
+from .forms import split_form, apply_quadrature_degree
+from .preconditioners import set_fieldsplit_options, set_fieldsplit_is, \
+    uses_multigrid, field_groups
+from .multigrid import set_multigrid
+
+__author__ = "Gaute Linga"
+
+__all__ = ["SubproblemSolver", "create_linear_solver", "create_petsc_solver",
+           "is_direct_method", "set_petsc_options", "num_iterations_saved"]
+
+
+def is_direct_method(method):
+    """ Check if method refers to a direct (LU) solver. """
+    return method in ["default", "lu", "mumps", "petsc", "superlu",
+                      "superlu_dist", "umfpack", "pastix"]
+
+
+class SubproblemSolver:
+    """ Solver for the linear subproblem a == L with unknown w.
+
+    Can be used as a drop-in replacement for df.LinearVariationalSolver,
+    but keeps the assembled operator (and hence its sparsity pattern)
+    alive between timesteps. The bilinear form is split into terms that
+    are constant in time and terms that are not. The constant part is
+    assembled once and added to the time-dependent part whenever the
+    operator is reassembled. If the operator is entirely constant, it is
+    never reassembled, and the factorization/preconditioner is reused.
+
+    With a Krylov method, the preconditioner can furthermore be kept
+    when the operator changes. It is then only rebuilt every
+    rebuild_intv solve, or when the number of iterations has grown by
+    more than a factor max_iteration_growth since the last rebuild.
+
+    A named block preconditioner (see common/preconditioners.py) can be
+    used for mixed spaces, in which case the PETSc options are prefixed
+    by name. If a_pc is given, the preconditioner is built from the
+    matrix assembled from a + a_pc rather than from a alone. The
+    geometric multigrid preconditioners use the levels of
+    mesh_hierarchy (see common/multigrid.py).
+
+    If nonzero_initial_guess is set, Krylov iterations start from the
+    current value of w, e.g. extrapolated from previous timesteps, and
+    the number of iterations saved by this is estimated from the
+    reduction of the initial residual.
+
+    The solver is always given the options prefix name + "_", and
+    petsc_options are set in the PETSc options database with this
+    prefix. This overrides the methods chosen in parameters.
+
+    The rows of the Dirichlet boundary dofs are found once, and reused
+    whenever boundary conditions are applied to the operator.
+
+    If quadrature_degree is given, it is used for all the forms.
+    """
+    def __init__(self, a, L, w, bcs, frozen=(), split=True,
+                 preconditioner_reuse=None, preconditioner=None,
+                 a_pc=None, name="", petsc_options=None,
+                 quadrature_degree=None, mesh_hierarchy=None):
+        a, L, a_pc = apply_quadrature_degree(
+            name, [("a", a), ("L", L), ("a_pc", a_pc)], quadrature_degree)
+        self.a = a
+        self.L = L
+        self.w = w
+        self.bcs = bcs
+        self.preconditioner = preconditioner
+        self.mesh_hierarchy = mesh_hierarchy
+        self.a_pc = a_pc
+        self.name = name
+        self.petsc_options = petsc_options
+        if split:
+            self.a_const, self.a_var = split_form(a, frozen)
+        else:
+            self.a_const, self.a_var = None, a
+        self.parameters = dict(linear_solver="default",
+                               preconditioner="default",
+                               nonzero_initial_guess=False)
+
+        self.A = None
+        self.A_const = None
+        self.P = None
+        self.A_pc = None
+        self.b = df.PETScVector()
+        self.solver = None
+        self.const_changed = True
+        self.bc_rows = None
+
+        self.preconditioner_reuse = None
+        if preconditioner_reuse is not None:
+            self.preconditioner_reuse = dict(rebuild_intv=10,
+                                             max_iteration_growth=2.)
+            self.preconditioner_reuse.update(preconditioner_reuse)
+        self.num_reused = 0
+        self.num_iterations = 0
+        self.num_iterations_rebuild = 0
+        self.num_rebuilds = 0
+        self.num_iterations_saved = 0.
+
+    def forms(self):
+        """ Returns the forms that are assembled by the solver. """
+        return [form for form in [self.a_const, self.a_var, self.L,
+                                  self.a_pc] if form is not None]
+
+    def invalidate(self):
+        """ Mark the constant part of the operator for reassembly,
+        e.g. after the timestep has changed. """
+        self.const_changed = True
+
+    def assemble_operator(self):
+        """ Assemble the operator. Returns True if it has changed. """
+        if self.A is None:
+            # First time: assemble everything into a fresh matrix, and
+            # use its sparsity pattern for the constant part as well.
+            self.A = df.PETScMatrix()
+            df.assemble(self.a, tensor=self.A)
+            if self.a_const is not None and self.a_var is not None:
+                self.A_const = self.A.copy()
+                df.assemble(self.a_const, tensor=self.A_const)
+            self.const_changed = False
+        elif self.a_var is None:
+            if not self.const_changed:
+                return False
+            df.assemble(self.a, tensor=self.A)
+            self.const_changed = False
+        elif self.a_const is None:
+            df.assemble(self.a_var, tensor=self.A)
+        else:
+            if self.const_changed:
+                df.assemble(self.a_const, tensor=self.A_const)
+                self.const_changed = False
+            df.assemble(self.a_var, tensor=self.A)
+            self.A.axpy(1.0, self.A_const, True)
+
+        if self.a_pc is not None:
+            self.assemble_preconditioner()
+
+        self.apply_bcs_operator(self.A)
+        if self.P is not None:
+            self.apply_bcs_operator(self.P)
+        return True
+
+    def apply_bcs_operator(self, A):
+        """ Replace the rows of the Dirichlet boundary dofs in A by
+        identity rows, like bc.apply(A) does. """
+        if not self.bcs:
+            return
+        if self.bc_rows is None:
+            rows = set()
+            for bc in self.bcs:
+                rows.update(bc.get_boundary_values().keys())
+            self.bc_rows = np.array(sorted(rows), dtype=np.intc)
+        A.ident_local(self.bc_rows)
+        A.apply("insert")
+
+    def assemble_preconditioner(self):
+        """ Assemble the preconditioner matrix P = A + A_pc. """
+        if self.P is None:
+            self.P = self.A.copy()
+            self.A_pc = self.A.copy()
+        else:
+            self.P.zero()
+            self.P.axpy(1.0, self.A, True)
+        df.assemble(self.a_pc, tensor=self.A_pc)
+        self.P.axpy(1.0, self.A_pc, True)
+
+    def create_solver(self):
+        """ Create the underlying linear solver. """
+        method = self.parameters["linear_solver"]
+        prefix = self.name + "_" if self.name else ""
+        if self.preconditioner is not None:
+            solver = df.PETScKrylovSolver()
+            solver.set_operators(self.A, self.P if self.P is not None
+                                 else self.A)
+            set_fieldsplit_options(self.preconditioner, prefix,
+                                   self.w.function_space())
+            set_petsc_options(prefix, self.petsc_options)
+            solver.set_options_prefix(prefix)
+            solver.set_from_options()
+            set_fieldsplit_is(solver, self.preconditioner,
+                              self.w.function_space())
+            if uses_multigrid(self.preconditioner):
+                set_multigrid(solver, self.preconditioner,
+                              self.w.function_space(), self.mesh_hierarchy,
+                              prefix, field_groups(self.preconditioner,
+                                                   self.w.function_space()))
+        else:
+            solver = create_petsc_solver(
+                self.A, method, self.parameters["preconditioner"],
+                prefix, self.petsc_options)
+        if self.use_initial_guess():
+            solver.set_nonzero_guess(True)
+        return solver
+
+    def is_krylov(self):
+        """ Check if an iterative method is used. """
+        if self.preconditioner is not None:
+            return True
+        return not is_direct_method(self.parameters["linear_solver"])
+
+    def use_initial_guess(self):
+        """ Check if Krylov iterations start from the current w. """
+        return self.parameters["nonzero_initial_guess"] and self.is_krylov()
+
+    def initial_residual_reduction(self):
+        """ Returns |b - A w|/|b| for the current w. """
+        r = self.b.copy()
+        self.A.mult(self.w.vector(), r)
+        r.axpy(-1.0, self.b)
+        return r.norm("l2")/max(self.b.norm("l2"), df.DOLFIN_EPS)
+
+    def rebuild_preconditioner(self):
+        """ Decide whether the preconditioner should be rebuilt. """
+        if self.num_rebuilds == 0:
+            return True
+        settings = self.preconditioner_reuse
+        return bool(
+            self.num_reused >= settings["rebuild_intv"] or
+            self.num_iterations > (settings["max_iteration_growth"]
+                                   * max(self.num_iterations_rebuild, 1)))
+
+    def solve(self):
+        """ Assemble and solve the linear system. """
+        operator_changed = self.assemble_operator()
+        df.assemble(self.L, tensor=self.b)
+        for bc in self.bcs:
+            bc.apply(self.b)
+
+        if self.solver is None:
+            self.solver = self.create_solver()
+
+        rebuild = False
+        if self.preconditioner_reuse is not None and self.is_krylov() \
+           and operator_changed:
+            rebuild = self.rebuild_preconditioner()
+            self.solver.ksp().setReusePreconditioner(not rebuild)
+
+        reduction = None
+        if self.use_initial_guess():
+            reduction = self.initial_residual_reduction()
+
+        self.num_iterations = self.solver.solve(self.w.vector(), self.b)
+
+        if reduction is not None and 0. < reduction < 1.:
+            # The iterations needed from a zero initial guess, assuming
+            # a constant convergence rate.
+            rtol = self.solver.ksp().getTolerances()[0]
+            self.num_iterations_saved += self.num_iterations*(
+                math.log(rtol)/math.log(rtol/reduction) - 1.)
+
+        if rebuild:
+            self.num_rebuilds += 1
+            self.num_reused = 0
+            self.num_iterations_rebuild = self.num_iterations
+        elif operator_changed:
+            self.num_reused += 1
+        return self.num_iterations
+
+
+def create_petsc_solver(A, method, preconditioner="default", prefix="",
+                        petsc_options=None):
+    """ Returns a linear solver with operator A.
+
+    Without petsc_options, a direct method gives a df.LUSolver. Otherwise,
+    the solver is a df.PETScKrylovSolver with the given options prefix,
+    and the options override the method and preconditioner.
+    """
+    if is_direct_method(method) and not petsc_options:
+        solver = df.LUSolver("default" if method == "lu" else method)
+        solver.set_operator(A)
+        return solver
+    if is_direct_method(method):
+        # Direct solver expressed as a Krylov solver, such that it can
+        # be changed through the options database.
+        solver = df.PETScKrylovSolver("preonly", "lu")
+        if method not in ["default", "lu", "petsc"]:
+            for option in factor_solver_options():
+                df.PETScOptions.set(prefix + option, method)
+    else:
+        solver = df.PETScKrylovSolver(method, preconditioner)
+    solver.set_operator(A)
+    set_petsc_options(prefix, petsc_options)
+    solver.set_options_prefix(prefix)
+    solver.set_from_options()
+    return solver
+
+
+def factor_solver_options():
+    """ Returns the name(s) of the PETSc option choosing the LU solver
+    package, which was renamed in PETSc 3.9. Without petsc4py, the
+    version is unknown, and both names are returned; PETSc ignores the
+    one it does not know. """
+    try:
+        from petsc4py import PETSc
+    except ImportError:
+        return ["pc_factor_mat_solver_package", "pc_factor_mat_solver_type"]
+    if tuple(PETSc.Sys.getVersion()[:2]) >= (3, 9):
+        return ["pc_factor_mat_solver_type"]
+    return ["pc_factor_mat_solver_package"]
+
+
+def set_petsc_options(prefix, options):
+    """ Set options in the PETSc options database, with the given
+    prefix. """
+    if options is None:
+        return
+    for key, value in options.items():
+        if value is None:
+            df.PETScOptions.set(prefix + key)
+        else:
+            df.PETScOptions.set(prefix + key, value)
+
+
+def create_linear_solver(a, L, w, bcs, options=None, a_pc=None):
+    """ Returns a solver for the linear problem a == L.
+
+    Uses the standard df.LinearVariationalSolver unless any of the
+    features of SubproblemSolver is requested in the dict options, which
+    may contain the keys split_assembly, frozen, preconditioner_reuse,
+    preconditioner, nonzero_initial_guess, petsc_options and name. The
+    form a_pc is only used together with a block preconditioner, and the
+    key mesh_hierarchy with a multigrid preconditioner. The quadrature
+    degree of the forms is set by the key quadrature_degree.
+    """
+    if options is None:
+        options = dict()
+    if options.get("split_assembly") or \
+       options.get("preconditioner_reuse") is not None or \
+       options.get("preconditioner") is not None or \
+       options.get("nonzero_initial_guess") or \
+       options.get("petsc_options"):
+        solver = SubproblemSolver(
+            a, L, w, bcs,
+            frozen=options.get("frozen", ()),
+            split=options.get("split_assembly", False),
+            preconditioner_reuse=options.get("preconditioner_reuse"),
+            preconditioner=options.get("preconditioner"),
+            a_pc=a_pc if options.get("preconditioner") is not None else None,
+            name=options.get("name", ""),
+            petsc_options=options.get("petsc_options"),
+            quadrature_degree=options.get("quadrature_degree"),
+            mesh_hierarchy=options.get("mesh_hierarchy"))
+        solver.parameters["nonzero_initial_guess"] = options.get(
+            "nonzero_initial_guess", False)
+        return solver
+    a, L = apply_quadrature_degree(options.get("name", ""),
+                                   [("a", a), ("L", L)],
+                                   options.get("quadrature_degree"))
+    problem = df.LinearVariationalProblem(a, L, w, bcs)
+    return df.LinearVariationalSolver(problem)
+
+
+def num_iterations_saved(solvers):
+    """ Returns the estimated number of Krylov iterations saved by
+    nonzero initial guesses, summed over the solvers. """
+    if not isinstance(solvers, dict):
+        solvers = dict(solver=solvers)
+    return sum(getattr(solver, "num_iterations_saved", 0.)
+               for solver in solvers.values())
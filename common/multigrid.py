@@ -0,0 +1,158 @@
+""" Geometric multigrid over a hierarchy of nested meshes.
+
+The hierarchy is made by uniform refinement of the mesh of the problem,
+which is then the coarsest level. The grid transfer (interpolation)
+operators between the levels are built once, with
+df.PETScDMCollection, and given to PETSc's PCMG, which forms the coarse
+operators by Galerkin projection. Multigrid is selected per subproblem
+through the named preconditioners of common/preconditioners.py.
+"""
+import dolfin as df
+import numpy as np
+
+__author__ = "Gaute Linga"
+
+__all__ = ["MultigridHierarchy", "create_mesh_hierarchy", "set_multigrid",
+           "MULTIGRID_OPTIONS"]
+
+
+# V-cycles with Chebyshev/Jacobi smoothing, and a direct solver on the
+# coarsest level. Can be overridden through petsc_options.
+MULTIGRID_OPTIONS = dict(
+    pc_mg_type="multiplicative",
+    pc_mg_cycle_type="v",
+    pc_mg_galerkin="both",
+    mg_levels_ksp_type="chebyshev",
+    mg_levels_ksp_max_it=2,
+    mg_levels_pc_type="jacobi",
+    mg_coarse_ksp_type="preonly",
+    mg_coarse_pc_type="redundant",
+    mg_coarse_redundant_pc_type="lu")
+
+
+class MultigridHierarchy:
+    """ The coarse levels of a mesh hierarchy, and the interpolation
+    operators between the levels. The finest level is given by the
+    function space the operators are requested for, such that the
+    hierarchy stays valid if the finest mesh is adapted or
+    repartitioned. """
+    def __init__(self, coarse_meshes, constrained_domain=None):
+        self.coarse_meshes = coarse_meshes
+        self.constrained_domain = constrained_domain
+        self.transfers = dict()
+
+    def num_levels(self):
+        return len(self.coarse_meshes) + 1
+
+    def coarse_space(self, level, element):
+        return df.FunctionSpace(self.coarse_meshes[level], element,
+                                constrained_domain=self.constrained_domain)
+
+    def interpolations(self, V):
+        """ Returns the interpolation operators (petsc4py matrices) from
+        each level to the next, coarsest first, for the (non-mixed)
+        function space V on the finest level. """
+        element = V.ufl_element()
+        spaces = [self.coarse_space(level, element)
+                  for level in range(len(self.coarse_meshes))] + [V]
+        interpolations = []
+        for level in range(len(self.coarse_meshes)):
+            # The operators to the finest level depend on its mesh
+            key = (repr(element), level,
+                   V.mesh().id() if level == len(self.coarse_meshes)-1
+                   else None)
+            if key not in self.transfers:
+                self.transfers[key] = \
+                    df.PETScDMCollection.create_transfer_matrix(
+                        spaces[level], spaces[level+1]).mat()
+            interpolations.append(self.transfers[key])
+        return interpolations
+
+
+def create_mesh_hierarchy(mesh, num_levels, constrained_domain=None,
+                          finest_mesh=None):
+    """ Refine mesh uniformly num_levels-1 times. Returns the finest mesh,
+    and the hierarchy of the coarser ones. If finest_mesh is given (e.g.
+    loaded from a checkpoint), it is used as the finest level instead of
+    the last refinement. """
+    meshes = [mesh]
+    for _ in range(num_levels-2):
+        meshes.append(df.refine(meshes[-1]))
+    if finest_mesh is None:
+        finest_mesh = df.refine(meshes[-1])
+    return finest_mesh, MultigridHierarchy(meshes, constrained_domain)
+
+
+def block_interpolations(hierarchy, function_space, group, dofs):
+    """ Returns the interpolation operators for the block of the
+    subspace group[0] of the mixed function_space, whose (sorted,
+    owned) dofs are given. The operators to the finest level are
+    composed with the map from the collapsed subspace to the block. """
+    from petsc4py import PETSc
+
+    if len(group) > 1:
+        raise ValueError("Multigrid is not supported for blocks with "
+                         "global (Real) constraints.")
+    V, collapsed_to_mixed = function_space.sub(group[0]).collapse(True)
+    interpolations = hierarchy.interpolations(V)
+
+    mixed_to_collapsed = dict((mixed, collapsed) for collapsed, mixed
+                              in collapsed_to_mixed.items())
+    mixed_start = function_space.dofmap().ownership_range()[0]
+    collapsed_range = V.dofmap().ownership_range()
+    S = PETSc.Mat().createAIJ(
+        ((len(dofs), None),
+         (collapsed_range[1]-collapsed_range[0], None)),
+        nnz=(1, 1), comm=interpolations[-1].getComm())
+    block_start = S.getOwnershipRange()[0]
+    for k, dof in enumerate(dofs):
+        S.setValue(block_start + k,
+                   V.dofmap().local_to_global_index(
+                       mixed_to_collapsed[dof - mixed_start]), 1.)
+    S.assemble()
+    return interpolations[:-1] + [S.matMult(interpolations[-1])]
+
+
+def configure_multigrid(ksp, prefix, interpolations):
+    """ Make the preconditioner of ksp a PCMG with the given
+    interpolation operators. Options already in the database take
+    precedence over MULTIGRID_OPTIONS. """
+    from petsc4py import PETSc
+
+    options = PETSc.Options()
+    options.setValue(prefix + "pc_type", "mg")
+    options.setValue(prefix + "pc_mg_levels", len(interpolations)+1)
+    for key, value in MULTIGRID_OPTIONS.items():
+        if not options.hasName(prefix + key):
+            options.setValue(prefix + key, value)
+    ksp.setFromOptions()
+    pc = ksp.getPC()
+    for level, P in enumerate(interpolations):
+        pc.setMGInterpolation(level+1, P)
+
+
+def set_multigrid(solver, name, function_space, hierarchy, prefix,
+                  groups=None):
+    """ Set up geometric multigrid for the PETScKrylovSolver solver with
+    the named preconditioner. Multigrid is applied either to the whole
+    operator, if groups is None, or to the last block of the field split
+    defined by groups. """
+    if hierarchy is None:
+        raise ValueError("The preconditioner {} requires a mesh "
+                         "hierarchy (multigrid_levels > 1).".format(name))
+    ksp = solver.ksp()
+    if groups is None:
+        configure_multigrid(ksp, prefix,
+                            hierarchy.interpolations(function_space))
+        return
+
+    # The sub-solvers of the field split exist only after setup
+    block = len(groups)-1
+    block_prefix = "{}fieldsplit_{}_".format(prefix, block)
+    df.PETScOptions.set(block_prefix + "pc_type", "none")
+    ksp.setUp()
+    dofs = np.sort(function_space.sub(groups[block][0]).dofmap().dofs())
+    configure_multigrid(
+        ksp.getPC().getFieldSplitSubKSP()[block], block_prefix,
+        block_interpolations(hierarchy, function_space, groups[block],
+                             dofs))
@@ -0,0 +1,263 @@
+""" Newton solver for the monolithic (fully coupled) schemes. """
+import dolfin as df
+import math
+from .cmd import info_blue
+from .forms import apply_quadrature_degree
+from .linalg import create_petsc_solver, is_direct_method
+
+__author__ = "Gaute Linga"
+
+__all__ = ["NewtonSolver"]
+
+
+class NewtonSolver:
+    """ Newton solver for the nonlinear problem F(w) == 0 with Jacobian J.
+
+    Can be used in place of df.NonlinearVariationalSolver; the settings
+    are found in parameters["newton_solver"]. In addition to the
+    standard settings, the following are supported:
+
+    jacobian_max_age: The Jacobian (and hence the factorization or
+        preconditioner) is reused for up to this many Newton iterations,
+        also across timesteps. It is rebuilt earlier when the residual is
+        reduced by less than a factor jacobian_rebuild_ratio in an
+        iteration, or when the line search fails.
+    eisenstat_walker: Solve the linear systems of a Krylov method
+        inexactly, with relative tolerances chosen from the convergence
+        of the residual (Eisenstat and Walker, 1996, choice 2).
+    line_search: Backtrack along the Newton direction until the residual
+        norm is sufficiently decreased.
+    step_tolerance: If positive, the iterations are also stopped when the
+        error of the iterate, estimated from the convergence rate of the
+        updates, is below step_tolerance times the change of w over the
+        solve (i.e. over the timestep). The nonlinear error is then kept
+        small compared to the time discretization error, without solving
+        to a fixed tolerance.
+
+    The counts of Newton iterations, Jacobian assemblies and linear
+    iterations of the last solve are found in stats, and are reported
+    if parameters["newton_solver"]["report"] is set.
+
+    If quadrature_degree is given, it is used for F and J.
+    """
+    def __init__(self, F, w, bcs, J, name="", petsc_options=None,
+                 quadrature_degree=None):
+        F, J = apply_quadrature_degree(name, [("F", F), ("J", J)],
+                                       quadrature_degree)
+        self.F = F
+        self.w = w
+        self.bcs = bcs
+        self.J = J
+        self.name = name
+        self.petsc_options = petsc_options
+
+        # Homogenized bcs for the Newton update
+        self.bcs_du = []
+        for bc in bcs:
+            bc_du = df.DirichletBC(bc)
+            bc_du.homogenize()
+            self.bcs_du.append(bc_du)
+
+        self.parameters = dict(newton_solver=dict(
+            linear_solver="default",
+            preconditioner="default",
+            relative_tolerance=1e-9,
+            absolute_tolerance=1e-10,
+            maximum_iterations=25,
+            error_on_nonconvergence=True,
+            report=True,
+            jacobian_max_age=1,
+            jacobian_rebuild_ratio=0.5,
+            eisenstat_walker=False,
+            eisenstat_walker_gamma=0.9,
+            eisenstat_walker_alpha=0.5*(1+math.sqrt(5)),
+            eisenstat_walker_eta_max=0.9,
+            line_search=False,
+            line_search_max_backtracks=10,
+            line_search_sufficient_decrease=1e-4,
+            step_tolerance=0.))
+
+        self.A = None
+        self.b = df.PETScVector()
+        self.du = None
+        self.w_old = None
+        self.w_start = None
+        self.solver = None
+        self.jacobian_age = 0
+        self.stats = dict()
+        self.num_jacobian_assemblies = 0
+        self.num_linear_iterations = 0
+        self.num_iterations = 0
+
+    def forms(self):
+        """ Returns the forms that are assembled by the solver. """
+        return [self.F, self.J]
+
+    def is_krylov(self):
+        """ Check if an iterative method is used for the linear systems.
+        The method is given by the ksp_type of petsc_options if set, and
+        otherwise by the linear_solver parameter. """
+        if self.petsc_options and "ksp_type" in self.petsc_options:
+            return self.petsc_options["ksp_type"] != "preonly"
+        return not is_direct_method(
+            self.parameters["newton_solver"]["linear_solver"])
+
+    def assemble_residual(self):
+        """ Assemble the residual at the current w. Returns its norm. """
+        df.assemble(self.F, tensor=self.b)
+        for bc in self.bcs_du:
+            bc.apply(self.b)
+        return self.b.norm("l2")
+
+    def assemble_jacobian(self):
+        """ Assemble the Jacobian at the current w. """
+        if self.A is None:
+            self.A = df.PETScMatrix()
+        df.assemble(self.J, tensor=self.A)
+        for bc in self.bcs_du:
+            bc.apply(self.A)
+        if self.solver is None:
+            prm = self.parameters["newton_solver"]
+            self.solver = create_petsc_solver(
+                self.A, prm["linear_solver"], prm["preconditioner"],
+                self.name + "_" if self.name else "", self.petsc_options)
+            self.du = self.w.vector().copy()
+        self.jacobian_age = 0
+        self.stats["jacobian_assemblies"] += 1
+
+    def step_error_converged(self, du_norm, du_norm_prev):
+        """ Check if the estimated error of the iterate is small compared
+        to the change of w since the start of the solve. """
+        if du_norm_prev is None or du_norm >= du_norm_prev:
+            return False
+        rate = du_norm/du_norm_prev
+        change = self.w.vector().copy()
+        change.axpy(-1.0, self.w_start)
+        return rate/(1.-rate)*du_norm <= \
+            self.parameters["newton_solver"]["step_tolerance"]*change.norm(
+                "l2")
+
+    def jacobian_outdated(self):
+        """ Check if the Jacobian should be rebuilt. """
+        return self.A is None or \
+            self.jacobian_age >= self.parameters["newton_solver"][
+                "jacobian_max_age"]
+
+    def solve_linear(self, eta):
+        """ Solve J du = F, with relative tolerance eta for a Krylov
+        method if eta is given. """
+        if eta is not None:
+            self.solver.ksp().setTolerances(rtol=eta)
+        self.du.zero()
+        num_iterations = self.solver.solve(self.du, self.b)
+        self.stats["linear_iterations"] += num_iterations
+        return num_iterations
+
+    def line_search(self, residual):
+        """ Backtracking line search along -du. Returns the new residual
+        norm, or None if no sufficient decrease was found. """
+        prm = self.parameters["newton_solver"]
+        if self.w_old is None:
+            self.w_old = self.w.vector().copy()
+        else:
+            self.w_old.zero()
+            self.w_old.axpy(1.0, self.w.vector())
+        step = 1.0
+        for _ in range(prm["line_search_max_backtracks"]+1):
+            self.w.vector().axpy(-step, self.du)
+            residual_new = self.assemble_residual()
+            if residual_new <= (
+                    1.-prm["line_search_sufficient_decrease"]*step)*residual:
+                return residual_new
+            self.w.vector().zero()
+            self.w.vector().axpy(1.0, self.w_old)
+            step *= 0.5
+        # Keep the shortest step
+        self.w.vector().axpy(-2*step, self.du)
+        self.assemble_residual()
+        return None
+
+    def solve(self):
+        """ Solve the nonlinear problem. Returns the tuple
+        (num_iterations, converged). """
+        prm = self.parameters["newton_solver"]
+        self.stats = dict(iterations=0, jacobian_assemblies=0,
+                          linear_iterations=0)
+        use_eisenstat_walker = prm["eisenstat_walker"] and self.is_krylov()
+
+        for bc in self.bcs:
+            bc.apply(self.w.vector())
+        use_step_tolerance = prm["step_tolerance"] > 0.
+        if use_step_tolerance:
+            if self.w_start is None:
+                self.w_start = self.w.vector().copy()
+            else:
+                self.w_start.zero()
+                self.w_start.axpy(1.0, self.w.vector())
+        du_norm_prev = None
+        residual = self.assemble_residual()
+        residual_0 = max(residual, df.DOLFIN_EPS)
+        converged = residual < prm["absolute_tolerance"]
+
+        eta = min(0.5, prm["eisenstat_walker_eta_max"])
+        iteration = 0
+        while not converged and iteration < prm["maximum_iterations"]:
+            if self.jacobian_outdated():
+                self.assemble_jacobian()
+            self.solve_linear(eta if use_eisenstat_walker else None)
+
+            if prm["line_search"]:
+                residual_new = self.line_search(residual)
+                if residual_new is None and self.jacobian_age > 0:
+                    # Failure might be due to an outdated Jacobian.
+                    self.w.vector().zero()
+                    self.w.vector().axpy(1.0, self.w_old)
+                    self.assemble_residual()
+                    self.jacobian_age = prm["jacobian_max_age"]
+                    continue
+                if residual_new is None:
+                    residual_new = self.b.norm("l2")
+            else:
+                self.w.vector().axpy(-1.0, self.du)
+                residual_new = self.assemble_residual()
+
+            iteration += 1
+            self.jacobian_age += 1
+            ratio = residual_new/max(residual, df.DOLFIN_EPS)
+            if ratio > prm["jacobian_rebuild_ratio"]:
+                self.jacobian_age = prm["jacobian_max_age"]
+
+            if use_eisenstat_walker:
+                gamma = prm["eisenstat_walker_gamma"]
+                alpha = prm["eisenstat_walker_alpha"]
+                eta_safe = gamma*eta**alpha
+                eta = gamma*ratio**alpha
+                if eta_safe > 0.1:
+                    eta = max(eta, eta_safe)
+                eta = min(eta, prm["eisenstat_walker_eta_max"])
+
+            residual = residual_new
+            converged = (residual < prm["absolute_tolerance"] or
+                         residual/residual_0 < prm["relative_tolerance"])
+            if use_step_tolerance and not converged:
+                du_norm = self.du.norm("l2")
+                converged = self.step_error_converged(du_norm, du_norm_prev)
+                du_norm_prev = du_norm
+
+        self.stats["iterations"] = iteration
+        self.num_iterations += iteration
+        self.num_jacobian_assemblies += self.stats["jacobian_assemblies"]
+        self.num_linear_iterations += self.stats["linear_iterations"]
+
+        if prm["report"]:
+            info_blue("Newton solver {}: {:d} iterations, residual {:e}, "
+                      "{:d} Jacobian assemblies/factorizations, "
+                      "{:d} linear iterations".format(
+                          self.name, iteration, residual,
+                          self.stats["jacobian_assemblies"],
+                          self.stats["linear_iterations"]))
+        if not converged and prm["error_on_nonconvergence"]:
+            raise RuntimeError(
+                "Newton solver {} did not converge in {:d} iterations.".format(
+                    self.name, iteration))
+        return iteration, converged
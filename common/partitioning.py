@@ -0,0 +1,123 @@
+""" Repartitioning of the mesh to balance the load between the
+processes. """
+import dolfin as df
+import os
+from .cmd import info_cyan, MPI_size
+from .io import mpi_comm, mpi_barrier, remove_safe
+
+__author__ = "Gaute Linga"
+
+__all__ = ["LoadBalancer"]
+
+
+class LoadBalancer:
+    """ Repartitions the mesh when the cells are unevenly distributed
+    between the processes, e.g. after adaptive refinement, which keeps
+    the new cells on the process of their parent cell.
+
+    The imbalance is the maximal over the mean number of cells per
+    process. The mesh and the solutions are written to an HDF5 file, and
+    read back with a new partition computed by the graph partitioner of
+    dolfin (SCOTCH or ParMETIS). The partitioner is not given cell
+    weights, so it balances the number of cells, which only
+    approximates the balance of the DOFs. The imbalance in owned DOFs of
+    the function spaces, which is the load of the solvers, is therefore
+    reported as well.
+
+    The settings are:
+
+    intv: Number of timesteps between checks of the imbalance. If 0,
+        the imbalance is only checked after the mesh has been adapted.
+    imbalance_tol: Repartition if the imbalance exceeds this.
+    partitioner: The graph partitioner, SCOTCH or ParMETIS. If None, the
+        dolfin default is used.
+    """
+    def __init__(self, folder, settings=None):
+        self.h5filename = os.path.join(folder, "Checkpoint",
+                                       "repartition.h5")
+        self.settings = dict(intv=0,
+                             imbalance_tol=1.2,
+                             partitioner=None)
+        if settings is not None:
+            self.settings.update(settings)
+        if self.settings["partitioner"] is not None:
+            df.parameters["mesh_partitioner"] = self.settings["partitioner"]
+        self.num_repartitions = 0
+        self.dof_imbalance_before = None
+
+    def is_due(self, tstep, remeshed=False):
+        """ Check if the imbalance should be checked. """
+        if MPI_size == 1:
+            return False
+        intv = self.settings["intv"]
+        return remeshed or (intv > 0 and tstep % intv == 0)
+
+    def imbalance(self, mesh):
+        """ Returns the maximal over the mean number of cells per
+        process. """
+        num_cells = float(mesh.num_cells())
+        num_cells_max = df.MPI.max(mpi_comm(), num_cells)
+        num_cells_mean = df.MPI.sum(mpi_comm(), num_cells)/MPI_size
+        return num_cells_max/max(num_cells_mean, 1.)
+
+    def dof_imbalance(self, w_):
+        """ Returns the maximal over the mean number of owned DOFs per
+        process, summed over the function spaces of the functions in the
+        dict w_. """
+        num_dofs = 0.
+        for f in w_.values():
+            ownership_range = f.function_space().dofmap().ownership_range()
+            num_dofs += ownership_range[1] - ownership_range[0]
+        num_dofs_max = df.MPI.max(mpi_comm(), num_dofs)
+        num_dofs_mean = df.MPI.sum(mpi_comm(), num_dofs)/MPI_size
+        return num_dofs_max/max(num_dofs_mean, 1.)
+
+    def is_imbalanced(self, mesh):
+        return self.imbalance(mesh) > self.settings["imbalance_tol"]
+
+    def repartition(self, mesh, w_dicts=None):
+        """ Returns the repartitioned mesh. The functions in the list of
+        dicts w_dicts (e.g. [w_, w_1]) are stored, to be loaded into the
+        functions on the new mesh by load_functions. """
+        timer = df.Timer("Repartition mesh")
+        imbalance_before = self.imbalance(mesh)
+        if w_dicts:
+            self.dof_imbalance_before = self.dof_imbalance(w_dicts[0])
+        h5file = df.HDF5File(mpi_comm(), self.h5filename, "w")
+        h5file.write(mesh, "mesh")
+        for i, w in enumerate(w_dicts or []):
+            if w is None:
+                continue
+            for name, f in w.items():
+                h5file.write(f, "{}/{}".format(i, name))
+        h5file.close()
+
+        new_mesh = df.Mesh()
+        h5file = df.HDF5File(mpi_comm(), self.h5filename, "r")
+        h5file.read(new_mesh, "mesh", False)
+        h5file.close()
+        timer.stop()
+        self.num_repartitions += 1
+        info_cyan("Repartitioned mesh: cell imbalance (max/mean) "
+                  "{0:.3f} before, {1:.3f} after".format(
+                      imbalance_before, self.imbalance(new_mesh)))
+        return new_mesh
+
+    def load_functions(self, w_dicts):
+        """ Load the functions stored by repartition into w_dicts, and
+        remove the file. The DOF imbalance before and after is
+        reported. """
+        if self.dof_imbalance_before is not None:
+            info_cyan("Repartitioned mesh: DOF imbalance (max/mean) "
+                      "{0:.3f} before, {1:.3f} after".format(
+                          self.dof_imbalance_before,
+                          self.dof_imbalance(w_dicts[0])))
+        h5file = df.HDF5File(mpi_comm(), self.h5filename, "r")
+        for i, w in enumerate(w_dicts):
+            if w is None:
+                continue
+            for name, f in w.items():
+                h5file.read(f, "{}/{}".format(i, name))
+        h5file.close()
+        mpi_barrier()
+        remove_safe(self.h5filename)
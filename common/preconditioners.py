@@ -0,0 +1,224 @@
+""" Block preconditioners for the mixed subproblems.
+
+The preconditioners are built with PETSc's PCFieldSplit and are
+configured through the PETSc options database, using the name of the
+subproblem as options prefix. They are selected by name, per
+subproblem, through the parameter 'preconditioners', e.g.
+    preconditioners={"NS": "schur_pressure_mass"}
+
+The geometric multigrid preconditioners (see common/multigrid.py)
+require a mesh hierarchy.
+"""
+import dolfin as df
+import numpy as np
+
+__author__ = "Gaute Linga"
+
+__all__ = ["PRECONDITIONERS", "get_preconditioner", "uses_pressure_mass",
+           "uses_multigrid", "field_groups", "set_fieldsplit_options",
+           "set_fieldsplit_is"]
+
+
+# AMG applied to a single block
+_block_amg = dict(ksp_type="preonly",
+                  pc_type="hypre",
+                  pc_hypre_type="boomeramg")
+
+
+# Direct (LU) solve of a single block, also in parallel
+_block_direct = dict(ksp_type="preonly",
+                     pc_type="redundant",
+                     redundant_pc_type="lu")
+
+
+def _prefixed(prefix, options):
+    return dict((prefix + key, value) for key, value in options.items())
+
+
+PRECONDITIONERS = dict(
+    # Saddle point (velocity, pressure): Upper block triangular Schur
+    # complement factorization. AMG on the velocity block; the Schur
+    # complement is approximated by the pressure mass matrix scaled by
+    # the inverse (local) viscosity.
+    schur_pressure_mass=dict(
+        groups="first_rest",
+        pressure_mass=True,
+        multigrid=False,
+        options=dict(
+            ksp_type="gmres",
+            pc_type="fieldsplit",
+            pc_fieldsplit_type="schur",
+            pc_fieldsplit_schur_fact_type="upper",
+            pc_fieldsplit_schur_precondition="a11",
+            fieldsplit_1_ksp_type="preonly",
+            fieldsplit_1_pc_type="jacobi",
+            **_prefixed("fieldsplit_0_", _block_amg))),
+    # Saddle point (velocity, pressure): As above, but with the
+    # least-squares commutator approximation of the Schur complement,
+    # which also accounts for convection.
+    schur_lsc=dict(
+        groups="first_rest",
+        pressure_mass=False,
+        multigrid=False,
+        options=dict(
+            ksp_type="gmres",
+            pc_type="fieldsplit",
+            pc_fieldsplit_type="schur",
+            pc_fieldsplit_schur_fact_type="upper",
+            pc_fieldsplit_schur_precondition="self",
+            fieldsplit_1_ksp_type="preonly",
+            fieldsplit_1_pc_type="lsc",
+            fieldsplit_1_lsc_pc_type="hypre",
+            fieldsplit_1_lsc_pc_hypre_type="boomeramg",
+            **_prefixed("fieldsplit_0_", _block_amg))),
+    # Coupled scalar fields (concentrations, potential): One block per
+    # field, each approximately solved by AMG. The blocks are combined
+    # additively (block Jacobi), multiplicatively (block Gauss-Seidel),
+    # or symmetric multiplicatively.
+    block_jacobi=dict(
+        groups="each",
+        pressure_mass=False,
+        multigrid=False,
+        options=dict(
+            ksp_type="gmres",
+            pc_type="fieldsplit",
+            pc_fieldsplit_type="additive",
+            fieldsplit_ksp_type="preonly",
+            fieldsplit_pc_type="hypre",
+            fieldsplit_pc_hypre_type="boomeramg")),
+    block_gauss_seidel=dict(
+        groups="each",
+        pressure_mass=False,
+        multigrid=False,
+        options=dict(
+            ksp_type="gmres",
+            pc_type="fieldsplit",
+            pc_fieldsplit_type="multiplicative",
+            fieldsplit_ksp_type="preonly",
+            fieldsplit_pc_type="hypre",
+            fieldsplit_pc_hypre_type="boomeramg")),
+    block_symmetric_gauss_seidel=dict(
+        groups="each",
+        pressure_mass=False,
+        multigrid=False,
+        options=dict(
+            ksp_type="gmres",
+            pc_type="fieldsplit",
+            pc_fieldsplit_type="symmetric_multiplicative",
+            fieldsplit_ksp_type="preonly",
+            fieldsplit_pc_type="hypre",
+            fieldsplit_pc_hypre_type="boomeramg")),
+    # Scalar Poisson-type subproblems (pressure): Geometric multigrid
+    # over the mesh hierarchy, with CG.
+    gmg=dict(
+        groups=None,
+        pressure_mass=False,
+        multigrid=True,
+        options=dict(ksp_type="cg")),
+    # Coupled scalar fields (concentrations, potential): As the block
+    # preconditioners above, but with geometric multigrid for the last
+    # block (the potential).
+    block_jacobi_gmg=dict(
+        groups="each",
+        pressure_mass=False,
+        multigrid=True,
+        options=dict(
+            ksp_type="gmres",
+            pc_type="fieldsplit",
+            pc_fieldsplit_type="additive",
+            fieldsplit_ksp_type="preonly",
+            fieldsplit_pc_type="hypre",
+            fieldsplit_pc_hypre_type="boomeramg")),
+    block_gauss_seidel_gmg=dict(
+        groups="each",
+        pressure_mass=False,
+        multigrid=True,
+        options=dict(
+            ksp_type="gmres",
+            pc_type="fieldsplit",
+            pc_fieldsplit_type="multiplicative",
+            fieldsplit_ksp_type="preonly",
+            fieldsplit_pc_type="hypre",
+            fieldsplit_pc_hypre_type="boomeramg"))
+)
+
+
+def get_preconditioner(name):
+    """ Returns the description of the named preconditioner. """
+    if name not in PRECONDITIONERS:
+        raise KeyError("Unknown preconditioner: {}. Available: {}".format(
+            name, ", ".join(sorted(PRECONDITIONERS.keys()))))
+    return PRECONDITIONERS[name]
+
+
+def uses_pressure_mass(name):
+    """ Check if the preconditioner needs the pressure mass matrix. """
+    return name is not None and get_preconditioner(name)["pressure_mass"]
+
+
+def uses_multigrid(name):
+    """ Check if the preconditioner uses geometric multigrid. """
+    return name is not None and get_preconditioner(name)["multigrid"]
+
+
+def field_groups(name, function_space):
+    """ Returns the subspace indices that make up each block, or None if
+    the preconditioner is not a block preconditioner. Global (Real)
+    constraints, such as p0 and V0, are kept in the block of the field
+    they constrain. Such blocks are solved directly (see
+    set_fieldsplit_options), since the dense row and column of the
+    constraint, with a zero diagonal, break AMG and Jacobi. """
+    num_sub_spaces = function_space.num_sub_spaces()
+    if get_preconditioner(name)["groups"] is None:
+        return None
+    if get_preconditioner(name)["groups"] == "first_rest":
+        return [[0], list(range(1, num_sub_spaces))]
+    groups = []
+    for i in range(num_sub_spaces):
+        if groups and \
+           function_space.sub(i).ufl_element().family() == "Real":
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return groups
+
+
+def set_fieldsplit_options(name, prefix, function_space):
+    """ Set the PETSc options of the named block preconditioner for the
+    function_space. The blocks with a Real constraint are solved
+    directly instead. Options set afterwards (e.g. petsc_options) take
+    precedence. """
+    options = get_preconditioner(name)["options"]
+    for key, value in options.items():
+        df.PETScOptions.set(prefix + key, value)
+    groups = field_groups(name, function_space)
+    for i, group in enumerate(groups or []):
+        if any(function_space.sub(j).ufl_element().family() == "Real"
+               for j in group):
+            # The unassembled Schur complement can not be factorized
+            if options.get("pc_fieldsplit_schur_precondition") == "self":
+                df.PETScOptions.set(
+                    prefix + "pc_fieldsplit_schur_precondition", "selfp")
+            block_prefix = "{}fieldsplit_{}_".format(prefix, i)
+            for key, value in _block_direct.items():
+                df.PETScOptions.set(block_prefix + key, value)
+
+
+def set_fieldsplit_is(solver, name, function_space):
+    """ Define the blocks of the named preconditioner for the
+    PETScKrylovSolver solver, if it has any. Its options must already
+    be set. """
+    from petsc4py import PETSc
+
+    groups = field_groups(name, function_space)
+    if groups is None:
+        return
+    ksp = solver.ksp()
+    comm = ksp.getComm()
+    fields = []
+    for i, group in enumerate(groups):
+        dofs = np.sort(np.concatenate(
+            [function_space.sub(j).dofmap().dofs() for j in group]))
+        fields.append((str(i), PETSc.IS().createGeneral(
+            dofs.astype(PETSc.IntType), comm=comm)))
+    ksp.getPC().setFieldSplitIS(*fields)
@@ -0,0 +1,434 @@
+""" Adaptive timestep control, pseudo-transient continuation, multistep
+and multirate time integration, and history of previous solutions. """
+import dolfin as df
+import math
+import numpy as np
+from .cmd import info_yellow, info_cyan
+from .io import mpi_is_root
+
+__author__ = "Gaute Linga"
+
+__all__ = ["TimestepController", "SteadyStateController", "SolutionHistory",
+           "BDFScheme", "MultirateScheduler"]
+
+
+class TimestepController:
+    """ Chooses the timestep from a local Courant number and an estimate
+    of the error made in the last step.
+
+    The Courant number is the maximum over the cells of the cell-averaged
+    |u| dt / h. The error is estimated by comparing the new solution to
+    the one predicted by linear extrapolation from the two previous
+    steps, which for a first order scheme is proportional to the local
+    truncation error. A step is rejected and should be redone with a
+    smaller timestep if the solver did not converge, or if the estimated
+    error exceeds error_tol.
+    """
+    def __init__(self, mesh, u, dt, settings=None):
+        self.settings = dict(courant_max=0.5,
+                             error_tol=1e-2,
+                             dt_min=1e-3*dt,
+                             dt_max=1e3*dt,
+                             growth_max=2.,
+                             shrink_min=0.2,
+                             safety=0.9,
+                             reject_factor=0.5)
+        if settings is not None:
+            self.settings.update(settings)
+
+        self.dt = dt
+        self.dt_prev = None
+        self.w_prev = None
+        self.courant = 0.
+        self.error = 0.
+        self.num_accepted = 0
+        self.num_rejected = 0
+
+        self.velocity_form = None
+        self.set_mesh(mesh, u)
+
+    def set_mesh(self, mesh, u):
+        """ Use the velocity u on mesh, e.g. after the mesh has been
+        adapted. The error estimate starts over. """
+        self.w_prev = None
+        self.velocity_form = None
+        if u is not None:
+            DG0 = df.FunctionSpace(mesh, "DG", 0)
+            v = df.TestFunction(DG0)
+            h = df.CellDiameter(mesh)
+            self.velocity_form = df.sqrt(df.dot(u, u))/h*v/df.CellVolume(
+                mesh)*df.dx
+
+    def courant_number(self, dt):
+        """ Returns the maximal cell Courant number. """
+        if self.velocity_form is None:
+            return 0.
+        return dt*df.assemble(self.velocity_form).max()
+
+    def estimate_error(self, w_, w_1, dt):
+        """ Returns the estimated relative error of the last step. """
+        if self.w_prev is None:
+            return 0.
+        error = 0.
+        for name in w_:
+            # Linear extrapolation from the two previous steps
+            diff = w_1[name].vector().copy()
+            diff.axpy(-1., self.w_prev[name])
+            diff *= -dt/self.dt_prev
+            diff.axpy(1., w_[name].vector())
+            diff.axpy(-1., w_1[name].vector())
+            norm = max(w_[name].vector().norm("l2"), df.DOLFIN_EPS)
+            error = max(error, diff.norm("l2")/norm)
+        return dt/(dt + self.dt_prev)*error
+
+    def evaluate(self, w_, w_1, converged=True):
+        """ Evaluate the step just taken from w_1 to w_. Returns a tuple
+        (accepted, dt), where dt is the timestep to be used for the
+        next (or repeated) step. """
+        s = self.settings
+        dt = self.dt
+        if not converged:
+            if dt <= s["dt_min"]:
+                raise RuntimeError(
+                    "Solver did not converge with the smallest allowed "
+                    "timestep dt_min={}.".format(s["dt_min"]))
+            self.num_rejected += 1
+            self.dt = max(s["reject_factor"]*dt, s["dt_min"])
+            info_yellow("Step did not converge: Reducing dt to {}".format(
+                self.dt))
+            return False, self.dt
+
+        self.courant = self.courant_number(dt)
+        self.error = self.estimate_error(w_, w_1, dt)
+
+        factor = s["growth_max"]
+        if self.courant > 0.:
+            factor = min(factor, s["courant_max"]/self.courant)
+        if self.error > 0.:
+            factor = min(factor, math.sqrt(s["error_tol"]/self.error))
+        factor = max(s["safety"]*factor, s["shrink_min"])
+        dt_new = min(max(factor*dt, s["dt_min"]), s["dt_max"])
+
+        if self.error > s["error_tol"] and dt > s["dt_min"]:
+            self.num_rejected += 1
+            self.dt = dt_new
+            info_yellow("Step rejected (error estimate {:e}): "
+                        "Reducing dt to {}".format(self.error, self.dt))
+            return False, self.dt
+
+        # Accept the step and store the previous solution for the next
+        # error estimate.
+        self.num_accepted += 1
+        if self.w_prev is None:
+            self.w_prev = dict((name, w_1[name].vector().copy())
+                               for name in w_1)
+        else:
+            for name in w_1:
+                self.w_prev[name].zero()
+                self.w_prev[name].axpy(1., w_1[name].vector())
+        self.dt_prev = dt
+        self.dt = dt_new
+        return True, self.dt
+
+
+class SteadyStateController:
+    """ Pseudo-transient continuation towards a steady state.
+
+    The residual of the steady problem is measured by the time derivative,
+    max over the subproblems of |w_ - w_1|/(dt |w_|). The timestep is
+    grown as the residual decreases, by switched evolution relaxation
+    (SER, Mulder and van Leer, 1985):
+
+        dt_new = dt (r_prev/r)^exponent,
+
+    limited by growth_max, dt_min and dt_max. The iterations stop when
+    the residual is reduced by a factor tol (or is below abs_tol), when
+    the relative change of the energy over a step is below energy_tol
+    (if positive, and an energy is given), or after max_tsteps steps.
+    The residual history is kept, and can be saved to file.
+    """
+    def __init__(self, dt, settings=None):
+        self.settings = dict(tol=1e-6,
+                             abs_tol=0.,
+                             energy_tol=0.,
+                             exponent=1.,
+                             growth_max=10.,
+                             dt_min=1e-3*dt,
+                             dt_max=1e6*dt,
+                             max_tsteps=10000)
+        if settings is not None:
+            self.settings.update(settings)
+
+        self.dt = dt
+        self.residual = None
+        self.residual_0 = None
+        self.energy = None
+        self.energy_change = None
+        self.converged = False
+        self.history = []
+
+    def compute_residual(self, w_, w_1, dt):
+        """ Returns the relative time derivative of the step just taken
+        from w_1 to w_. """
+        residual = 0.
+        for name in w_:
+            diff = w_[name].vector().copy()
+            diff.axpy(-1., w_1[name].vector())
+            norm = max(w_[name].vector().norm("l2"), df.DOLFIN_EPS)
+            residual = max(residual, diff.norm("l2")/(dt*norm))
+        return residual
+
+    def evaluate(self, w_, w_1, tstep, t, energy=None):
+        """ Evaluate the step just taken from w_1 to w_, at timestep tstep
+        and time t. Returns the timestep to be used for the next step. """
+        s = self.settings
+        dt = self.dt
+        residual = self.compute_residual(w_, w_1, dt)
+        if self.residual_0 is None:
+            self.residual_0 = max(residual, df.DOLFIN_EPS)
+
+        if energy is not None and self.energy is not None:
+            self.energy_change = abs(energy - self.energy)/max(
+                abs(energy), df.DOLFIN_EPS)
+        self.energy = energy
+        self.history.append((tstep, t, dt, residual,
+                             energy if energy is not None else np.nan))
+
+        self.converged = bool(
+            residual < s["tol"]*self.residual_0 or
+            residual < s["abs_tol"] or
+            (s["energy_tol"] > 0. and self.energy_change is not None and
+             self.energy_change < s["energy_tol"]))
+
+        factor = 1.
+        if self.residual is not None and residual > 0.:
+            factor = min((self.residual/residual)**s["exponent"],
+                         s["growth_max"])
+        self.residual = residual
+        self.dt = min(max(factor*dt, s["dt_min"]), s["dt_max"])
+        return self.dt
+
+    def is_done(self):
+        """ Check if the steady state is reached, or the maximal number of
+        steps has been taken. """
+        return self.converged or len(self.history) >= \
+            self.settings["max_tsteps"]
+
+    def save(self, filename):
+        """ Save the residual history. """
+        if mpi_is_root():
+            np.savetxt(filename, np.array(self.history),
+                       header="Step\tTime\tdt\tResidual\tEnergy")
+
+
+class SolutionHistory:
+    """ Keeps the solutions w_2, w_3, ... of previous timesteps (w_1 is
+    the latest), and extrapolates them polynomially to the next time
+    level, e.g. to get initial guesses for the iterative solvers.
+    Variable timesteps are taken into account.
+    """
+    def __init__(self, w_1, order):
+        self.order = order
+        self.w = [w_1] + [
+            dict((name, df.Function(f.function_space(),
+                                    name="{}_{}".format(name, k)))
+                 for name, f in w_1.items())
+            for k in range(2, order+2)]
+        self.dts = []
+
+    def push(self, dt):
+        """ Shift the history. Must be called just before w_1 is updated
+        after a timestep of size dt. """
+        for k in range(len(self.w)-1, 0, -1):
+            for name in self.w[k]:
+                self.w[k][name].assign(self.w[k-1][name])
+        self.dts = ([dt] + self.dts)[:self.order]
+
+    def extrapolate(self, w_, dt):
+        """ Set w_ to the extrapolation to the next time level, which is a
+        timestep dt ahead of w_1. """
+        # Time levels relative to the one of w_1
+        times = [0.]
+        for dt_k in self.dts:
+            times.append(times[-1] - dt_k)
+        weights = []
+        for j, t_j in enumerate(times):
+            weight = 1.
+            for m, t_m in enumerate(times):
+                if m != j:
+                    weight *= (dt - t_m)/(t_j - t_m)
+            weights.append(weight)
+        for name in w_:
+            w_[name].vector().zero()
+            for w_k, weight in zip(self.w, weights):
+                w_[name].vector().axpy(weight, w_k[name].vector())
+            w_[name].vector().apply("insert")
+
+
+class BDFScheme:
+    """ Coefficients of the (variable step) second order backward
+    differentiation formula, BDF2, in an implicit-explicit setting.
+
+    The time derivative of x at the new time level is approximated by
+    per_tau*(a0*x - history(x_1, x_2)), where x_1 and x_2 are the
+    solutions of the two previous timesteps. Terms that are treated
+    explicitly (lagged) use the extrapolation extrapolate(x_1, x_2) to
+    the new time level. The coefficients are df.Constants, such that
+    the forms are set up once. Until a previous timestep is available,
+    the coefficients are those of backward Euler.
+
+    With r = dt/dt_prev, the ratio of the new to the previous timestep,
+    a0 = (1+2r)/(1+r), and history and extrapolation have the weights
+    (1+r, r^2/(1+r)) and (1+r, r), respectively.
+    """
+    def __init__(self, dt, dt_prev=None):
+        self.a0 = df.Constant(1.)
+        self.a1 = df.Constant(1.)
+        self.a2 = df.Constant(0.)
+        self.e1 = df.Constant(1.)
+        self.e2 = df.Constant(0.)
+        self.dt_prev = dt_prev
+        self.set_timestep(dt)
+
+    def history(self, x_1, x_2):
+        """ The part of the time increment given by previous timesteps. """
+        return self.a1*x_1 - self.a2*x_2
+
+    def extrapolate(self, x_1, x_2):
+        """ Extrapolation of x to the new time level. """
+        return self.e1*x_1 - self.e2*x_2
+
+    def set_timestep(self, dt):
+        """ Set the coefficients for the timestep dt. Returns True if a0,
+        and thereby the operators, has changed. """
+        if self.dt_prev is None:
+            coeffs = (1., 1., 0., 1., 0.)
+        else:
+            r = dt/self.dt_prev
+            coeffs = ((1.+2*r)/(1.+r), 1.+r, r**2/(1.+r), 1.+r, r)
+        a0_old = float(self.a0)
+        for constant, value in zip(
+                [self.a0, self.a1, self.a2, self.e1, self.e2], coeffs):
+            constant.assign(value)
+        return float(self.a0) != a0_old
+
+    def push(self, dt):
+        """ Register a completed timestep of size dt, and set the
+        coefficients of the next timestep, assumed to be of the same
+        size. Returns True if the operators have changed. """
+        self.dt_prev = dt
+        return self.set_timestep(dt)
+
+    def is_second_order(self):
+        """ Check if a previous timestep is available. """
+        return self.dt_prev is not None
+
+
+class MultirateScheduler:
+    """ Advances subproblems with several substeps per timestep.
+
+    A subproblem with n substeps is solved n times per timestep, with the
+    time derivative scaled by the df.Constant per_tau[name] = n/dt, and
+    the previous solution w_1 set to the last substep in between.
+
+    The subproblems solved earlier in the same timestep are interpolated
+    linearly in time over the substeps: in substep k, their w_1 and w_
+    are set to their values at the start and the end of the substep.
+    Subproblems solved later are lagged, as without substeps. After the
+    substeps, the fields of the other subproblems are restored, and w_1
+    of the substepped subproblem is reset to the start of the timestep,
+    such that the subproblems solved later see the same fields as
+    without substeps.
+
+    The computing time spent on each subproblem is accumulated and
+    reported.
+    """
+    def __init__(self, w_, w_1, substeps, dt):
+        self.w_ = w_
+        self.w_1 = w_1
+        self.substeps = dict((name, int(n)) for name, n in substeps.items()
+                             if name in w_ and int(n) > 1)
+        self.per_tau = dict((name, df.Constant(n/dt))
+                            for name, n in self.substeps.items())
+        self.w_start = dict()
+        self.w_end = dict()
+        self.computing_time = dict()
+        self.num_solves = dict()
+
+    def set_timestep(self, dt):
+        """ Update the substeps to the timestep dt. """
+        for name, n in self.substeps.items():
+            self.per_tau[name].assign(n/dt)
+
+    def work_function(self, functions, name):
+        if name not in functions:
+            functions[name] = df.Function(self.w_[name].function_space())
+        return functions[name]
+
+    def interpolate(self, f, name, theta):
+        """ Set f to the subproblem name at the fraction theta of the
+        timestep. """
+        f.vector().zero()
+        f.vector().axpy(1.-theta, self.w_start[name].vector())
+        f.vector().axpy(theta, self.w_end[name].vector())
+        f.vector().apply("insert")
+
+    def timed_solve(self, name, solvers):
+        timer = df.Timer("Solve subproblem " + name)
+        solvers[name].solve()
+        self.computing_time[name] = self.computing_time.get(name, 0.) + \
+            timer.stop()
+        self.num_solves[name] = self.num_solves.get(name, 0) + 1
+
+    def solve(self, subproblems, solvers, after_solve=None):
+        """ Solve the subproblems once, in the given order. after_solve is
+        called with the name of a subproblem whenever its fields have
+        changed, e.g. to update coefficients depending on them. """
+        for i, name in enumerate(subproblems):
+            if name in self.substeps:
+                self.solve_substeps(name, subproblems[:i], solvers,
+                                    after_solve)
+            else:
+                self.timed_solve(name, solvers)
+                if after_solve is not None:
+                    after_solve(name)
+
+    def solve_substeps(self, name, solved, solvers, after_solve=None):
+        """ Take the substeps of the subproblem name. The subproblems in
+        solved have already been advanced in this timestep. """
+        n = self.substeps[name]
+        self.work_function(self.w_start, name).assign(self.w_1[name])
+        for other in solved:
+            self.work_function(self.w_start, other).assign(self.w_1[other])
+            self.work_function(self.w_end, other).assign(self.w_[other])
+        for k in range(1, n+1):
+            for other in solved:
+                self.interpolate(self.w_1[other], other, (k-1.)/n)
+                self.interpolate(self.w_[other], other, float(k)/n)
+                if after_solve is not None:
+                    after_solve(other)
+            self.timed_solve(name, solvers)
+            if k < n:
+                self.w_1[name].assign(self.w_[name])
+                if after_solve is not None:
+                    after_solve(name)
+        self.w_1[name].assign(self.w_start[name])
+        if after_solve is not None:
+            after_solve(name)
+        for other in solved:
+            self.w_1[other].assign(self.w_start[other])
+            self.w_[other].assign(self.w_end[other])
+            if after_solve is not None:
+                after_solve(other)
+
+    def report(self):
+        """ Report and reset the computing time per subproblem. """
+        total = max(sum(self.computing_time.values()), df.DOLFIN_EPS)
+        for name in sorted(self.computing_time):
+            info_cyan("Subproblem {0}: {1:d} substeps per timestep, "
+                      "{2:d} solves, {3:f} seconds ({4:.1f} %)".format(
+                          name, self.substeps.get(name, 1),
+                          self.num_solves[name], self.computing_time[name],
+                          100.*self.computing_time[name]/total))
+        self.computing_time = dict()
+        self.num_solves = dict()
@@ -13,7 +13,7 @@ df.parameters["form_compiler"]["optimize"] = True
 # df.parameters["form_compiler"]["representation"] = "quadrature"
 df.parameters["linear_algebra_backend"] = "PETSc"
 df.parameters["std_out_all_processes"] = False
-# df.parameters["krylov_solver"]["nonzero_initial_guess"] = True
+# Nonzero initial guesses for the Krylov solvers: see initial_guess
 df.parameters["form_compiler"]["cpp_optimize_flags"] = "-O3"
 # df.set_log_active(False)
 
@@ -36,6 +36,32 @@ parameters = dict(
     info_intv=10,
     use_iterative_solvers=False,
     use_pressure_stabilization=False,
+    split_assembly=False,
+    preconditioner_reuse=dict(),
+    preconditioners=dict(),
+    petsc_options=dict(),
+    newton_solver=dict(),
+    equilibration=dict(),
+    coefficient_fields=None,
+    quadrature_degree=None,
+    mass_lumping=False,
+    time_scheme="BE",
+    substeps=dict(),
+    precompile=False,
+    jit_cache_dir=None,
+    adaptive_dt=False,
+    adaptive_dt_settings=dict(),
+    adaptive_mesh=False,
+    adaptive_mesh_settings=dict(),
+    repartition=False,
+    repartition_settings=dict(),
+    multigrid_levels=1,
+    steady_state=False,
+    steady_state_settings=dict(),
+    coupling_max_iter=1,
+    coupling_tol=1e-6,
+    coupling_anderson_depth=0,
+    initial_guess=None,
     dump_subdomains=False,
     V_lagrange=False,
     p_lagrange=False,
@@ -102,7 +128,7 @@ def internalize_cmd_kwargs(parameters, cmd_kwargs):
     Consider moving this to common/cmd.py
     """
     for key, val in cmd_kwargs.items():
-        if isinstance(val, dict):
+        if isinstance(val, dict) and isinstance(parameters.get(key), dict):
             parameters[key].update(val)
         else:
             parameters[key] = val
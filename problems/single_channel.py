@@ -201,6 +201,8 @@ def start_hook(w_, w_1, test_functions,
                use_iterative_solvers,
                V_lagrange,
                enable_EC,
+               newton_solver,
+               equilibration,
                **namespace):
     if enable_EC:
         from solvers.stable_single import equilibrium_EC
@@ -208,7 +208,8 @@ def start_hook(w_, w_1, test_functions,
                dirichlet_bcs, neumann_bcs, boundary_to_mark,
                use_iterative_solvers,
                restart_folder,
-               V_lagrange, **namespace):
+               V_lagrange, newton_solver, equilibration,
+               **namespace):
     if not restart_folder:
         from solvers.stable_single import equilibrium_EC_PNP
         info_blue("Equilibrating with a non-linear solver.")
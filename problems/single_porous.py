@@ -188,7 +188,8 @@ def start_hook(w_, w_1, test_functions,
                dx, ds, normal,
                dirichlet_bcs, neumann_bcs, boundary_to_mark,
                use_iterative_solvers,
-               V_lagrange, **namespace):
+               V_lagrange, newton_solver, equilibration,
+               **namespace):
     from solvers.stable_single import equilibrium_EC
     info_blue("Equilibrating with a non-linear solver.")
     equilibrium_EC(**vars())
@@ -3,9 +3,20 @@ This is the main module for running the BERNAISE code.
 More specific info will follow in a later commit.
 """
 import dolfin as df
+import importlib
 from common.cmd import parse_command_line, help_menu
 from common.io import create_initial_folders, load_checkpoint, save_solution, \
     load_parameters, load_mesh
+from common.timestepping import TimestepController, \
+    SteadyStateController, SolutionHistory
+from common.linalg import num_iterations_saved
+from common.forms import get_quadrature_degree
+from common.jit import set_jit_cache_dir, precompile_solvers
+from common.discretization import create_spaces, create_functions, \
+    create_boundary_conditions, initialize_functions, transfer_functions
+from common.adaptivity import MeshAdaptivity
+from common.partitioning import LoadBalancer
+from common.multigrid import create_mesh_hierarchy
 
 __author__ = "Gaute Linga"
 
@@ -16,6 +27,9 @@ if cmd_kwargs.get("help", False):
     help_menu()
     exit()
 
+# Location of the compiled forms and expressions
+set_jit_cache_dir(cmd_kwargs.get("jit_cache_dir", None))
+
 # Import problem and default parameters
 default_problem = "simple"
 exec("from problems.{} import *".format(
@@ -40,6 +54,24 @@ if restart_folder:
     mesh = load_mesh(os.path.join(restart_folder, "fields.h5"),
                      use_partition_from_file=True)
 
+# Mesh hierarchy for geometric multigrid. The mesh of the problem is the
+# coarsest level, and is refined uniformly. When restarting, the finest
+# level is the mesh of the checkpoint, and the mesh of the problem is
+# made again with the parameters of the checkpoint.
+mesh_hierarchy = None
+if multigrid_levels > 1:
+    if restart_folder:
+        coarse_mesh = importlib.import_module("problems.{}".format(
+            cmd_kwargs.get("problem", default_problem))).mesh
+        if callable(coarse_mesh):
+            coarse_mesh = coarse_mesh(**parameters)
+        _, mesh_hierarchy = create_mesh_hierarchy(
+            coarse_mesh, multigrid_levels, constrained_domain(**vars()),
+            finest_mesh=mesh)
+    else:
+        mesh, mesh_hierarchy = create_mesh_hierarchy(
+            mesh, multigrid_levels, constrained_domain(**vars()))
+
 # Import solver functionality
 exec("from solvers.{} import *".format(solver))
 
@@ -55,187 +87,135 @@ for name, (family, degree, is_vector) in base_elements.items():
         elements[name] = df.FiniteElement(family, mesh.ufl_cell(), degree)
 
 # Declare function spaces
-spaces = dict()
-for name, subproblem in subproblems.items():
-    if len(subproblem) > 1:
-        spaces[name] = df.FunctionSpace(
-            mesh, df.MixedElement(
-                [elements[s["element"]] for s in subproblem]),
-            constrained_domain=constrained_domain(**vars()))
-    # If there is only one field in the subproblem, don't bother with
-    # the MixedElement.
-    elif len(subproblem) == 1:
-        spaces[name] = df.FunctionSpace(
-            mesh, elements[subproblem[0]["element"]],
-            constrained_domain=constrained_domain(**vars()))
-    else:
-        info_on_red("Something went wrong here!")
-        exit("")
-
-# dim = mesh.topology().dim()  # In case the velocity fields should be
-#                              # segregated at some point
-fields = []
-field_to_subspace = dict()
-field_to_subproblem = dict()
-for name, subproblem in subproblems.items():
-    if len(subproblem) > 1:
-        for i, s in enumerate(subproblem):
-            field = s["name"]
-            fields.append(field)
-            field_to_subspace[field] = spaces[name].sub(i)
-            field_to_subproblem[field] = (name, i)
-    else:
-        field = subproblem[0]["name"]
-        fields.append(field)
-        field_to_subspace[field] = spaces[name]
-        field_to_subproblem[field] = (name, -1)
-
+vars().update(create_spaces(mesh, elements, subproblems,
+                            constrained_domain(**vars())))
 
 # Create initial folders for storing results
 newfolder, tstepfiles = create_initial_folders(folder, restart_folder,
                                                fields, tstep, parameters)
 
-# Create overarching test and trial functions
-test_functions = dict()
-trial_functions = dict()
-for name, subproblem in subproblems.items():
-    if len(subproblem) > 1:
-        test_functions[name] = df.TestFunctions(spaces[name])
-        trial_functions[name] = df.TrialFunctions(spaces[name])
-    else:
-        test_functions[name] = df.TestFunction(spaces[name])
-        trial_functions[name] = df.TrialFunction(spaces[name])
-
-# Create work dictionaries for all subproblems
-w_ = dict((subproblem, df.Function(space, name=subproblem))
-           for subproblem, space in spaces.items())
-w_1 = dict((subproblem, df.Function(space, name=subproblem+"_1"))
-            for subproblem, space in spaces.items())
-w_tmp = dict((subproblem, df.Function(space, name=subproblem+"_tmp"))
-             for subproblem, space in spaces.items())
-
-# Shortcuts to the fields
-x_ = dict()
-for name, subproblem in subproblems.items():
-    if len(subproblem) > 1:
-        w_loc = df.split(w_[name])
-        for i, field in enumerate(subproblem):
-            x_[field["name"]] = w_loc[i]
-    else:
-        x_[subproblem[0]["name"]] = w_[name]
+# Create test and trial functions, and work dictionaries for all
+# subproblems. The solutions of the second previous timestep, w_2, are
+# kept for the BDF2 scheme.
+if time_scheme not in ["BE", "BDF2"]:
+    info_error("Unknown time scheme {}.".format(time_scheme))
+vars().update(create_functions(spaces, subproblems, time_scheme))
+bdf = None
+multirate = None
 
 # If continuing from previously, restart from checkpoint
-load_checkpoint(restart_folder, w_, w_1)
+w_2_loaded = load_checkpoint(restart_folder, w_, w_1, w_2)
 
 # Get boundary conditions, from fields to subproblems
-bcs_tuple = create_bcs(**vars())
-if len(bcs_tuple) == 3:
-    boundaries, bcs, bcs_pointwise = bcs_tuple
-elif len(bcs_tuple) == 2:
-    boundaries, bcs = bcs_tuple
-    bcs_pointwise = None
-else:
-    info_on_red("Wrong implementation of create_bcs.")
-    exit()
-
-# Set up subdomains
-subdomains = df.MeshFunction("size_t", mesh, mesh.topology().dim()-1)
-subdomains.set_all(0)
-boundary_to_mark = dict()
-mark_to_boundary = dict()
-for i, (boundary_name, markers) in enumerate(boundaries.items()):
-    for marker in markers:
-        marker.mark(subdomains, i+1)
-    boundary_to_mark[boundary_name] = i+1
-    mark_to_boundary[i] = boundary_name
+vars().update(create_boundary_conditions(
+    mesh, create_bcs(**vars()), subproblems, fields,
+    field_to_subspace, field_to_subproblem))
 
 # Subdomains check
 if dump_subdomains:
     subdomains_xdmf = df.XDMFFile("subdomains_dump.xdmf")
     subdomains_xdmf.write(subdomains)
 
-# Set up dirichlet part of bcs
-dirichlet_bcs = dict()
-for subproblem_name in subproblems.keys():
-    dirichlet_bcs[subproblem_name] = []
-
-# Neumann BCs (per field)
-neumann_bcs = dict()
-for field in fields:
-    neumann_bcs[field] = dict()
-
-for boundary_name, bcs_fields in bcs.items():
-    for field, bc in bcs_fields.items():
-        subproblem_name = field_to_subproblem[field][0]
-        subspace = field_to_subspace[field]
-        mark = boundary_to_mark[boundary_name]
-        if bc.is_dbc():
-            dirichlet_bcs[subproblem_name].append(
-                bc.dbc(subspace, subdomains, mark))
-        if bc.is_nbc():
-            neumann_bcs[field][boundary_name] = bc.nbc()
-
-# Pointwise dirichlet bcs
-for field, (value, c_code) in bcs_pointwise.items():
-    subproblem_name = field_to_subproblem[field][0]
-    subspace = field_to_subspace[field]
-    if not isinstance(value, df.Expression):
-        value = df.Constant(value)
-    dirichlet_bcs[subproblem_name].append(
-        df.DirichletBC(subspace, value, c_code, "pointwise"))
-
-# Compute some mesh related stuff
-dx = df.dx
-ds = df.Measure("ds", domain=mesh, subdomain_data=subdomains)
-normal = df.FacetNormal(mesh)
-
 # Initialize solutions
-w_init_fields = initialize(**vars())
-if w_init_fields:
-    for name, subproblem in subproblems.items():
-        w_init_vector = []
-        if len(subproblem) > 1:
-            for i, s in enumerate(subproblem):
-                field = s["name"]
-                # Only change initial state if it is given in w_init_fields.
-                if field in w_init_fields:
-                    w_init_field = w_init_fields[field]
-                else:
-                    # Otherwise take the default value of that field.
-                    w_init_field = w_[name].sub(i)
-                # Use df.project(df.as_vector(...)) with care...
-                num_subspaces = w_init_field.function_space().num_sub_spaces()
-                if num_subspaces == 0:
-                    w_init_vector.append(w_init_field)
-                else:
-                    for j in range(num_subspaces):
-                        w_init_vector.append(w_init_field.sub(j))
-            # assert len(w_init_vector) == w_[name].value_size()  
-            w_init = df.project(
-                df.as_vector(tuple(w_init_vector)), w_[name].function_space(),
-                solver_type="gmres", preconditioner_type="default")
-        else:
-            field = subproblem[0]["name"]
-            if field in w_init_fields:
-                w_init_field = w_init_fields[field]
-            else:
-                # Take default value...
-                w_init_field = w_[name]
-            w_init = df.project(w_init_field, w_[name].function_space(),
-                                solver_type="gmres",
-                                preconditioner_type="default")
-        w_[name].interpolate(w_init)
-        w_1[name].interpolate(w_init)
+initialize_functions(initialize(**vars()), w_, w_1, subproblems)
+
+# Adaptive mesh refinement. The initial mesh is adapted to the initial
+# state, which is reinitialized on each refined mesh.
+adaptivity = None
+if adaptive_mesh:
+    adaptivity = MeshAdaptivity(mesh, solutes, adaptive_mesh_settings)
+    if restart_folder:
+        adaptivity.load_base_mesh(os.path.join(restart_folder, "fields.h5"))
+    else:
+        for _ in range(adaptivity.settings["max_level"]):
+            mesh = adaptivity.adapt(mesh, x_)
+            vars().update(create_spaces(mesh, elements, subproblems,
+                                        constrained_domain(**vars())))
+            vars().update(create_functions(spaces, subproblems,
+                                           time_scheme))
+            vars().update(create_boundary_conditions(
+                mesh, create_bcs(**vars()), subproblems, fields,
+                field_to_subspace, field_to_subproblem))
+            initialize_functions(initialize(**vars()), w_, w_1, subproblems)
+    for field in fields:
+        tstepfiles[field].parameters["rewrite_function_mesh"] = True
+
+# Repartition the mesh when the cells are unevenly distributed between
+# the processes
+load_balancer = None
+if repartition:
+    load_balancer = LoadBalancer(newfolder, repartition_settings)
+    if load_balancer.is_due(tstep, True) and \
+            load_balancer.is_imbalanced(mesh):
+        mesh = load_balancer.repartition(mesh, [w_, w_1, w_2])
+        vars().update(create_spaces(mesh, elements, subproblems,
+                                    constrained_domain(**vars())))
+        vars().update(create_functions(spaces, subproblems, time_scheme))
+        load_balancer.load_functions([w_, w_1, w_2])
+        vars().update(create_boundary_conditions(
+            mesh, create_bcs(**vars()), subproblems, fields,
+            field_to_subspace, field_to_subproblem))
+        for field in fields:
+            tstepfiles[field].parameters["rewrite_function_mesh"] = True
+
+# Start Krylov iterations from the solution extrapolated from
+# previous timesteps
+history = None
+if initial_guess is not None:
+    df.parameters["krylov_solver"]["nonzero_initial_guess"] = True
+    history = SolutionHistory(
+        w_1, dict(previous=0, linear=1, quadratic=2)[initial_guess])
 
 # Get rhs source terms (if any)
 q_rhs = rhs_source(t=t_0, **vars())
 
+# Quadrature degree of forms without a degree given per subproblem
+if get_quadrature_degree(quadrature_degree, "default") is not None:
+    df.parameters["form_compiler"]["quadrature_degree"] = \
+        get_quadrature_degree(quadrature_degree, "default")
+
 # Setup problem
 vars().update(setup(**vars()))
 
+if w_2 is not None and bdf is None:
+    info_error("Solver {} does not support the BDF2 scheme.".format(solver))
+
 # Problem-specific hook before time loop
 vars().update(start_hook(**vars()))
 
+# Compile the forms of all solvers and stop before the time loop. The
+# hook is run first, such that the forms it solves (e.g. the
+# equilibration of the single_* problems) are compiled as well.
+if precompile:
+    info_cyan("Compiled {0:d} forms for problem {1}, solver {2}.".format(
+        precompile_solvers(solvers),
+        cmd_kwargs.get("problem", default_problem), solver))
+    exit()
+
+# Adaptive timestepping
+timestep_controller = None
+if adaptive_dt:
+    if not set_timestep(**vars()):
+        info_error("Solver {} does not support adaptive timestepping.".format(
+            solver))
+    timestep_controller = TimestepController(mesh, x_.get("u"), dt,
+                                             adaptive_dt_settings)
+
+# Pseudo-transient continuation to a steady state. The energy is
+# monitored if the solver defines it.
+steady_state_controller = None
+energy_form = None
+if steady_state:
+    if not set_timestep(**vars()) or timestep_controller is not None:
+        info_error("Solver {} does not support steady state mode, or "
+                   "adaptive_dt is set.".format(solver))
+    steady_state_controller = SteadyStateController(dt,
+                                                    steady_state_settings)
+    discrete_energy = getattr(importlib.import_module(
+        "solvers." + solver), "discrete_energy", None)
+    if discrete_energy is not None:
+        energy_form = sum(discrete_energy(**vars()))*dx
+
 stop = False
 t = t_0
 
@@ -254,17 +234,119 @@ while not stop:
 
     tstep_hook(**vars())
 
-    solve(**vars())
+    if history is not None:
+        history.extrapolate(w_, dt)
+
+    if timestep_controller is None:
+        solve(**vars())
+    else:
+        accepted = False
+        while not accepted:
+            try:
+                solve(**vars())
+                converged = True
+            except RuntimeError:
+                converged = False
+            accepted, dt_new = timestep_controller.evaluate(
+                w_, w_1, converged)
+            if not accepted:
+                # Redo the step from the previous solution
+                for subproblem in w_:
+                    w_[subproblem].assign(w_1[subproblem])
+                dt = dt_new
+                set_timestep(**vars())
+                if history is not None:
+                    history.extrapolate(w_, dt)
+
+    if history is not None:
+        history.push(dt)
+
+    if steady_state_controller is not None:
+        dt_new = steady_state_controller.evaluate(
+            w_, w_1, tstep+1, t+dt,
+            df.assemble(energy_form) if energy_form is not None else None)
 
     update(**vars())
 
     t += dt
     tstep += 1
 
+    if timestep_controller is not None or \
+            steady_state_controller is not None:
+        dt = dt_new
+        parameters["dt"] = dt
+        set_timestep(**vars())
+
+    # Adapt and/or repartition the mesh, move the solutions to it, and
+    # rebuild the boundary conditions and solvers
+    remeshed = False
+    if adaptivity is not None and adaptivity.is_due(tstep):
+        w_old, w_1_old, w_2_old = w_, w_1, w_2
+        mesh = adaptivity.adapt(mesh, x_)
+        vars().update(create_spaces(mesh, elements, subproblems,
+                                    constrained_domain(**vars())))
+        vars().update(create_functions(spaces, subproblems, time_scheme))
+        transfer_functions(w_old, w_)
+        transfer_functions(w_1_old, w_1)
+        if w_2 is not None:
+            transfer_functions(w_2_old, w_2)
+        del w_old, w_1_old, w_2_old
+        remeshed = True
+
+    if load_balancer is not None and \
+            load_balancer.is_due(tstep, remeshed) and \
+            load_balancer.is_imbalanced(mesh):
+        mesh = load_balancer.repartition(mesh, [w_, w_1, w_2])
+        vars().update(create_spaces(mesh, elements, subproblems,
+                                    constrained_domain(**vars())))
+        vars().update(create_functions(spaces, subproblems, time_scheme))
+        load_balancer.load_functions([w_, w_1, w_2])
+        remeshed = True
+
+    if remeshed:
+        for field in fields:
+            tstepfiles[field].parameters["rewrite_function_mesh"] = True
+        vars().update(create_boundary_conditions(
+            mesh, create_bcs(**vars()), subproblems, fields,
+            field_to_subspace, field_to_subproblem))
+        bdf_old = bdf
+        w_2_loaded = bdf is not None and bdf.is_second_order()
+        q_rhs = rhs_source(t=t, **vars())
+        vars().update(setup(**vars()))
+        if w_2_loaded:
+            # Keep the BDF2 coefficients of a variable timestep
+            bdf.dt_prev = bdf_old.dt_prev
+            bdf.set_timestep(dt)
+        del bdf_old
+        if history is not None:
+            history = SolutionHistory(w_1, history.order)
+        if timestep_controller is not None:
+            timestep_controller.set_mesh(mesh, x_.get("u"))
+        if energy_form is not None:
+            energy_form = sum(discrete_energy(**vars()))*dx
+
     stop = save_solution(**vars())
 
     if tstep % info_intv == 0 or stop:
         info_green("Time = {0:f}, timestep = {1:d}".format(t, tstep))
+        if timestep_controller is not None:
+            info_cyan("dt = {0:e}, Courant number = {1:f}, "
+                      "error estimate = {2:e}, rejected steps = {3:d}".format(
+                          dt, timestep_controller.courant,
+                          timestep_controller.error,
+                          timestep_controller.num_rejected))
+        if steady_state_controller is not None:
+            info_cyan("Pseudo-timestep = {0:e}, residual = {1:e} "
+                      "(reduction {2:e})".format(
+                          dt, steady_state_controller.residual,
+                          steady_state_controller.residual /
+                          steady_state_controller.residual_0))
+        if multirate is not None:
+            multirate.report()
+        if history is not None:
+            info_cyan("Estimated Krylov iterations saved by "
+                      "extrapolated initial guesses: {0:.0f}".format(
+                          num_iterations_saved(solvers)))
         split_computing_time = timer.stop()
         split_num_tsteps = tstep-tstep_0
         timer.start()
@@ -285,4 +367,14 @@ if total_num_tsteps > 0:
                   total_num_tsteps, total_computing_time,
                   total_computing_time/total_num_tsteps))
 
+if steady_state_controller is not None:
+    steady_state_controller.save(os.path.join(newfolder, "Statistics",
+                                              "steady_state.dat"))
+    if steady_state_controller.converged:
+        info_cyan("Steady state reached after {0:d} steps.".format(
+            len(steady_state_controller.history)))
+    else:
+        info_red("Steady state not reached in {0:d} steps.".format(
+            len(steady_state_controller.history)))
+
 end_hook(**vars())
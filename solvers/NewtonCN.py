@@ -9,6 +9,8 @@ AB, 2017-06-1(based on basic.py)
 import dolfin as df
 import math
 from common.functions import ramp, dramp, diff_pf_potential
+from common.newton import NewtonSolver
+from common.forms import get_quadrature_degree
 from . import *
 from . import __all__
 
@@ -40,12 +42,16 @@ def get_subproblems(base_elements, solutes,
     return subproblems
 
 
-def setup(test_functions, trial_functions, w_, w_1, bcs, permittivity,
+def setup(test_functions, trial_functions, w_, w_1, dirichlet_bcs,
+          permittivity,
           density, viscosity,
           solutes, enable_PF, enable_EC, enable_NS,
           surface_tension, dt, interface_thickness,
           grav_const, pf_mobility_coeff, pf_mobility,
           use_iterative_solvers,
+          newton_solver,
+          petsc_options,
+          quadrature_degree,
           **namespace):
     """ Set up problem. """
     # Constant
@@ -67,6 +73,8 @@ def setup(test_functions, trial_functions, w_, w_1, bcs, permittivity,
         p_ = funs_[field_number]
         p_1 = funs_1[field_number]
         field_number += 1
+    else:
+        v = u_ = u_1 = q = p_ = p_1 = None
     if enable_PF:
         psi = test_functions["NSPFEC"][field_number]
         phi_ = funs_[field_number]
@@ -76,6 +84,8 @@ def setup(test_functions, trial_functions, w_, w_1, bcs, permittivity,
         g_ = funs_[field_number]
         g_1 = funs_1[field_number]
         field_number += 1
+    else:
+        psi = phi_ = phi_1 = h = g_ = g_1 = 1
     if enable_EC:
         num_solutes = len(test_functions["NSPFEC"])-field_number-1
         b = test_functions["NSPFEC"][field_number:(num_solutes+field_number)]
@@ -84,6 +94,8 @@ def setup(test_functions, trial_functions, w_, w_1, bcs, permittivity,
         U = test_functions["NSPFEC"][num_solutes+field_number]
         V_ = funs_[num_solutes+field_number]
         V_1 = funs_1[num_solutes+field_number]
+    else:
+        b = c_ = c_1 = U = V_ = V_1 = rho_e_ = rho_e_1 = 0
 
     M_ = pf_mobility(phi_, gamma)
     M_1 = pf_mobility(phi_1, gamma)
@@ -116,7 +128,8 @@ def setup(test_functions, trial_functions, w_, w_1, bcs, permittivity,
         rho_e_1 = sum([c_e*z_e for c_e, z_e in zip(c_1, z)])  # prev sol.
 
     solver = dict()
-    solver["NSPFEC"] = setup_NSPFEC(w_["NSPFEC"], w_1["NSPFEC"], bcs["NSPFEC"],
+    solver["NSPFEC"] = setup_NSPFEC(w_["NSPFEC"], w_1["NSPFEC"],
+                                    dirichlet_bcs["NSPFEC"],
                                     trial_functions["NSPFEC"],
                                     v, q, psi, h, b, U,
                                     u_, p_, phi_, g_, c_, V_,
@@ -126,7 +139,11 @@ def setup(test_functions, trial_functions, w_, w_1, bcs, permittivity,
                                     dbeta, dveps, drho,
                                     per_tau, sigma_bar, eps, grav, z,
                                     enable_NS, enable_PF, enable_EC,
-                                    use_iterative_solvers)
+                                    use_iterative_solvers,
+                                    newton_solver,
+                                    petsc_options.get("NSPFEC"),
+                                    get_quadrature_degree(
+                                        quadrature_degree, "NSPFEC"))
     return dict(solvers=solver)
 
 
@@ -139,7 +156,10 @@ def setup_NSPFEC(w_NSPFEC, w_1NSPFEC, bcs_NSPFEC, trial_func_NSPFEC,
                  dbeta, dveps, drho,
                  per_tau, sigma_bar, eps, grav, z,
                  enable_NS, enable_PF, enable_EC,
-                 use_iterative_solvers):
+                 use_iterative_solvers,
+                 newton_solver=None,
+                 petsc_options=None,
+                 quadrature_degree=None):
     """ The full problem of electrohydrodynamics in two pahase.
     Note that it is possioble to trun off the dirffent parts at will.
     """
@@ -161,11 +181,14 @@ def setup_NSPFEC(w_NSPFEC, w_1NSPFEC, bcs_NSPFEC, trial_func_NSPFEC,
     F = 0.5*(F_imp + F_exp)
     J = df.derivative(F, w_NSPFEC)
 
-    problem_NSPFEC = df.NonlinearVariationalProblem(F, w_NSPFEC, bcs_NSPFEC, J)
-    solver_NSPFEC = df.NonlinearVariationalSolver(problem_NSPFEC)
+    solver_NSPFEC = NewtonSolver(F, w_NSPFEC, bcs_NSPFEC, J,
+                                 name="NSPFEC", petsc_options=petsc_options,
+                                 quadrature_degree=quadrature_degree)
     if use_iterative_solvers:
         solver_NSPFEC.parameters['newton_solver']['linear_solver'] = 'gmres'
         solver_NSPFEC.parameters['newton_solver']['preconditioner'] = 'ilu'
+    if newton_solver is not None:
+        solver_NSPFEC.parameters['newton_solver'].update(newton_solver)
 
     return solver_NSPFEC
 
@@ -245,21 +268,5 @@ def NSPFEC_action(u_, u_1, phi_, phi_1, c_, c_1,
         F_E = sum(F_E_c) + F_E_V
         F.append(F_E)
 
-    F = sum(F)
-    J = df.derivative(F, w_NSPFEC)
-
-    problem_NSPFEC = df.NonlinearVariationalProblem(F, w_NSPFEC, bcs_NSPFEC, J)
-    solver_NSPFEC = df.NonlinearVariationalSolver(problem_NSPFEC)
-    if use_iterative_solvers:
-        solver_NSPFEC.parameters['newton_solver']['linear_solver'] = 'gmres'
-        solver_NSPFEC.parameters['newton_solver']['preconditioner'] = 'ilu'
-
-    return solver_NSPFEC
+    return sum(F)
 
-def solve(solvers, **namespace):
-    """ Solve equations. """
-    solvers["NSPFEC"].solve()
-
-def update(w_, w_1, enable_PF, enable_EC, enable_NS, **namespace):
-    """ Update work variables at end of timestep. """
-    w_1["NSPFEC"].assign(w_["NSPFEC"])
@@ -15,6 +15,11 @@ The problem is split between the following subproblems.
 
 * NSp: Pressure.
 
+The pressure step uses the minimal density, such that the operators of
+the pressure and velocity correction steps are constant. They are
+assembled and factorized (or preconditioned) once, and only rebuilt when
+the timestep changes.
+
 GL, 2017-05-29
 
 """
@@ -25,6 +30,9 @@ from common.functions import ramp, dramp, diff_pf_potential, \
     ramp_harmonic, ramp_geometric
 from common.cmd import info_red
 from common.io import mpi_barrier
+from common.linalg import create_linear_solver, SubproblemSolver
+from common.forms import get_quadrature_degree, uses_mass_lumping, \
+    mass_measure
 from .basic import unit_interval_filter  # GL: Move this to common.functions?
 from . import *
 from . import __all__
@@ -163,6 +171,12 @@ def setup(tstep, test_functions, trial_functions, w_, w_1,
           grav_const, grav_dir, pf_mobility, pf_mobility_coeff,
           use_iterative_solvers,
           solve_initial,
+          preconditioners,
+          petsc_options,
+          quadrature_degree,
+          mass_lumping,
+          base_elements,
+          mesh_hierarchy,
           **namespace):
     """ Set up problem. """
 
@@ -195,13 +209,26 @@ def setup(tstep, test_functions, trial_functions, w_, w_1,
     #x = df.Expression(tuple(["x[0]", "x[1]", "x[2]"][:len(grav_dir)]),
     #                  degree=1)
 
+    # Options for the linear solvers, per subproblem
+    solver_options = dict(
+        (name, dict(name=name,
+                    preconditioner=preconditioners.get(name),
+                    mesh_hierarchy=mesh_hierarchy,
+                    petsc_options=petsc_options.get(name),
+                    quadrature_degree=get_quadrature_degree(
+                        quadrature_degree, name)))
+        for name in ["PF", "EC", "NSu", "NSu_correct", "NSp"])
+
     solvers = dict()
     if enable_PF:
         w_PF = w_["PF"]
         dirichlet_bcs_PF = dirichlet_bcs["PF"]
         #phi = phi_
         #g = g_
-        solvers["PF"] = setup_PF(**vars())
+        solvers["PF"] = setup_PF(
+            dx_mass=mass_measure(dx, uses_mass_lumping(mass_lumping, "PF"),
+                                 base_elements["phi"][1]),
+            **vars())
 
     if enable_EC:
         solvers["EC"] = setup_EC(w_["EC"], c, V, b, U, rho_e,
@@ -210,9 +237,14 @@ def setup(tstep, test_functions, trial_functions, w_, w_1,
                                  neumann_bcs, boundary_to_mark,
                                  c_1,
                                  u_1, K_, veps_, phi_flt_, rho_1,
-                                 dt, z, dbeta,
+                                 per_tau, z, dbeta,
                                  enable_NS, enable_PF,
-                                 use_iterative_solvers)
+                                 use_iterative_solvers,
+                                 solver_options["EC"],
+                                 mass_measure(
+                                     dx, uses_mass_lumping(mass_lumping,
+                                                           "EC"),
+                                     base_elements["c"][1]))
 
     if enable_NS:
         w_NSu = w_["NSu"]
@@ -222,25 +254,30 @@ def setup(tstep, test_functions, trial_functions, w_, w_1,
         solvers["NSu"] = setup_NSu(**vars())
         solvers["NSp"] = setup_NSp(**vars())
 
-    return dict(solvers=solvers)
+    return dict(solvers=solvers, per_tau=per_tau)
 
 
 def setup_PF(w_PF, phi, g, psi, h,
              dx, ds,
              dirichlet_bcs_PF, neumann_bcs, boundary_to_mark,
              phi_1, u_1, M_, M_1, c_1, V_1, rho_1,
-             dt, sigma_bar, eps,
+             per_tau, sigma_bar, eps,
              drho, dbeta, dveps, grav,
              enable_NS, enable_EC,
              use_iterative_solvers,
+             solver_options,
+             dx_mass=None,
              **namespace):
-    """ Set up phase field subproblem. """
+    """ Set up phase field subproblem. The time derivative is integrated
+    with dx_mass, e.g. for mass lumping. """
+    if dx_mass is None:
+        dx_mass = dx
     # Projected velocity (for energy stability)
     if enable_NS:
         u_proj = u_1  # - dt*phi_1*df.grad(g)/rho_1
         phi_adv = phi  # phi_1
 
-    F_phi = (1./dt*(phi - phi_1)*psi*dx
+    F_phi = (per_tau*(phi - phi_1)*psi*dx_mass
              + M_1*df.dot(df.grad(g), df.grad(psi))*dx)
     if enable_NS:
         F_phi += - phi_adv * df.dot(u_proj, df.grad(psi))*dx
@@ -260,8 +297,8 @@ def setup_PF(w_PF, phi, g, psi, h,
     F = F_phi + F_g
     a, L = df.lhs(F), df.rhs(F)
 
-    problem = df.LinearVariationalProblem(a, L, w_PF, dirichlet_bcs_PF)
-    solver = df.LinearVariationalSolver(problem)
+    solver = create_linear_solver(a, L, w_PF, dirichlet_bcs_PF,
+                                  solver_options["PF"])
 
     if use_iterative_solvers:
         solver.parameters["linear_solver"] = "gmres"  # "bicgstab"  # "gmres"
@@ -322,18 +359,23 @@ def setup_EC(w_EC, c, V, b, U, rho_e,
              dx, ds,
              dirichlet_bcs_EC, neumann_bcs, boundary_to_mark,
              c_1, u_1, K_, veps_, phi_, rho_1,
-             dt, z, dbeta,
+             per_tau, z, dbeta,
              enable_NS, enable_PF,
              use_iterative_solvers,
+             solver_options=None,
+             dx_mass=None,
              **namespace):
-    """ Set up electrochemistry subproblem. """
+    """ Set up electrochemistry subproblem. The time derivative is
+    integrated with dx_mass, e.g. for mass lumping. """
+    if dx_mass is None:
+        dx_mass = dx
 
     F_c = []
     for ci, ci_1, bi, Ki_, zi, dbetai in zip(c, c_1, b, K_, z, dbeta):
         u_proj_i = u_1  # - dt/rho_1*df.grad(ci)
         ci_adv = ci  # ci_1
 
-        F_ci = (1./dt*(ci-ci_1)*bi*dx +
+        F_ci = (per_tau*(ci-ci_1)*bi*dx_mass +
                 Ki_*df.dot(df.nabla_grad(ci),
                            df.nabla_grad(bi))*dx)
         if zi != 0:
@@ -357,8 +399,8 @@ def setup_EC(w_EC, c, V, b, U, rho_e,
     F = sum(F_c) + F_V
     a, L = df.lhs(F), df.rhs(F)
 
-    problem = df.LinearVariationalProblem(a, L, w_EC, dirichlet_bcs_EC)
-    solver = df.LinearVariationalSolver(problem)
+    solver = create_linear_solver(a, L, w_EC, dirichlet_bcs_EC,
+                                  solver_options)
 
     if use_iterative_solvers:
         solver.parameters["linear_solver"] = "gmres"
@@ -372,23 +414,24 @@ def setup_NSu(w_NSu, u, v,
               dirichlet_bcs_NSu, neumann_bcs, boundary_to_mark,
               u_, u_1, p_, p_1, phi_, phi_1, rho_, rho_1, g_, g_1, c_, c_1,
               M_, M_1, mu_, mu_1, rho_e_, rho_e_1, V_,
-              dt, drho, sigma_bar, eps, dveps, grav, dbeta, z,
+              per_tau, rho_min, drho, sigma_bar, eps, dveps, grav, dbeta, z,
               enable_PF, enable_EC,
               use_iterative_solvers,
+              solver_options,
               **namespace):
     """ Set up the Navier-Stokes velocity subproblem. """
     mom_1 = rho_1*u_1
     if enable_PF:
         mom_1 += -drho * M_1 * df.grad(g_1)
 
-    F_predict = (1./dt * rho_1 * df.dot(u - u_1, v) * dx
+    F_predict = (per_tau * rho_1 * df.dot(u - u_1, v) * dx
                  + df.inner(df.nabla_grad(u), df.outer(mom_1, v)) * dx
                  + 2*mu_*df.inner(df.sym(df.nabla_grad(u)),
                                   df.sym(df.nabla_grad(v))) * dx
                  - p_1 * df.div(v) * dx
                  - rho_*df.dot(grav, v) * dx
                  + 0.5 * (
-                     1./dt * (rho_ - rho_1)
+                     per_tau * (rho_ - rho_1)
                      - df.inner(mom_1, df.grad(df.dot(u, v)))) * dx)
     if enable_PF:
         F_predict += phi_1 * df.dot(df.grad(g_), v) * dx
@@ -418,22 +461,24 @@ def setup_NSu(w_NSu, u, v,
 
     a_predict, L_predict = df.lhs(F_predict), df.rhs(F_predict)
 
-    problem_predict = df.LinearVariationalProblem(
-        a_predict, L_predict, w_NSu, dirichlet_bcs_NSu)
-    solvers["predict"] = df.LinearVariationalSolver(problem_predict)
+    solvers["predict"] = create_linear_solver(
+        a_predict, L_predict, w_NSu, dirichlet_bcs_NSu,
+        solver_options["NSu"])
 
     if use_iterative_solvers:
         solvers["predict"].parameters["linear_solver"] = "bicgstab"
         solvers["predict"].parameters["preconditioner"] = "jacobi"  # "amg"
 
+    # Consistent with the pressure step, the correction uses the minimal
+    # density, which makes the operator a constant mass matrix.
     F_correct = (
-        rho_ * df.inner(u - u_, v) * dx
-        - dt * (p_ - p_1) * df.div(v) * dx
+        rho_min * df.inner(u - u_, v) * dx
+        - 1./per_tau * (p_ - p_1) * df.div(v) * dx
     )
     a_correct, L_correct = df.lhs(F_correct), df.rhs(F_correct)
-    problem_correct = df.LinearVariationalProblem(
-        a_correct, L_correct, w_NSu, dirichlet_bcs_NSu)
-    solvers["correct"] = df.LinearVariationalSolver(problem_correct)
+    solvers["correct"] = create_constant_solver(
+        a_correct, L_correct, w_NSu, dirichlet_bcs_NSu,
+        solver_options["NSu_correct"])
 
     if use_iterative_solvers:
         solvers["correct"].parameters["linear_solver"] = "cg"  # "bicgstab"
@@ -445,26 +490,42 @@ def setup_NSu(w_NSu, u, v,
 def setup_NSp(w_NSp, p, q,
               dx, ds,
               dirichlet_bcs_NSp, neumann_bcs, boundary_to_mark,
-              u_, u_1, p_, p_1, rho_, dt, rho_min,
+              u_, u_1, p_, p_1, rho_, per_tau, rho_min,
               use_iterative_solvers,
+              solver_options,
               **namespace):
+    """ Set up the pressure subproblem. The operator is the (constant)
+    Laplacian. """
     F = (
         df.dot(df.nabla_grad(p - p_1), df.nabla_grad(q)) * df.dx
-        + 1./dt * rho_min * df.div(u_) * q * df.dx
+        + per_tau * rho_min * df.div(u_) * q * df.dx
     )
 
     a, L = df.lhs(F), df.rhs(F)
-    problem = df.LinearVariationalProblem(a, L, w_NSp, dirichlet_bcs_NSp)
-    solver = df.LinearVariationalSolver(problem)
+    solver = create_constant_solver(a, L, w_NSp, dirichlet_bcs_NSp,
+                                    solver_options["NSp"])
 
     if use_iterative_solvers:
-        solver.parameters["linear_solver"] = "gmres"
+        solver.parameters["linear_solver"] = "cg"
         solver.parameters["preconditioner"] = "hypre_amg"  # "amg"
         # solver.parameters["preconditioner"] = "hypre_euclid"
 
     return solver
 
 
+def create_constant_solver(a, L, w, bcs, options):
+    """ Returns a solver for a == L which assembles the operator, and
+    sets up the factorization or preconditioner, only once (or when
+    invalidated). """
+    return SubproblemSolver(a, L, w, bcs,
+                            preconditioner=options.get("preconditioner"),
+                            mesh_hierarchy=options.get("mesh_hierarchy"),
+                            name=options.get("name", ""),
+                            petsc_options=options.get("petsc_options"),
+                            quadrature_degree=options.get(
+                                "quadrature_degree"))
+
+
 def solve(tstep, w_, w_1, w_tmp, solvers,
           enable_PF, enable_EC, enable_NS,
           **namespace):
@@ -520,6 +581,17 @@ def update(t, dt, w_, w_1, enable_PF, enable_EC, enable_NS,
             w_1[subproblem].assign(w_[subproblem])
 
 
+def set_timestep(dt, per_tau, solvers, **namespace):
+    """ Update the timestep in the equations. """
+    per_tau.assign(1./dt)
+    for solver in solvers.values():
+        for subsolver in (solver.values() if isinstance(solver, dict)
+                          else [solver]):
+            if hasattr(subsolver, "invalidate"):
+                subsolver.invalidate()
+    return True
+
+
 def epsilon(u):
     return df.sym(df.nabla_grad(u))
 
@@ -1,7 +1,7 @@
 __author__ = "Gaute Linga"
 
 
-__all__ = ["get_subproblems", "setup", "solve", "update"]
+__all__ = ["get_subproblems", "setup", "solve", "update", "set_timestep"]
 
 
 def get_subproblems(**namespace):
@@ -23,3 +23,9 @@ def solve(**namespace):
 def update(**namespace):
     """ Update work arrays at the end of timestep. """
     pass
+
+
+def set_timestep(**namespace):
+    """ Update the timestep dt in the equations. Returns False if the
+    solver does not support changing the timestep. """
+    return False
@@ -13,7 +13,9 @@ linearisation. The problem is split between the following subproblems.
 
 * NS: The Navier-Stokes equations are solved simultaneously for the
   velocity and pressure fields, where the intertial term is linearised
-  to make the whole subproblem linear.
+  to make the whole subproblem linear. With use_pressure_stabilization,
+  a pressure stabilization term allows equal order (e.g. P1-P1)
+  velocity and pressure elements.
 
 GL, 2017-05-29
 
@@ -23,6 +25,15 @@ import math
 from common.functions import ramp, dramp, diff_pf_potential_linearised, \
     unit_interval_filter, diff_pf_contact_linearised, pf_potential, alpha
 from common.io import mpi_barrier, info_red
+from common.cmd import info_blue, info_warning, info_error
+from common.fixed_point import AndersonAcceleration, get_stacked, \
+    set_stacked, global_norm
+from common.linalg import create_linear_solver
+from common.timestepping import BDFScheme, MultirateScheduler
+from common.coefficient_fields import CoefficientFields
+from common.forms import get_quadrature_degree, uses_mass_lumping, \
+    mass_measure
+from common.preconditioners import uses_pressure_mass
 import numpy as np
 from . import *
 from . import __all__
@@ -69,6 +80,23 @@ def setup(mesh, test_functions, trial_functions,
           comoving_velocity,
           p_lagrange,
           q_rhs,
+          split_assembly,
+          preconditioner_reuse,
+          preconditioners,
+          freeze_NSPF,
+          coupling_max_iter,
+          coupling_anderson_depth,
+          initial_guess,
+          petsc_options,
+          coefficient_fields,
+          quadrature_degree,
+          mass_lumping,
+          base_elements,
+          time_scheme,
+          w_2, w_2_loaded,
+          substeps,
+          mesh_hierarchy,
+          dt_prev=None,
           **namespace):
     """ Set up problem. """
     # Constant
@@ -138,6 +166,39 @@ def setup(mesh, test_functions, trial_functions,
     else:
         c_ = V_ = c_1 = V_1 = None
 
+    # With the BDF2 scheme, the lagged fields are extrapolated to the new
+    # time level, and the parts of the time derivatives given by the
+    # previous timesteps are kept in hist.
+    bdf = None
+    hist = dict()
+    if time_scheme == "BDF2":
+        # The previous timestep is stored in the checkpoint, and differs
+        # from dt with adaptive timestepping
+        if w_2_loaded:
+            bdf = BDFScheme(dt, dt_prev if dt_prev is not None else dt)
+        else:
+            bdf = BDFScheme(dt)
+        for subproblem in ["NS", "S"]:
+            if subproblem in w_2:
+                u_2 = df.split(w_2[subproblem])[0]
+                hist["u"] = bdf.history(u_1, u_2)
+                u_1 = bdf.extrapolate(u_1, u_2)
+        phi_2 = df.split(w_2["PF"])[0] if enable_PF else 1.
+        hist["phi"] = bdf.history(unit_interval_filter(phi_1),
+                                  unit_interval_filter(phi_2))
+        hist["rho"] = bdf.history(ramp(unit_interval_filter(phi_1), density),
+                                  ramp(unit_interval_filter(phi_2), density))
+        if enable_PF:
+            phi_1 = bdf.extrapolate(phi_1, phi_2)
+        if enable_EC:
+            cV_2 = df.split(w_2["EC"])
+            c_2, V_2 = cV_2[:num_solutes], cV_2[num_solutes]
+            hist["c"] = [bdf.history(ci_1, ci_2)
+                         for ci_1, ci_2 in zip(c_1, c_2)]
+            c_1 = [bdf.extrapolate(ci_1, ci_2)
+                   for ci_1, ci_2 in zip(c_1, c_2)]
+            V_1 = bdf.extrapolate(V_1, V_2)
+
     phi_flt_ = unit_interval_filter(phi_)
     phi_flt_1 = unit_interval_filter(phi_1)
 
@@ -162,34 +223,131 @@ def setup(mesh, test_functions, trial_functions,
         beta_.append(ramp(phi_, [solute[4], solute[5]]))
         dbeta.append(dramp([solute[4], solute[5]]))
 
+    # The coefficients depending on the phase field can be precomputed
+    # as functions, which are updated in solve. The extrapolated
+    # coefficients of the BDF2 scheme are kept as expressions, as is
+    # beta_, which does not enter the forms (only its constant
+    # derivative dbeta does).
+    material_fields = None
+    if enable_PF and coefficient_fields:
+        material_fields = CoefficientFields(
+            mesh, coefficient_fields if isinstance(coefficient_fields, str)
+            else "P1")
+        phi_src_ = w_["PF"].sub(0)
+        phi_src_1 = w_1["PF"].sub(0)
+        M_ = material_fields.add(
+            phi_src_, lambda phi: pf_mobility(phi, gamma), filtered=True)
+        if bdf is None:
+            M_1 = material_fields.add(
+                phi_src_1, lambda phi: pf_mobility(phi, gamma),
+                filtered=True)
+        mu_ = material_fields.add(
+            phi_src_, lambda phi: ramp(phi, viscosity), filtered=True)
+        rho_ = material_fields.add(
+            phi_src_, lambda phi: ramp(phi, density), filtered=True)
+        if bdf is None:
+            rho_1 = material_fields.add(
+                phi_src_1, lambda phi: ramp(phi, density), filtered=True)
+        veps_ = material_fields.add(
+            phi_src_, lambda phi: ramp(phi, permittivity), filtered=True)
+        K_ = [material_fields.add(
+            phi_src_, lambda phi, A=solute[2:4]: ramp(phi, A))
+              for solute in solutes]
+
     if enable_EC:
         rho_e = sum([c_e*z_e for c_e, z_e in zip(c, z)])  # Sum of trial func.
         rho_e_ = sum([c_e*z_e for c_e, z_e in zip(c_, z)])  # Sum of curr. sol.
     else:
         rho_e_ = None
 
+    # The coupling fields are lagged by default. With outer coupling
+    # iterations, the latest iterates are used instead.
+    if coupling_max_iter > 1:
+        u_cpl, c_cpl, V_cpl = u_, c_, V_
+    else:
+        u_cpl, c_cpl, V_cpl = u_1, c_1, V_1
+    anderson = None
+    if coupling_max_iter > 1 and coupling_anderson_depth > 0:
+        anderson = AndersonAcceleration(coupling_anderson_depth)
+
+    # Subproblems can be advanced with several substeps per timestep
+    multirate = None
+    if substeps:
+        if bdf is not None or coupling_max_iter > 1:
+            info_error("Substeps can not be combined with the BDF2 scheme "
+                       "or coupling iterations.")
+        multirate = MultirateScheduler(w_, w_1, substeps, dt)
+    tau = dict((subproblem, multirate.per_tau.get(subproblem, per_tau)
+                if multirate is not None else per_tau)
+               for subproblem in ["PF", "EC", "NS", "S"])
+
+    # Fields that are not advanced in time can be treated as constants
+    # when assembling the remaining subproblems.
+    frozen = []
+    if freeze_NSPF:
+        for subproblem in ["NS", "PF"]:
+            if subproblem in w_:
+                frozen.extend([w_[subproblem], w_1[subproblem]])
+                if bdf is not None:
+                    frozen.append(w_2[subproblem])
+
+    # The stabilized velocity-pressure systems are preconditioned by a
+    # Schur complement field split, unless another preconditioner is
+    # given.
+    if use_iterative_solvers and use_pressure_stabilization:
+        preconditioners = dict(
+            dict(NS="schur_pressure_mass", S="schur_pressure_mass"),
+            **preconditioners)
+
+    # Options for the linear solvers, per subproblem
+    solver_options = dict()
+    for subproblem in ["PF", "EC", "NS", "S"]:
+        solver_options[subproblem] = dict(
+            split_assembly=split_assembly,
+            frozen=frozen,
+            preconditioner_reuse=preconditioner_reuse.get(subproblem),
+            preconditioner=preconditioners.get(subproblem),
+            mesh_hierarchy=mesh_hierarchy,
+            nonzero_initial_guess=initial_guess is not None,
+            petsc_options=petsc_options.get(subproblem),
+            quadrature_degree=get_quadrature_degree(quadrature_degree,
+                                                    subproblem),
+            name=subproblem)
+
     solvers = dict()
     if enable_PF:
         solvers["PF"] = setup_PF(w_["PF"], phi, g, psi, h,
                                  dx, ds, normal,
                                  dirichlet_bcs["PF"], neumann_bcs,
                                  boundary_to_mark,
-                                 phi_1, u_1, M_1, c_1, V_1,
-                                 per_tau, sigma_bar, eps, dbeta, dveps,
+                                 phi_1, u_cpl, M_1, c_cpl, V_cpl,
+                                 tau["PF"], sigma_bar, eps, dbeta, dveps,
                                  enable_NS, enable_EC,
-                                 use_iterative_solvers, q_rhs)
+                                 use_iterative_solvers, q_rhs,
+                                 solver_options["PF"],
+                                 mass_measure(
+                                     dx, uses_mass_lumping(mass_lumping,
+                                                           "PF"),
+                                     base_elements["phi"][1]),
+                                 bdf, hist.get("phi"))
 
     if enable_EC:
         solvers["EC"] = setup_EC(w_["EC"], c, V, b, U, rho_e,
                                  dx, ds, normal,
                                  dirichlet_bcs["EC"], neumann_bcs,
                                  boundary_to_mark,
-                                 c_1, u_1, K_, veps_, phi_flt_,
+                                 c_1, u_cpl, K_, veps_, phi_flt_,
                                  solutes,
-                                 per_tau, z, dbeta,
+                                 tau["EC"], z, dbeta,
                                  enable_NS, enable_PF,
                                  use_iterative_solvers,
-                                 q_rhs)
+                                 q_rhs,
+                                 solver_options["EC"],
+                                 mass_measure(
+                                     dx, uses_mass_lumping(mass_lumping,
+                                                           "EC"),
+                                     base_elements["c"][1]),
+                                 bdf, hist.get("c"))
 
     if enable_NS:
         solvers["NS"] = setup_NS(w_["NS"], u, p, v, q, p0, q0,
@@ -201,14 +359,16 @@ def setup(mesh, test_functions, trial_functions,
                                  c_, V_,
                                  c_1, V_1,
                                  dbeta, solutes,
-                                 per_tau, drho, sigma_bar, eps, dveps,
+                                 tau["NS"], drho, sigma_bar, eps, dveps,
                                  grav, fric,
                                  u_comoving,
                                  enable_PF, enable_EC,
                                  use_iterative_solvers,
                                  use_pressure_stabilization,
                                  p_lagrange,
-                                 q_rhs)
+                                 q_rhs,
+                                 solver_options["NS"],
+                                 bdf, hist.get("u"), hist.get("rho"))
     if enable_S:
         solvers["S"] = setup_S(w_["S"], u, p, v, q, p0, q0,
                                dx, ds, normal,
@@ -219,16 +379,29 @@ def setup(mesh, test_functions, trial_functions,
                                c_, V_,
                                c_1, V_1,
                                dbeta, solutes,
-                               per_tau, drho, sigma_bar, eps, dveps,
+                               tau["S"], drho, sigma_bar, eps, dveps,
                                grav, fric,
                                u_comoving,
                                enable_PF, enable_EC,
                                use_iterative_solvers,
                                use_pressure_stabilization,
                                p_lagrange,
-                               q_rhs)
+                               q_rhs,
+                               solver_options["S"],
+                               bdf, hist.get("u"))
+
+    return dict(solvers=solvers, per_tau=per_tau, anderson=anderson,
+                material_fields=material_fields, bdf=bdf,
+                multirate=multirate)
+
 
-    return dict(solvers=solvers)
+def increment(x, x_1, x_hist=None, bdf=None):
+    """ The increment of x over a timestep, which divided by the timestep
+    gives the time derivative. For backward Euler, this is x - x_1. With
+    the BDF2 scheme, x_hist is the part given by previous timesteps. """
+    if bdf is None:
+        return x - x_1
+    return bdf.a0*x - x_hist
 
 
 def setup_S(w_S, u, p, v, q, p0, q0,
@@ -243,22 +416,28 @@ def setup_S(w_S, u, p, v, q, p0, q0,
             enable_PF, enable_EC,
             use_iterative_solvers, use_pressure_stabilization,
             p_lagrange,
-            q_rhs):
+            q_rhs,
+            solver_options=None,
+            bdf=None, u_hist=None):
     """ Set up Stokes subproblem """
     F = (
-        per_tau * rho_1 * df.dot(u - u_1, v) * dx
+        per_tau * rho_1 * df.dot(increment(u, u_1, u_hist, bdf), v) * dx
         + mu_*df.inner(df.grad(u), df.grad(v)) * dx
         - p * df.div(v) * dx
         + q * df.div(u) * dx
         - rho_*df.dot(grav, v) * dx
     )
+    if use_pressure_stabilization:
+        F += pressure_stabilization_form(
+            p, q, mu_, dx, w_S.function_space())
 
     print("Linear system size", w_S.function_space().dim())
 
 
     a, L = df.system(F)
-    problem = df.LinearVariationalProblem(a, L, w_S, dirichlet_bcs)
-    solver = df.LinearVariationalSolver(problem)
+    a_pc = pressure_mass_form(p, q, p0, q0, mu_, dx, solver_options)
+    solver = create_linear_solver(a, L, w_S, dirichlet_bcs,
+                                  solver_options, a_pc)
 
     solver.parameters["linear_solver"] = "mumps"
 
@@ -269,6 +448,26 @@ def setup_S(w_S, u, p, v, q, p0, q0,
     return solver
 
 
+def pressure_stabilization_form(p, q, mu_, dx, W, rho_=None, u_=None):
+    """ Returns the Brezzi-Pitkaranta pressure stabilization term,
+    tau grad p . grad q, with tau = h^2/(4 mu + 2 rho |u| h). It stabilizes
+    equal order velocity and pressure elements, and is consistent up to
+    O(h) for P1-P1. Since it is part of the pressure block of the
+    operator, it is also part of the Schur complement approximation of
+    the block preconditioners. Stable (e.g. Taylor-Hood) elements of the
+    velocity-pressure space W are rejected, since the term would only add
+    a consistency error. """
+    if W.sub(0).ufl_element().degree() != W.sub(1).ufl_element().degree():
+        info_error("Pressure stabilization requires equal order velocity "
+                   "and pressure elements.")
+    h = df.CellDiameter(W.mesh())
+    denominator = 4*mu_
+    if rho_ is not None and u_ is not None:
+        denominator += 2*rho_*df.sqrt(df.dot(u_, u_))*h
+    tau = h**2/denominator
+    return tau*df.dot(df.grad(p), df.grad(q)) * dx
+
+
 def setup_NS(w_NS, u, p, v, q, p0, q0,
              dx, ds, normal,
              dirichlet_bcs, neumann_bcs, boundary_to_mark,
@@ -281,7 +480,9 @@ def setup_NS(w_NS, u, p, v, q, p0, q0,
              enable_PF, enable_EC,
              use_iterative_solvers, use_pressure_stabilization,
              p_lagrange,
-             q_rhs):
+             q_rhs,
+             solver_options=None,
+             bdf=None, u_hist=None, rho_hist=None):
     """ Set up the Navier-Stokes subproblem. """
     # F = (
     #     per_tau * rho_ * df.dot(u - u_1, v)*dx
@@ -296,14 +497,15 @@ def setup_NS(w_NS, u, p, v, q, p0, q0,
         mom_1 += -M_*drho * df.nabla_grad(g_)
 
     F = (
-        per_tau * rho_1 * df.dot(u - u_1, v) * dx
+        per_tau * rho_1 * df.dot(increment(u, u_1, u_hist, bdf), v) * dx
         + fric*mu_*df.dot(u + u_comoving, v) * dx
         + 2*mu_*df.inner(df.sym(df.nabla_grad(u)),
                          df.sym(df.nabla_grad(v))) * dx
         - p * df.div(v) * dx
         + q * df.div(u) * dx
         + df.inner(df.nabla_grad(u), df.outer(mom_1, v)) * dx
-        + 0.5 * (per_tau * (rho_ - rho_1) * df.dot(u, v) * dx
+        + 0.5 * (per_tau * increment(rho_, rho_1, rho_hist, bdf)
+                 * df.dot(u, v) * dx
                  + df.dot(normal, mom_1)*df.dot(u, v) * df.ds
                  - df.dot(mom_1, df.nabla_grad(df.dot(u, v))) * dx)
         - rho_*df.dot(grav, v) * dx
@@ -335,22 +537,35 @@ def setup_NS(w_NS, u, p, v, q, p0, q0,
     if p_lagrange:
         F += (p*q0 + q*p0)*dx
 
+    if use_pressure_stabilization:
+        F += pressure_stabilization_form(
+            p, q, mu_, dx, w_NS.function_space(), rho_1, u_1)
+
     if "u" in q_rhs:
         F += -df.dot(q_rhs["u"], v)*dx
 
     a, L = df.lhs(F), df.rhs(F)
 
+    a_pc = pressure_mass_form(p, q, p0, q0, mu_, dx, solver_options)
+    solver = create_linear_solver(a, L, w_NS, dirichlet_bcs,
+                                  solver_options, a_pc)
 
+    return solver
 
-    problem = df.LinearVariationalProblem(a, L, w_NS, dirichlet_bcs)
-    solver = df.LinearVariationalSolver(problem)
-
-    if use_iterative_solvers and use_pressure_stabilization:
-        solver.parameters["linear_solver"] = "minres"
-        solver.parameters["preconditioner"] = "amg"
-        #solver.parameters["preconditioner"] = "ilu"
 
-    return solver
+def pressure_mass_form(p, q, p0, q0, mu_, dx, solver_options=None):
+    """ Returns the pressure mass matrix form, scaled by the inverse
+    viscosity, which approximates the Schur complement of the
+    velocity-pressure system. It is added to the pressure block of the
+    matrix the Schur complement preconditioner is built from.
+    Returns None if it is not needed. """
+    if solver_options is None or \
+       not uses_pressure_mass(solver_options.get("preconditioner")):
+        return None
+    a_pc = 1./mu_*p*q*dx
+    if p0 is not None:
+        a_pc += p0*q0*dx
+    return a_pc
 
 
 def setup_PF(w_PF, phi, g, psi, h,
@@ -361,10 +576,17 @@ def setup_PF(w_PF, phi, g, psi, h,
              dbeta, dveps,
              enable_NS, enable_EC,
              use_iterative_solvers,
-             q_rhs):
-    """ Set up phase field subproblem. """
-
-    F_phi = (per_tau*(phi-unit_interval_filter(phi_1))*psi*dx +
+             q_rhs,
+             solver_options=None,
+             dx_mass=None,
+             bdf=None, phi_hist=None):
+    """ Set up phase field subproblem. The time derivative is integrated
+    with dx_mass, e.g. for mass lumping. """
+    if dx_mass is None:
+        dx_mass = dx
+
+    F_phi = (per_tau*increment(phi, unit_interval_filter(phi_1),
+                               phi_hist, bdf)*psi*dx_mass +
              M_1*df.dot(df.grad(g), df.grad(psi))*dx)
     if enable_NS:
         F_phi += - phi*df.dot(u_1, df.grad(psi))*dx \
@@ -395,8 +617,8 @@ def setup_PF(w_PF, phi, g, psi, h,
     F = F_phi + F_g
     a, L = df.lhs(F), df.rhs(F)
 
-    problem = df.LinearVariationalProblem(a, L, w_PF, dirichlet_bcs)
-    solver = df.LinearVariationalSolver(problem)
+    solver = create_linear_solver(a, L, w_PF, dirichlet_bcs,
+                                  solver_options)
 
     if use_iterative_solvers:
         solver.parameters["linear_solver"] = "gmres"
@@ -413,12 +635,20 @@ def setup_EC(w_EC, c, V, b, U, rho_e,
              per_tau, z, dbeta,
              enable_NS, enable_PF,
              use_iterative_solvers,
-             q_rhs):
-    """ Set up electrochemistry subproblem. """
+             q_rhs,
+             solver_options=None,
+             dx_mass=None,
+             bdf=None, c_hist=None):
+    """ Set up electrochemistry subproblem. The time derivative is
+    integrated with dx_mass, e.g. for mass lumping. """
+    if dx_mass is None:
+        dx_mass = dx
+    if c_hist is None:
+        c_hist = [None]*len(c)
     F_c = []
-    for ci, ci_1, bi, Ki_, zi, dbetai, solute in zip(
-            c, c_1, b, K_, z, dbeta, solutes):
-        F_ci = (per_tau*(ci-ci_1)*bi*dx +
+    for ci, ci_1, ci_hist, bi, Ki_, zi, dbetai, solute in zip(
+            c, c_1, c_hist, b, K_, z, dbeta, solutes):
+        F_ci = (per_tau*increment(ci, ci_1, ci_hist, bdf)*bi*dx_mass +
                 Ki_*df.dot(df.nabla_grad(ci), df.nabla_grad(bi))*dx)
         if zi != 0:
             F_ci += Ki_*zi*ci_1*df.dot(df.nabla_grad(V), df.nabla_grad(bi))*dx
@@ -447,8 +677,8 @@ def setup_EC(w_EC, c, V, b, U, rho_e,
     F = sum(F_c) + F_V
     a, L = df.lhs(F), df.rhs(F)
 
-    problem = df.LinearVariationalProblem(a, L, w_EC, dirichlet_bcs)
-    solver = df.LinearVariationalSolver(problem)
+    solver = create_linear_solver(a, L, w_EC, dirichlet_bcs,
+                                  solver_options)
 
     if use_iterative_solvers:
         solver.parameters["linear_solver"] = "gmres"
@@ -458,26 +688,71 @@ def setup_EC(w_EC, c, V, b, U, rho_e,
 
 
 def solve(w_, solvers, enable_PF, enable_EC, enable_NS, enable_S,
-          freeze_NSPF, **namespace):
+          freeze_NSPF, coupling_max_iter, coupling_tol, anderson,
+          material_fields, multirate=None,
+          **namespace):
     """ Solve equations. """
     timer_outer = df.Timer("Solve system")
-    for subproblem, enable in zip(["PF", "EC", "NS", "S"],
-                                  [enable_PF and not freeze_NSPF,
-                                   enable_EC,
-                                   enable_NS and not freeze_NSPF,
-                                   enable_S]):
-        if enable:
-            timer_inner = df.Timer("Solve subproblem " + subproblem)
-            mpi_barrier()
-            solvers[subproblem].solve()
-            timer_inner.stop()
+    if material_fields is not None:
+        material_fields.update()
+    subproblems = [subproblem for subproblem, enable in zip(
+        ["PF", "EC", "NS", "S"],
+        [enable_PF and not freeze_NSPF,
+         enable_EC,
+         enable_NS and not freeze_NSPF,
+         enable_S]) if enable]
+
+    if coupling_max_iter <= 1:
+        solve_subproblems(subproblems, solvers, material_fields, multirate)
+    else:
+        # Outer fixed-point iterations over the subproblems
+        functions = [w_[subproblem] for subproblem in subproblems]
+        x = get_stacked(functions)
+        for iteration in range(1, coupling_max_iter+1):
+            solve_subproblems(subproblems, solvers, material_fields)
+            g = get_stacked(functions)
+            change = global_norm(g - x)/max(global_norm(g), df.DOLFIN_EPS)
+            if change < coupling_tol or iteration == coupling_max_iter:
+                break
+            if anderson is not None:
+                g = anderson.apply(x, g)
+                set_stacked(functions, g)
+            x = g
+        if anderson is not None:
+            anderson.reset()
+
+        if change < coupling_tol:
+            info_blue("Coupling iterations: {:d}, "
+                      "relative change: {:e}".format(iteration, change))
+        else:
+            info_warning("Coupling iterations did not converge in {:d} "
+                         "iterations, relative change: {:e}".format(
+                             iteration, change))
 
     timer_outer.stop()
 
 
+def solve_subproblems(subproblems, solvers, material_fields=None,
+                      multirate=None):
+    """ Solve the subproblems once, in the given order. """
+    def after_solve(subproblem):
+        if subproblem == "PF" and material_fields is not None:
+            material_fields.update()
+
+    if multirate is not None:
+        multirate.solve(subproblems, solvers, after_solve)
+        return
+    for subproblem in subproblems:
+        timer_inner = df.Timer("Solve subproblem " + subproblem)
+        mpi_barrier()
+        solvers[subproblem].solve()
+        timer_inner.stop()
+        after_solve(subproblem)
+
+
 def update(t, dt, w_, w_1, bcs, bcs_pointwise,
            enable_PF, enable_EC, enable_NS, enable_S, q_rhs,
-           freeze_NSPF, **namespace):
+           freeze_NSPF, solvers, w_2=None, bdf=None, **namespace):
     """ Update work variables at end of timestep. """
     # Update the time-dependent source terms
     for qi in q_rhs.values():
@@ -495,8 +770,35 @@ def update(t, dt, w_, w_1, bcs, bcs_pointwise,
                                    enable_NS and not freeze_NSPF,
                                    enable_S]):
         if enable:
+            if bdf is not None:
+                w_2[subproblem].assign(w_1[subproblem])
             w_1[subproblem].assign(w_[subproblem])
 
+    # The BDF2 coefficients (and hence the operators) change after the
+    # first timestep
+    if bdf is not None and bdf.push(dt):
+        invalidate_solvers(solvers)
+
+
+def set_timestep(dt, per_tau, solvers, bdf=None, multirate=None,
+                 **namespace):
+    """ Update the timestep in the equations. """
+    per_tau.assign(1./dt)
+    if bdf is not None:
+        bdf.set_timestep(dt)
+    if multirate is not None:
+        multirate.set_timestep(dt)
+    invalidate_solvers(solvers)
+    return True
+
+
+def invalidate_solvers(solvers):
+    """ Mark the constant parts of the operators for reassembly. """
+    for solver in solvers.values():
+        # Terms scaling with per_tau are regarded as constant in time.
+        if hasattr(solver, "invalidate"):
+            solver.invalidate()
+
 
 def equilibrium_EC(w_, x_, test_functions,
                    solutes,
@@ -580,6 +882,7 @@ def discrete_energy(x_, solutes, density, permittivity,
                     density_per_concentration,
                     surface_tension, interface_thickness,
                     enable_NS, enable_PF, enable_EC,
+                    enable_S=False,
                     **namespace):
     if x_ is None:
         E_list = []
@@ -11,6 +11,12 @@ linearisation. The problem is split between the following subproblems.
 
 * NSp: Pressure.
 
+The pressure step uses the minimal density (following Guermond and
+Salgado), such that the operators of the pressure and velocity
+correction steps are constant. They are assembled and factorized (or
+preconditioned) once, and only the right hand sides are assembled at each
+timestep.
+
 GL, 2017-05-29
 
 """
@@ -19,10 +25,11 @@ import math
 from common.functions import ramp, dramp, diff_pf_potential_linearised
 from common.cmd import info_red
 from common.io import mpi_barrier
+from common.linalg import SubproblemSolver
+from common.forms import get_quadrature_degree
 from solvers.basic import setup_PF, setup_EC, unit_interval_filter
 from . import *
 from . import __all__
-import numpy as np
 
 
 def get_subproblems(base_elements, solutes,
@@ -58,6 +65,10 @@ def setup(tstep, test_functions, trial_functions,
           use_iterative_solvers,
           use_pressure_stabilization,
           q_rhs, 
+          preconditioners,
+          petsc_options,
+          quadrature_degree,
+          mesh_hierarchy,
           **namespace):
     """ Set up problem. """
     # Constant
@@ -66,6 +77,7 @@ def setup(tstep, test_functions, trial_functions,
     grav = df.Constant((0., -grav_const))
     gamma = pf_mobility_coeff
     eps = interface_thickness
+    rho_min = min(density) if enable_PF else density[0]
 
     # Navier-Stokes
     if enable_NS:
@@ -142,13 +154,17 @@ def setup(tstep, test_functions, trial_functions,
                                drho, sigma_bar, eps, grav, dveps,
                                enable_PF, enable_EC)
 
+    # Options for the linear solvers, per subproblem
+    solver_options = dict(
+        (name, dict(name=name, petsc_options=petsc_options.get(name),
+                    preconditioner=preconditioners.get(name),
+                    mesh_hierarchy=mesh_hierarchy,
+                    quadrature_degree=get_quadrature_degree(
+                        quadrature_degree, name)))
+        for name in ["PF", "EC", "NSu", "NSu_correct", "NSp"])
+
     solvers = dict()
     if enable_PF:
-        # solvers["PF"] = setup_PF(w_["PF"], phi, g, psi, h, dirichlet_bcs["PF"],
-        #                          phi_1, u_1, M_1, c_1, V_1,
-        #                          per_tau, sigma_bar, eps, dbeta, dveps,
-        #                          enable_NS, enable_EC,
-        #                          use_iterative_solvers)
         solvers["PF"] = setup_PF(w_["PF"], phi, g, psi, h,
                                  dx, ds, normal,
                                  dirichlet_bcs["PF"], neumann_bcs,
@@ -156,35 +172,48 @@ def setup(tstep, test_functions, trial_functions,
                                  phi_1, u_1, M_1, c_1, V_1,
                                  per_tau, sigma_bar, eps, dbeta, dveps,
                                  enable_NS, enable_EC,
-                                 use_iterative_solvers, q_rhs)
+                                 use_iterative_solvers, q_rhs,
+                                 solver_options["PF"])
 
     if enable_EC:
-        solvers["EC"] = setup_EC(w_["EC"], c, V, b, U, rho_e, dirichlet_bcs["EC"],
-                                 c_1, u_1, K_, veps_, phi_, per_tau, z, dbeta,
+        solvers["EC"] = setup_EC(w_["EC"], c, V, b, U, rho_e,
+                                 dx, ds, normal,
+                                 dirichlet_bcs["EC"], neumann_bcs,
+                                 boundary_to_mark,
+                                 c_1, u_1, K_, veps_, phi_,
+                                 solutes,
+                                 per_tau, z, dbeta,
                                  enable_NS, enable_PF,
-                                 use_iterative_solvers)
+                                 use_iterative_solvers,
+                                 q_rhs,
+                                 solver_options["EC"])
 
     if enable_NS:
         solvers["NSu"] = setup_NSu(
-            u, v, u_, p_, dirichlet_bcs["NSu"],
+            w_["NSu"], u, v, u_, p_, dirichlet_bcs["NSu"],
             u_1, p_1, phi_, rho_, rho_1, g_, M_, nu_, rho_e_, V_,
-            dt, drho, sigma_bar, eps, dveps, grav,
-            enable_PF, enable_EC)
-        solvers["NSp"] = setup_NSp(p, q, dirichlet_bcs["NSp"], u_, p_, p_1, rho_, dt)
+            per_tau, rho_min, drho, sigma_bar, eps, dveps, grav,
+            enable_PF, enable_EC,
+            use_iterative_solvers, solver_options)
+        solvers["NSp"] = setup_NSp(
+            w_["NSp"], p, q, dirichlet_bcs["NSp"], u_, p_1,
+            per_tau, rho_min,
+            use_iterative_solvers, solver_options["NSp"])
 
-    return dict(solvers=solvers)
+    return dict(solvers=solvers, per_tau=per_tau)
 
 
-def setup_NSu(u, v, u_, p_, bcs_NSu,
+def setup_NSu(w_NSu, u, v, u_, p_, bcs_NSu,
               u_1, p_1, phi_, rho_, rho_1, g_, M_, nu_, rho_e_, V_,
-              dt, drho, sigma_bar, eps, dveps, grav,
-              enable_PF, enable_EC):
+              per_tau, rho_min, drho, sigma_bar, eps, dveps, grav,
+              enable_PF, enable_EC,
+              use_iterative_solvers, solver_options):
     """ Set up the Navier-Stokes subproblem. """
     # Crank-Nicolson velocity
     # u_CN = 0.5*(u_1 + u)
 
     F_predict = (
-        1./dt * df.sqrt(rho_) * df.dot(df.sqrt(rho_)*u - df.sqrt(rho_1)*u_1, v)*df.dx
+        per_tau * df.sqrt(rho_) * df.dot(df.sqrt(rho_)*u - df.sqrt(rho_1)*u_1, v)*df.dx
         # + rho_*df.inner(df.grad(u), df.outer(u_1, v))*df.dx
         # + 2*nu_*df.inner(df.sym(df.grad(u)), df.grad(v))*df.dx
         # - p_1 * df.div(v)*df.dx
@@ -209,43 +238,55 @@ def setup_NSu(u, v, u_, p_, bcs_NSu,
             phi_filtered), v)*df.dot(df.grad(V_),
                                      df.grad(V_))*df.dx
 
-    # a1, L1 = df.lhs(F_predict), df.rhs(F_predict)
+    a1, L1 = df.lhs(F_predict), df.rhs(F_predict)
 
+    # The velocity correction has the (constant) mass matrix as operator
     F_correct = (
         df.inner(u - u_, v)*df.dx
-        + dt/rho_ * df.inner(df.grad(p_ - p_1), v)*df.dx
+        + 1./(per_tau*rho_min) * df.inner(df.grad(p_ - p_1), v)*df.dx
     )
-    # a3 = df.dot(u, v)*df.dx
-    # L3 = df.dot(u_, v)*df.dx - dt*df.dot(df.grad(p_), v)*df.dx
-    # a3, L3 = df.lhs(F_correct), df.rhs(F_correct)
-
-    solver = dict()
-    # solver["a1"] = a1
-    # solver["L1"] = L1
-    solver["Fu"] = F_predict
-    solver["Fu_corr"] = F_correct
-    # solver["a3"] = a3
-    # solver["L3"] = L3
-    solver["bcs"] = bcs_NSu
-    return solver
+    a3, L3 = df.lhs(F_correct), df.rhs(F_correct)
 
-
-def setup_NSp(p, q, bcs_NSp, u_, p_, p_1, rho_, dt):
+    solvers = dict()
+    # The terms of the tentative velocity operator that are constant in
+    # time are only assembled once.
+    solvers["predict"] = SubproblemSolver(
+        a1, L1, w_NSu, bcs_NSu, name="NSu",
+        petsc_options=solver_options["NSu"]["petsc_options"],
+        quadrature_degree=solver_options["NSu"]["quadrature_degree"])
+    solvers["correct"] = SubproblemSolver(
+        a3, L3, w_NSu, bcs_NSu, name="NSu_correct",
+        petsc_options=solver_options["NSu_correct"]["petsc_options"],
+        quadrature_degree=solver_options["NSu_correct"]["quadrature_degree"])
+
+    if use_iterative_solvers:
+        solvers["predict"].parameters["linear_solver"] = "bicgstab"
+        solvers["predict"].parameters["preconditioner"] = "jacobi"
+        solvers["correct"].parameters["linear_solver"] = "cg"
+        solvers["correct"].parameters["preconditioner"] = "jacobi"
+    return solvers
+
+
+def setup_NSp(w_NSp, p, q, bcs_NSp, u_, p_1, per_tau, rho_min,
+              use_iterative_solvers, solver_options):
+    """ Set up the pressure correction subproblem. The operator is the
+    (constant) Laplacian. """
     F_correct = (
-        1./rho_ * df.dot(df.grad(p - p_1), df.grad(q)) * df.dx
-        + 1./dt * df.div(u_) * q * df.dx
+        df.dot(df.grad(p - p_1), df.grad(q)) * df.dx
+        + per_tau * rho_min * df.div(u_) * q * df.dx
     )
-    # a2 = df.dot(df.grad(p), df.grad(q))*df.dx
-    # L2 = (df.dot(df.grad(p_1), df.grad(q))*df.dx
-    #       - (1./dt)*df.div(rho_*u_)*q*df.dx)
-    # L2 = -(1./dt)*df.div(u_)*q*df.dx
-    # a2, L2 = df.lhs(F_correct), df.rhs(F_correct)
-
-    solver = dict()
-    # solver["a2"] = a2
-    # solver["L2"] = L2
-    solver["Fp"] = F_correct
-    solver["bcs"] = bcs_NSp
+    a2, L2 = df.lhs(F_correct), df.rhs(F_correct)
+
+    solver = SubproblemSolver(
+        a2, L2, w_NSp, bcs_NSp, name="NSp",
+        preconditioner=solver_options["preconditioner"],
+        mesh_hierarchy=solver_options["mesh_hierarchy"],
+        petsc_options=solver_options["petsc_options"],
+        quadrature_degree=solver_options["quadrature_degree"])
+
+    if use_iterative_solvers:
+        solver.parameters["linear_solver"] = "cg"
+        solver.parameters["preconditioner"] = "hypre_amg"
     return solver
 
 
@@ -261,64 +302,31 @@ def solve(tstep, w_, w_1, w_tmp, solvers,
             solvers[subproblem].solve()
             timer_inner.stop()
     if enable_NS:
-        # timer = df.Timer("NS: Assemble matrices")
-        # A1 = df.assemble(solvers["NSu"]["a1"])
-        # A2 = df.assemble(solvers["NSp"]["a2"])
-        # A3 = df.assemble(solvers["NSu"]["a3"])
-        # timer.stop()
-
-        # timer = df.Timer("NS: Apply BCs 1")
-        # [bc.apply(A1) for bc in solvers["NSu"]["bcs"]]
-        # [bc.apply(A2) for bc in solvers["NSp"]["bcs"]]
-        # timer.stop()
-        du = np.array([1e9])
+        du = 1e9
         tol = 1e-6
         max_num_iterations = 1
         i_iter = 0
 
-        Fu = solvers["NSu"]["Fu"]
-        bcs_u = solvers["NSu"]["bcs"]
-
         while du > tol and i_iter < max_num_iterations:
             i_iter += 1
-            du[0] = 0.
             # Step 1: Tentative velocity
             timer = df.Timer("NS: Tentative velocity")
-            # b1 = df.assemble(solvers["NSu"]["L1"])
-            # [bc.apply(b1) for bc in solvers["NSu"]["bcs"]]
-            # df.solve(A1, w_["NSu"].vector(), b1)
-
-            w_tmp["NSu"].vector()[:] = w_["NSu"].vector()
+            w_tmp["NSu"].assign(w_["NSu"])
+            solvers["NSu"]["predict"].solve()
 
-            # A, L = df.system(Fu)
-            # df.solve(A == L, w_["NSu"], bcs_u)
-            df.solve(df.lhs(Fu) == df.rhs(Fu), w_["NSu"], bcs_u)
-
-            du[0] += df.norm(w_["NSu"].vector()-w_tmp["NSu"].vector())
+            # Change from the previous iterate, computed in place
+            w_tmp["NSu"].vector().axpy(-1.0, w_["NSu"].vector())
+            du = w_tmp["NSu"].vector().norm("l2")
             timer.stop()
 
             # Step 2: Pressure correction
             timer = df.Timer("NS: Pressure correction")
-            # b2 = df.assemble(solvers["NSp"]["L2"])
-            # [bc.apply(b2) for bc in solvers["NSp"]["bcs"]]
-            # df.solve(A2, w_["NSp"].vector(), b2)
-
-            Fp = solvers["NSp"]["Fp"]
-            bcs_p = solvers["NSp"]["bcs"]
-            df.solve(df.lhs(Fp) == df.rhs(Fp), w_["NSp"], bcs_p)
-
-            w_1["NSp"].assign(w_["NSp"])
-
+            solvers["NSp"].solve()
             timer.stop()
 
         # Step 3: Velocity correction
         timer = df.Timer("NS: Velocity correction")
-        # b3 = df.assemble(solvers["NSu"]["L3"])
-        # df.solve(A3, w_["NSu"].vector(), b3)
-        Fu_corr = solvers["NSu"]["Fu_corr"]
-
-        df.solve(df.lhs(Fu_corr) == df.rhs(Fu_corr), w_["NSu"], bcs_u)
-
+        solvers["NSu"]["correct"].solve()
         timer.stop()
 
     timer_outer.stop()
@@ -333,6 +341,17 @@ def update(w_, w_1, enable_PF, enable_EC, enable_NS, **namespace):
             w_1[subproblem].assign(w_[subproblem])
 
 
+def set_timestep(dt, per_tau, solvers, **namespace):
+    """ Update the timestep in the equations. """
+    per_tau.assign(1./dt)
+    for solver in solvers.values():
+        for subsolver in (solver.values() if isinstance(solver, dict)
+                          else [solver]):
+            if hasattr(subsolver, "invalidate"):
+                subsolver.invalidate()
+    return True
+
+
 def epsilon(u):
     return df.sym(df.nabla_grad(u))
 
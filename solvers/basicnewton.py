@@ -11,6 +11,8 @@ import dolfin as df
 import math
 from common.functions import ramp, dramp, diff_pf_potential, diff_pf_contact,\
     unit_interval_filter, max_value
+from common.newton import NewtonSolver
+from common.forms import get_quadrature_degree
 from . import *
 from . import __all__
 
@@ -53,6 +55,9 @@ def setup(test_functions, trial_functions, w_, w_1,
           q_rhs,
           use_iterative_solvers,
           p_lagrange,
+          newton_solver,
+          petsc_options,
+          quadrature_degree,
           **namespace):
     """ Set up problem. """
     # Constants
@@ -146,7 +151,11 @@ def setup(test_functions, trial_functions, w_, w_1,
                                     enable_NS, enable_PF, enable_EC,
                                     use_iterative_solvers,
                                     p_lagrange,
-                                    q_rhs)
+                                    q_rhs,
+                                    newton_solver,
+                                    petsc_options.get("NSPFEC"),
+                                    get_quadrature_degree(
+                                        quadrature_degree, "NSPFEC"))
     return dict(solvers=solver)
 
 
@@ -165,7 +174,10 @@ def setup_NSPFEC(w_NSPFEC, w_1NSPFEC,
                  enable_NS, enable_PF, enable_EC,
                  use_iterative_solvers,
                  p_lagrange,
-                 q_rhs):
+                 q_rhs,
+                 newton_solver=None,
+                 petsc_options=None,
+                 quadrature_degree=None):
     """ The full problem of electrohydrodynamics in two phases.
     Note that it is possible to turn off the different parts at will.
     """
@@ -296,11 +308,14 @@ def setup_NSPFEC(w_NSPFEC, w_1NSPFEC,
     F = sum(F)
 
     J = df.derivative(F, w_NSPFEC)
-    problem_NSPFEC = df.NonlinearVariationalProblem(F, w_NSPFEC, dirichlet_bcs_NSPFEC, J)
-    solver_NSPFEC = df.NonlinearVariationalSolver(problem_NSPFEC)
+    solver_NSPFEC = NewtonSolver(F, w_NSPFEC, dirichlet_bcs_NSPFEC, J,
+                                 name="NSPFEC", petsc_options=petsc_options,
+                                 quadrature_degree=quadrature_degree)
     if use_iterative_solvers:
         solver_NSPFEC.parameters['newton_solver']['linear_solver'] = 'gmres'
         solver_NSPFEC.parameters['newton_solver']['preconditioner'] = 'ilu'
+    if newton_solver is not None:
+        solver_NSPFEC.parameters['newton_solver'].update(newton_solver)
 
     return solver_NSPFEC
 
@@ -1,24 +1,35 @@
-"""This module implements the a linearized-Poisson-Boltzmann-solver for one phase for the ideal gas chemical potential and two ion-spicese. 
-- Planed to add two phase surport 
-- Planed to genrelize to N ion-spicese if possibol for linearized version
+"""This module implements a linearized Poisson-Boltzmann solver for one
+phase, with the ideal gas chemical potential and any number of solutes.
+
+The Boltzmann distribution of the concentrations is linearized around the
+previous state (c_1, V_1),
+
+    c_i = c_1i (1 - z_i (V - V_1)),
+
+which together with the Poisson equation for V gives a linear problem.
+Starting from uniform (bulk) concentrations and V = 0, the first step is
+the Debye-Hueckel approximation. Repeated steps converge to the solution
+of the nonlinear Poisson-Boltzmann equation for moderate potentials.
+
+The solution of a single step is also used as initial guess for the
+nonlinear equilibrium solvers, see solve_linearized_PB.
+
+- Planned to add two phase support
 
 AB, 2018
 """
 import dolfin as df
-from common.functions import max_value, alpha, alpha_c, alpha_cc, \
-    alpha_reg, alpha_c_reg, absolute
+from common.linalg import create_linear_solver
+from common.forms import get_quadrature_degree
 from . import *
 from . import __all__
-import numpy as np
 
-def get_subproblems(base_elements, solutes, enable_EC, enable_PF,
-                    V_lagrange, 
+
+def get_subproblems(base_elements, solutes, enable_EC,
+                    V_lagrange,
                     **namespace):
     """ Returns dict of subproblems the solver splits the problem into. """
     subproblems = dict()
-    if enable_PF:
-        subproblems["PF"] = [dict(name="phi", element="phi"),
-                             dict(name="g", element="g")]
     if enable_EC:
         subproblems["EC"] = ([dict(name=solute[0], element="c")
                               for solute in solutes]
@@ -27,107 +38,142 @@ def get_subproblems(base_elements, solutes, enable_EC, enable_PF,
             subproblems["EC"].append(dict(name="V0", element="V0"))
     return subproblems
 
+
 def setup(test_functions, trial_functions, w_, w_1,
-          ds, dx, normal,
+          ds, dx,
           dirichlet_bcs, neumann_bcs, boundary_to_mark,
-          permittivity, density, viscosity,
-          solutes, enable_EC, enable_PF,
-          dt,
+          permittivity,
+          solutes, enable_EC,
           use_iterative_solvers,
-          mesh,
-          V_lagrange, p_lagrange,
+          V_lagrange,
+          petsc_options,
+          quadrature_degree,
           **namespace):
     """ Set up problem. """
-    # Constant
     veps = df.Constant(permittivity[0])
-    
-    # If Phase Field 
-    if enable_PF:
-        phi, g = trial_functions["PF"]
-        psi, h = test_functions["PF"]
-
-        phi_, g_ = df.split(w_["PF"])
-        phi_1, g_1 = df.split(w_1["PF"])
-    else:
-        # Defaults to phase 1 if phase field is disabled
-        phi_ = phi_1 = 1.
-        g_ = g_1 = None
-
-    # Electrochemistry
-    c_ = V_ = c_1 = V_1 = V0 = V0_ = V0_1 = b = U = U0 = None
+
+    solvers = dict()
     if enable_EC:
-        num_solutes = len(trial_functions["EC"])-1
-        assert(num_solutes == len(solutes))
+        num_solutes = len(solutes)
         c = trial_functions["EC"][:num_solutes]
         V = trial_functions["EC"][num_solutes]
         b = test_functions["EC"][:num_solutes]
         U = test_functions["EC"][num_solutes]
+        V0 = U0 = None
+        if V_lagrange:
+            V0 = trial_functions["EC"][-1]
+            U0 = test_functions["EC"][-1]
 
-        cV_ = df.split(w_["EC"])
         cV_1 = df.split(w_1["EC"])
-        c_, V_ = cV_[:num_solutes], cV_[num_solutes]
         c_1, V_1 = cV_1[:num_solutes], cV_1[num_solutes]
-    else:
-        c_ = V_ = c_1 = V_1 = None
-
-    dbeta = []  # Diff. in beta
-    z = []  # Charge z[species]
-    K_ = []  # Diffusivity K[species]
-    beta_ = []  # Conc. jump func. beta[species]
 
-    for solute in solutes:
-        z.append(solute[1])
-        K_.append(ramp(phi_, [solute[2], solute[3]]))
-        beta_.append(ramp(phi_, [solute[4], solute[5]]))
-        dbeta.append(dramp([solute[4], solute[5]]))
+        z = [solute[1] for solute in solutes]
 
-    if enable_EC:
-        rho_e = sum([c_e*z_e for c_e, z_e in zip(c, z)])  # Sum of trial func.
-        rho_e_ = sum([c_e*z_e for c_e, z_e in zip(c_, z)])  # Sum of curr. sol.
-    else:
-        rho_e_ = None
-
-    if enable_EC:
-        solvers["EC"] = setup_EC(w_["EC"], c, V, b, U, rho_e,
+        solvers["EC"] = setup_EC(w_["EC"], c, V, V0, b, U, U0,
+                                 c_1, V_1, z, veps,
                                  dx, ds,
                                  dirichlet_bcs["EC"], neumann_bcs,
                                  boundary_to_mark,
-                                 c_1, K_, veps,
-                                 z, dbeta,
-                                 enable_PF,
-                                 use_iterative_solvers)
-
-
+                                 use_iterative_solvers,
+                                 solver_options=dict(
+                                     name="EC",
+                                     petsc_options=petsc_options.get("EC"),
+                                     quadrature_degree=get_quadrature_degree(
+                                         quadrature_degree, "EC")))
     return dict(solvers=solvers)
 
-    def setup_EC(w_EC, c, V, b, U, rho_e,
+
+def setup_EC(w_EC, c, V, V0, b, U, U0,
+             c_1, V_1, z, veps,
              dx, ds,
              dirichlet_bcs, neumann_bcs, boundary_to_mark,
-             c_1, u_1, K_, veps_, phi_,
-             per_tau, z, dbeta,
-             enable_NS, enable_PF,
-             use_iterative_solvers):
-    """ Set up electrochemistry subproblem. """
-         
-    F_V = veps_*df.dot(df.grad(V), df.grad(U))*dx
-    for boundary_name, sigma_e in neumann_bcs["V"].iteritems():
-        F_V += -sigma_e*U*ds(boundary_to_mark[boundary_name])
+             use_iterative_solvers,
+             charge_scale=1.,
+             solver_options=None):
+    """ Set up the linearized Poisson-Boltzmann problem. The surface
+    charges are multiplied by charge_scale. """
+    F_c = []
+    for ci, ci_1, bi, zi in zip(c, c_1, b, z):
+        F_ci = (ci - ci_1*(1. - zi*(V - V_1)))*bi*dx
+        F_c.append(F_ci)
+
+    rho_e = sum([ci*zi for ci, zi in zip(c, z)])
+
+    F_V = veps*df.dot(df.grad(V), df.grad(U))*dx
+    for boundary_name, sigma_e in neumann_bcs["V"].items():
+        F_V += -charge_scale*sigma_e*U*ds(boundary_to_mark[boundary_name])
     if rho_e != 0:
-        F_V += -V*U*dx
-    F = F_V
-    a, L = df.lhs(F), df.rhs(F)
+        F_V += -rho_e*U*dx
+    if V0 is not None:
+        F_V += veps*V0*U*dx + veps*V*U0*dx
 
-    
-   
-
-    problem = df.LinearVariationalProblem(a, L, w_EC, dirichlet_bcs)
-    solver = df.LinearVariationalSolver(problem)
+    F = sum(F_c) + F_V
+    a, L = df.lhs(F), df.rhs(F)
 
-    for ci, ci_1, bi, Ki_, zi, dbetai in zip(c, c_1, b, K_, z, dbeta):
-        ?? 
+    solver = create_linear_solver(a, L, w_EC, dirichlet_bcs, solver_options)
 
     if use_iterative_solvers:
         solver.parameters["linear_solver"] = "gmres"
-        solver.parameters["preconditioner"] = "hypre_euclid"
+        solver.parameters["preconditioner"] = "hypre_amg"
 
     return solver
+
+
+def solve(solvers, enable_EC, **namespace):
+    """ Solve equations. """
+    if enable_EC:
+        solvers["EC"].solve()
+
+
+def update(w_, w_1, enable_EC, **namespace):
+    """ Update work variables at end of timestep. """
+    if enable_EC:
+        w_1["EC"].assign(w_["EC"])
+
+
+def solve_linearized_PB(w_EC, solutes, veps,
+                        dx, ds,
+                        dirichlet_bcs, neumann_bcs, boundary_to_mark,
+                        use_iterative_solvers, V_lagrange,
+                        charge_scale=1.):
+    """ Replace w_EC by the solution of the Poisson-Boltzmann equation
+    linearized around w_EC. The concentrations are then set to the
+    (positive) Boltzmann distribution c_i = c_i,ref exp(-z_i (V - V_ref))
+    for the computed potential. """
+    num_solutes = len(solutes)
+    W = w_EC.function_space()
+    trial = df.TrialFunctions(W)
+    test = df.TestFunctions(W)
+    c, V = trial[:num_solutes], trial[num_solutes]
+    b, U = test[:num_solutes], test[num_solutes]
+    V0 = U0 = None
+    if V_lagrange:
+        V0, U0 = trial[-1], test[-1]
+    z = [solute[1] for solute in solutes]
+
+    w_ref = w_EC.copy(deepcopy=True)
+    cV_ref = df.split(w_ref)
+    c_ref, V_ref = cV_ref[:num_solutes], cV_ref[num_solutes]
+
+    solver = setup_EC(w_EC, c, V, V0, b, U, U0,
+                      c_ref, V_ref, z, veps,
+                      dx, ds,
+                      dirichlet_bcs, neumann_bcs, boundary_to_mark,
+                      use_iterative_solvers,
+                      charge_scale=charge_scale)
+    solver.solve()
+
+    # Project the concentrations to the Boltzmann distribution
+    w_lin = w_EC.copy(deepcopy=True)
+    cV_lin = df.split(w_lin)
+    V_lin = cV_lin[num_solutes]
+    F = sum([(ci - ci_ref*df.exp(-zi*(V_lin - V_ref)))*bi*dx
+             for ci, ci_ref, bi, zi in zip(c, c_ref, b, z)])
+    F += (V - V_lin)*U*dx
+    if V_lagrange:
+        F += (V0 - cV_lin[-1])*U0*dx
+    solver = create_linear_solver(df.lhs(F), df.rhs(F), w_EC, dirichlet_bcs)
+    if use_iterative_solvers:
+        solver.parameters["linear_solver"] = "cg"
+        solver.parameters["preconditioner"] = "jacobi"
+    solver.solve()
@@ -9,6 +9,13 @@ from common.functions import max_value, alpha, alpha_c, alpha_cc, \
 from . import *
 from . import __all__
 from common.io import mpi_barrier
+from common.cmd import info_cyan, info_yellow
+from common.linalg import create_linear_solver
+from common.forms import get_quadrature_degree, uses_mass_lumping, \
+    mass_measure
+from common.newton import NewtonSolver
+from .basic import pressure_mass_form
+from .l_PB_single import solve_linearized_PB
 import numpy as np
 
 
@@ -49,6 +56,14 @@ def setup(test_functions, trial_functions, w_, w_1,
           density_per_concentration,
           viscosity_per_concentration,
           V_lagrange, p_lagrange,
+          preconditioners,
+          preconditioner_reuse,
+          petsc_options,
+          newton_solver,
+          quadrature_degree,
+          mass_lumping,
+          base_elements,
+          mesh_hierarchy,
           **namespace):
     """ Set up problem. """
     # Constant
@@ -187,7 +202,10 @@ def setup(test_functions, trial_functions, w_, w_1,
     if enable_EC:
         w_EC = w_["EC"]
         dirichlet_bcs_EC = dirichlet_bcs["EC"]
-        solvers["EC"] = setup_EC(**vars())
+        solvers["EC"] = setup_EC(
+            dx_mass=mass_measure(dx, uses_mass_lumping(mass_lumping, "EC"),
+                                 base_elements["c"][1]),
+            **vars())
 
     if enable_NS:
         w_NS = w_["NS"]
@@ -209,6 +227,11 @@ def setup_NS(w_NS, u, p, v, q, p0, q0,
              q_rhs,
              density_per_concentration,
              K,
+             mu_0,
+             preconditioners,
+             preconditioner_reuse,
+             petsc_options,
+             quadrature_degree,
              **namespace):
     """ Set up the Navier-Stokes subproblem. """
     mom_1 = rho_1 * u_1
@@ -245,13 +268,28 @@ def setup_NS(w_NS, u, p, v, q, p0, q0,
 
     a, L = df.lhs(F), df.rhs(F)
     if not use_iterative_solvers:
-        problem = df.LinearVariationalProblem(a, L, w_NS, dirichlet_bcs_NS)
-        solver = df.LinearVariationalSolver(problem)
-
+        solver = create_linear_solver(
+            a, L, w_NS, dirichlet_bcs_NS,
+            dict(name="NS", petsc_options=petsc_options.get("NS"),
+                 quadrature_degree=get_quadrature_degree(
+                     quadrature_degree, "NS")))
     else:
-        solver = df.LUSolver()
-        # solver.set_operator(A)
-        return solver, a, L, dirichlet_bcs_NS
+        # Terms that only depend on constants (such as rho_0 and mu_0
+        # when the density and viscosity do not depend on the
+        # concentrations) are assembled once. The preconditioner is only
+        # rebuilt when the operator has changed, or as given by
+        # preconditioner_reuse.
+        solver_options = dict(split_assembly=True,
+                              preconditioner_reuse=preconditioner_reuse.get(
+                                  "NS"),
+                              preconditioner=preconditioners.get("NS"),
+                              petsc_options=petsc_options.get("NS"),
+                              quadrature_degree=get_quadrature_degree(
+                                  quadrature_degree, "NS"),
+                              name="NS")
+        a_pc = pressure_mass_form(p, q, p0, q0, mu_0, dx, solver_options)
+        solver = create_linear_solver(a, L, w_NS, dirichlet_bcs_NS,
+                                      solver_options, a_pc)
 
     return solver
 
@@ -292,8 +330,17 @@ def setup_EC(w_EC, c, V, V0, b, U, U0,
              reactions,
              beta,
              g_c_1,
+             preconditioners,
+             petsc_options,
+             newton_solver=None,
+             quadrature_degree=None,
+             dx_mass=None,
+             mesh_hierarchy=None,
              **namespace):
-    """ Set up electrochemistry subproblem. """
+    """ Set up electrochemistry subproblem. The time derivative is
+    integrated with dx_mass, e.g. for mass lumping. """
+    if dx_mass is None:
+        dx_mass = dx
     if enable_NS:
         # Projected velocity
         u_star = u_1 - dt/rho_1*sum([ci_1*grad_g_ci
@@ -303,7 +350,7 @@ def setup_EC(w_EC, c, V, V0, b, U, U0,
     F_c = []
     for ci, ci_1, bi, Ki, grad_g_ci, solute, ci_reg in zip(
             c, c_1, b, K, grad_g_c, solutes, c_reg):
-        F_ci = (1./dt*(ci-ci_1)*bi*dx +
+        F_ci = (1./dt*(ci-ci_1)*bi*dx_mass +
                 Ki*ci_reg*df.dot(grad_g_ci, df.grad(bi))*dx)
         if enable_NS:
             # F_ci += df.dot(df.div(ci_1*u_1), bi)*dx
@@ -350,17 +397,22 @@ def setup_EC(w_EC, c, V, V0, b, U, U0,
     F = sum(F_c) + F_V
     if nonlinear_EC:
         J = df.derivative(F, w_EC)
-        problem = df.NonlinearVariationalProblem(F, w_EC, dirichlet_bcs_EC, J)
-        solver = df.NonlinearVariationalSolver(problem)
-        solver.parameters["newton_solver"]["relative_tolerance"] = 1e-7
-        if use_iterative_solvers:
-            solver.parameters["newton_solver"]["linear_solver"] = "bicgstab"
-            if not V_lagrange:
-                solver.parameters["newton_solver"]["preconditioner"] = "hypre_amg"
+        solver = setup_EC_newton(F, w_EC, dirichlet_bcs_EC, J,
+                                 use_iterative_solvers, V_lagrange,
+                                 newton_solver, "EC",
+                                 petsc_options.get("EC"),
+                                 get_quadrature_degree(
+                                     quadrature_degree, "EC"))
     else:
         a, L = df.lhs(F), df.rhs(F)
-        problem = df.LinearVariationalProblem(a, L, w_EC, dirichlet_bcs_EC)
-        solver = df.LinearVariationalSolver(problem)
+        solver = create_linear_solver(
+            a, L, w_EC, dirichlet_bcs_EC,
+            dict(preconditioner=preconditioners.get("EC"),
+                 mesh_hierarchy=mesh_hierarchy,
+                 petsc_options=petsc_options.get("EC"),
+                 quadrature_degree=get_quadrature_degree(
+                     quadrature_degree, "EC"),
+                 name="EC"))
         if use_iterative_solvers:
             solver.parameters["linear_solver"] = "bicgstab"
             solver.parameters["preconditioner"] = "hypre_amg"
@@ -387,17 +439,7 @@ def solve(w_, t, dt, q_rhs, solvers, enable_EC, enable_NS,
         if enable:
             timer_inner = df.Timer("Solve subproblem " + subproblem)
             mpi_barrier()
-            if subproblem == "NS" and use_iterative_solvers:
-                solver, a, L, bcs = solvers[subproblem]
-                A = df.assemble(a)
-                b = df.assemble(L)
-                for bc in bcs:
-                    bc.apply(A)
-                    bc.apply(b)
-                solver.set_operator(A)
-                solver.solve(w_["NS"].vector(), b)
-            else:
-                solvers[subproblem].solve()
+            solvers[subproblem].solve()
             timer_inner.stop()
 
     timer_outer.stop()
@@ -461,6 +503,26 @@ def discrete_energy(x_, solutes, density, permittivity,
     return E_list
 
 
+def setup_EC_newton(F, w_EC, dirichlet_bcs_EC, J,
+                    use_iterative_solvers, V_lagrange,
+                    newton_solver=None, name="EC", petsc_options=None,
+                    quadrature_degree=None):
+    """ Returns a Newton solver for the nonlinear electrochemistry
+    problem. The Jacobian reuse and tolerances can be set through the
+    newton_solver parameter. """
+    solver = NewtonSolver(F, w_EC, dirichlet_bcs_EC, J,
+                          name=name, petsc_options=petsc_options,
+                          quadrature_degree=quadrature_degree)
+    solver.parameters["newton_solver"]["relative_tolerance"] = 1e-7
+    if use_iterative_solvers:
+        solver.parameters["newton_solver"]["linear_solver"] = "bicgstab"
+        if not V_lagrange:
+            solver.parameters["newton_solver"]["preconditioner"] = "hypre_amg"
+    if newton_solver is not None:
+        solver.parameters["newton_solver"].update(newton_solver)
+    return solver
+
+
 def equilibrium_EC(w_, test_functions,
                    solutes,
                    permittivity,
@@ -468,8 +530,12 @@ def equilibrium_EC(w_, test_functions,
                    dirichlet_bcs, neumann_bcs, boundary_to_mark,
                    use_iterative_solvers,
                    V_lagrange,
+                   newton_solver=None,
+                   equilibration=None,
                    **namespace):
     """ Electrochemistry equilibrium solver. Nonlinear! """
+    timer = df.Timer("Equilibrate EC")
+    settings = equilibration_settings(equilibration)
     num_solutes = len(solutes)
 
     cV = df.split(w_["EC"])
@@ -492,6 +558,7 @@ def equilibrium_EC(w_, test_functions,
     rho_e = sum([c_e*z_e for c_e, z_e in zip(c, z)])
 
     veps = permittivity[0]
+    charge_scale = df.Constant(1./settings["continuation_steps"])
 
     F_c = []
     for ci, bi, Ki, zi in zip(c, b, K, z):
@@ -501,7 +568,7 @@ def equilibrium_EC(w_, test_functions,
 
     F_V = veps*df.dot(df.grad(V), df.grad(U))*dx
     for boundary_name, sigma_e in neumann_bcs["V"].items():
-        F_V += -sigma_e*U*ds(boundary_to_mark[boundary_name])
+        F_V += -charge_scale*sigma_e*U*ds(boundary_to_mark[boundary_name])
     if rho_e != 0:
         F_V += -rho_e*U*dx
     if V_lagrange:
@@ -510,17 +577,20 @@ def equilibrium_EC(w_, test_functions,
     F = sum(F_c) + F_V
     J = df.derivative(F, w_["EC"])
 
-    problem = df.NonlinearVariationalProblem(F, w_["EC"],
-                                             dirichlet_bcs["EC"], J)
-    solver = df.NonlinearVariationalSolver(problem)
+    solver = setup_EC_newton(F, w_["EC"], dirichlet_bcs["EC"], J,
+                             use_iterative_solvers, V_lagrange,
+                             newton_solver, "EC_equilibrium")
 
-    solver.parameters["newton_solver"]["relative_tolerance"] = 1e-7
-    if use_iterative_solvers:
-        solver.parameters["newton_solver"]["linear_solver"] = "bicgstab"
-        if not V_lagrange:
-            solver.parameters["newton_solver"]["preconditioner"] = "hypre_amg"
-
-    solver.solve()
+    if settings["linearized_start"]:
+        solve_linearized_PB(w_["EC"], solutes, df.Constant(veps),
+                            dx, ds, dirichlet_bcs["EC"], neumann_bcs,
+                            boundary_to_mark,
+                            use_iterative_solvers, V_lagrange,
+                            charge_scale)
+    solve_continuation(solver, w_["EC"], charge_scale,
+                       settings["continuation_steps"],
+                       settings["min_continuation_step"])
+    report_equilibration(solver, timer.stop())
 
 
 def equilibrium_EC_PNP(w_, test_functions,
@@ -530,8 +600,12 @@ def equilibrium_EC_PNP(w_, test_functions,
                        dirichlet_bcs, neumann_bcs, boundary_to_mark,
                        use_iterative_solvers,
                        V_lagrange,
+                       newton_solver=None,
+                       equilibration=None,
                        **namespace):
     """ Electrochemistry equilibrium solver. Nonlinear! """
+    timer = df.Timer("Equilibrate EC")
+    settings = equilibration_settings(equilibration)
     num_solutes = len(solutes)
 
     cV = df.split(w_["EC"])
@@ -559,6 +633,7 @@ def equilibrium_EC_PNP(w_, test_functions,
     veps = df.Expression("val",
                          val=veps_arr[0],
                          degree=1)
+    charge_scale = df.Constant(1./settings["continuation_steps"])
 
     F_c = []
     for ci, bi, Ki, zi in zip(c, b, K, z):
@@ -568,7 +643,7 @@ def equilibrium_EC_PNP(w_, test_functions,
 
     F_V = veps*df.dot(df.grad(V), df.grad(U))*dx
     for boundary_name, sigma_e in neumann_bcs["V"].items():
-        F_V += -sigma_e*U*ds(boundary_to_mark[boundary_name])
+        F_V += -charge_scale*sigma_e*U*ds(boundary_to_mark[boundary_name])
     if rho_e != 0:
         F_V += -rho_e*U*dx
     if V_lagrange:
@@ -577,15 +652,71 @@ def equilibrium_EC_PNP(w_, test_functions,
     F = sum(F_c) + F_V
     J = df.derivative(F, w_["EC"])
 
-    problem = df.NonlinearVariationalProblem(F, w_["EC"],
-                                             dirichlet_bcs["EC"], J)
-    solver = df.NonlinearVariationalSolver(problem)
-
-    solver.parameters["newton_solver"]["relative_tolerance"] = 1e-7
-    if use_iterative_solvers:
-        solver.parameters["newton_solver"]["linear_solver"] = "bicgstab"
-        if not V_lagrange:
-            solver.parameters["newton_solver"]["preconditioner"] = "hypre_amg"
-    for val in veps_arr[1:]:
+    solver = setup_EC_newton(F, w_["EC"], dirichlet_bcs["EC"], J,
+                             use_iterative_solvers, V_lagrange,
+                             newton_solver, "EC_equilibrium")
+
+    if settings["linearized_start"]:
+        veps.val = veps_arr[1]
+        solve_linearized_PB(w_["EC"], solutes, veps,
+                            dx, ds, dirichlet_bcs["EC"], neumann_bcs,
+                            boundary_to_mark,
+                            use_iterative_solvers, V_lagrange,
+                            charge_scale)
+    # Continuation in the surface charge at the largest permittivity,
+    # then in the permittivity.
+    for i, val in enumerate(veps_arr[1:]):
         veps.val = val
-        solver.solve()
+        if i == 0:
+            solve_continuation(solver, w_["EC"], charge_scale,
+                               settings["continuation_steps"],
+                               settings["min_continuation_step"])
+        else:
+            solver.solve()
+    report_equilibration(solver, timer.stop())
+
+
+def equilibration_settings(equilibration=None):
+    """ Returns the settings of the equilibrium solvers, see the
+    equilibration parameter. """
+    settings = dict(linearized_start=False,
+                    continuation_steps=1,
+                    min_continuation_step=1e-3)
+    if equilibration is not None:
+        settings.update(equilibration)
+    return settings
+
+
+def solve_continuation(solver, w_EC, charge_scale, num_steps,
+                       min_step=1e-3):
+    """ Solve the equilibrium problem while increasing charge_scale
+    from 1/num_steps to 1 in num_steps steps. If the Newton solver fails,
+    the step is halved and retried from the previous solution. """
+    w_prev = w_EC.vector().copy()
+    scale = 0.
+    step = 1./num_steps
+    while scale < 1.:
+        scale_next = min(scale + step, 1.)
+        charge_scale.assign(scale_next)
+        try:
+            solver.solve()
+        except RuntimeError:
+            if step <= min_step:
+                raise
+            w_EC.vector().zero()
+            w_EC.vector().axpy(1.0, w_prev)
+            step *= 0.5
+            info_yellow("Equilibration did not converge: Reducing the "
+                        "surface charge step to {}".format(step))
+            continue
+        scale = scale_next
+        w_prev.zero()
+        w_prev.axpy(1.0, w_EC.vector())
+
+
+def report_equilibration(solver, time_elapsed):
+    """ Report the time and the Newton iterations to equilibrium. """
+    info_cyan("Time to equilibrium: {:f} seconds ({:d} Newton iterations, "
+              "{:d} Jacobian assemblies)".format(
+                  time_elapsed, solver.num_iterations,
+                  solver.num_jacobian_assemblies))
@@ -7,6 +7,9 @@ from .stable_single import setup_EC, alpha_prime_approx, alpha_generalized, \
     regulate, alpha_c
 import dolfin as df
 from common.io import mpi_barrier
+from common.linalg import create_linear_solver
+from common.forms import get_quadrature_degree, uses_mass_lumping, \
+    mass_measure
 from . import *
 from . import __all__
 import numpy as np
@@ -43,6 +46,13 @@ def setup(test_functions, trial_functions, w_, w_1,
           V_lagrange, p_lagrange,
           density_per_concentration,
           viscosity_per_concentration,
+          preconditioners,
+          petsc_options,
+          newton_solver,
+          quadrature_degree,
+          mass_lumping,
+          base_elements,
+          mesh_hierarchy,
           **namespace):
     """ Set up problem. """
     # Constant
@@ -169,7 +179,10 @@ def setup(test_functions, trial_functions, w_, w_1,
     if enable_EC:
         w_EC = w_["EC"]
         dirichlet_bcs_EC = dirichlet_bcs["EC"]
-        solvers["EC"] = setup_EC(**vars())
+        solvers["EC"] = setup_EC(
+            dx_mass=mass_measure(dx, uses_mass_lumping(mass_lumping, "EC"),
+                                 base_elements["c"][1]),
+            **vars())
 
     if enable_NS:
         w_NSu = w_["NSu"]
@@ -193,6 +206,8 @@ def setup_NSu(w_NSu, u, v,
               density_per_concentration,
               viscosity_per_concentration,
               K,
+              petsc_options,
+              quadrature_degree,
               **namespace):
     """ Set up the Navier-Stokes velocity subproblem. """
     solvers = dict()
@@ -224,9 +239,11 @@ def setup_NSu(w_NSu, u, v,
 
     a_predict, L_predict = df.lhs(F_predict), df.rhs(F_predict)
     #    if not use_iterative_solvers:
-    problem_predict = df.LinearVariationalProblem(
-        a_predict, L_predict, w_NSu, dirichlet_bcs_NSu)
-    solvers["predict"] = df.LinearVariationalSolver(problem_predict)
+    solvers["predict"] = create_linear_solver(
+        a_predict, L_predict, w_NSu, dirichlet_bcs_NSu,
+        dict(name="NSu", petsc_options=petsc_options.get("NSu"),
+             quadrature_degree=get_quadrature_degree(
+                 quadrature_degree, "NSu")))
     if use_iterative_solvers:
         solvers["predict"].parameters["linear_solver"] = "bicgstab"
         solvers["predict"].parameters["preconditioner"] = "amg"
@@ -236,9 +253,12 @@ def setup_NSu(w_NSu, u, v,
         - dt * (p_ - p_1) * df.div(v) * dx
     )
     a_correct, L_correct = df.lhs(F_correct), df.rhs(F_correct)
-    problem_correct = df.LinearVariationalProblem(
-        a_correct, L_correct, w_NSu, dirichlet_bcs_NSu)
-    solvers["correct"] = df.LinearVariationalSolver(problem_correct)
+    solvers["correct"] = create_linear_solver(
+        a_correct, L_correct, w_NSu, dirichlet_bcs_NSu,
+        dict(name="NSu_correct",
+             petsc_options=petsc_options.get("NSu_correct"),
+             quadrature_degree=get_quadrature_degree(
+                 quadrature_degree, "NSu_correct")))
 
     if use_iterative_solvers:
         solvers["correct"].parameters["linear_solver"] = "bicgstab"
@@ -254,6 +274,10 @@ def setup_NSu(w_NSu, u, v,
 def setup_NSp(w_NSp, p, q, dirichlet_bcs_NSp,
               dt, u_, p_1, rho_0,
               use_iterative_solvers,
+              preconditioners,
+              petsc_options,
+              quadrature_degree,
+              mesh_hierarchy,
               **namespace):
     """ Set up Navier-Stokes pressure subproblem. """
     F = (
@@ -263,9 +287,13 @@ def setup_NSp(w_NSp, p, q, dirichlet_bcs_NSp,
 
     a, L = df.lhs(F), df.rhs(F)
 
-    problem = df.LinearVariationalProblem(
-        a, L, w_NSp, dirichlet_bcs_NSp)
-    solver = df.LinearVariationalSolver(problem)
+    solver = create_linear_solver(
+        a, L, w_NSp, dirichlet_bcs_NSp,
+        dict(name="NSp", preconditioner=preconditioners.get("NSp"),
+             mesh_hierarchy=mesh_hierarchy,
+             petsc_options=petsc_options.get("NSp"),
+             quadrature_degree=get_quadrature_degree(
+                 quadrature_degree, "NSp")))
 
     if use_iterative_solvers:
         solver.parameters["linear_solver"] = "bicgstab"
@@ -8,37 +8,108 @@ tol = 1e-5
 # "basicnewton"
 
 
-@pytest.mark.parametrize("solver",  ["basic"])
-@pytest.mark.parametrize("num_proc", [1, 2])
-def test_simple(solver, num_proc):
+def run_simple(solver, num_proc, options):
+    """ Returns the velocity norm of the simple test. """
     cmd = ("cd ..; mpiexec -n {} python sauce.py solver={} "
            "problem=simple T=0.1 grid_spacing=0.1 "
-           "testing=True")
-    d = subprocess.check_output(cmd.format(num_proc, solver), shell=True)
+           "testing=True {}")
+    d = subprocess.check_output(cmd.format(num_proc, solver, options),
+                                shell=True)
     match = re.search("Velocity norm = " + number, str(d))
-    err = match.groups()
+    return eval(match.groups()[0])
 
+
+@pytest.mark.parametrize("solver",  ["basic"])
+@pytest.mark.parametrize("num_proc", [1, 2])
+@pytest.mark.parametrize("options", ["", "split_assembly=True"])
+def test_simple(solver, num_proc, options):
     ref = 1.901026e-03
-    assert(abs(eval(err[0])-ref) < tol)
+    assert(abs(run_simple(solver, num_proc, options)-ref) < tol)
 
 
-@pytest.mark.parametrize("solver", ["basic"])
-@pytest.mark.parametrize("num_proc", [1, 2])
-def test_taylorgreen(solver, num_proc):
+def test_simple_coefficient_fields():
+    # The DG0 coefficients change the discretization, so the result is
+    # not compared with the reference of the exact coefficients, but
+    # must not depend on the partition.
+    ref = run_simple("basic", 1, "coefficient_fields=DG0")
+    assert(abs(run_simple("basic", 2, "coefficient_fields=DG0")-ref) < tol)
+
+
+def run_taylorgreen(solver, num_proc, options):
+    """ Returns the final error norms of the taylorgreen test. """
     cmd = ("cd ..; mpiexec -n {} python sauce.py solver={} "
-           "problem=taylorgreen T=0.002 testing=True N=20")
-    d = subprocess.check_output(cmd.format(num_proc, solver), shell=True)
+           "problem=taylorgreen T=0.002 testing=True N=20 {}")
+    d = subprocess.check_output(cmd.format(num_proc, solver, options),
+                                shell=True)
     match = re.search("Final error norms: u = " + number +
                       " phi = " + number +
                       " c_p = " + number +
                       " c_m = " + number +
                       " V = " + number, str(d))
-    err = match.groups()
+    return [eval(e) for e in match.groups()]
+
+
+@pytest.mark.parametrize("solver", ["basic"])
+@pytest.mark.parametrize("num_proc", [1, 2])
+@pytest.mark.parametrize("options", [
+    "", "adaptive_dt=True", "time_scheme=BDF2", "substeps='{\"EC\":4}'",
+    "coupling_max_iter=5 coupling_anderson_depth=2",
+    "use_iterative_solvers=True initial_guess=linear"])
+def test_taylorgreen(solver, num_proc, options):
+    err = run_taylorgreen(solver, num_proc, options)
 
     for e in err:
+        assert e < 1e-1
+
+
+@pytest.mark.parametrize("num_proc", [1, 2])
+def test_taylorgreen_multigrid(num_proc):
+    # The problem mesh is the coarsest level, so N=10 with two levels is
+    # solved on the same mesh as the other taylorgreen tests.
+    cmd = ("cd ..; mpiexec -n {} python sauce.py solver=basic "
+           "problem=taylorgreen T=0.002 testing=True N=10 "
+           "multigrid_levels=2 "
+           "preconditioners='{{\"EC\": \"block_gauss_seidel_gmg\"}}' "
+           "petsc_options='{{\"EC\": {{\"ksp_converged_reason\": null}}}}'")
+    d = str(subprocess.check_output(cmd.format(num_proc), shell=True))
+    iterations = [int(it) for it in re.findall(
+        r"Linear EC_ ?solve converged due to \w+ iterations ([0-9]+)", d)]
+    assert len(iterations) > 0
+    assert max(iterations) <= 30
+
+    match = re.search("Final error norms: u = " + number +
+                      " phi = " + number +
+                      " c_p = " + number +
+                      " c_m = " + number +
+                      " V = " + number, d)
+    for e in match.groups():
         assert eval(e) < 1e-1
 
 
+@pytest.mark.parametrize("num_proc", [1, 2])
+def test_taylorgreen_substeps(num_proc):
+    # Over two timesteps, the errors are dominated by the spatial
+    # discretization, so substepping EC must give the same errors as the
+    # single-rate scheme up to the (small) change in the temporal error.
+    err_single = run_taylorgreen("basic", num_proc, "")
+    err_multi = run_taylorgreen("basic", num_proc, "substeps='{\"EC\":4}'")
+
+    for e_single, e_multi in zip(err_single, err_multi):
+        assert abs(e_multi-e_single) < 1e-2*e_single
+
+
+@pytest.mark.parametrize("num_proc", [1, 2])
+def test_petsc_options(num_proc):
+    # The options are given as a dict on the command line, and must reach
+    # the PETSc solver of the NS subproblem with its prefix.
+    cmd = ("cd ..; mpiexec -n {} python sauce.py solver=basic "
+           "problem=taylorgreen T=0.002 testing=True N=20 "
+           "petsc_options='{{\"NS\": {{\"ksp_type\": \"preonly\", "
+           "\"pc_type\": \"redundant\", \"ksp_converged_reason\": null}}}}'")
+    d = subprocess.check_output(cmd.format(num_proc), shell=True)
+    assert re.search("Linear NS_ ?solve converged", str(d))
+
+
 if __name__ == "__main__":
     #test_simple("basic", 1)
-    test_taylorgreen("basic", 1)
+    test_taylorgreen("basic", 1, "")
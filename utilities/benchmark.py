@@ -0,0 +1,64 @@
+""" Common functionality of the benchmark scripts, which run the
+taylorgreen test with sauce.py for a set of options, and compare the
+error norms and computing times. """
+import re
+import subprocess
+import sys
+
+__author__ = "Gaute Linga"
+
+
+def add_taylorgreen_arguments(parser, resolution=32, solver="basic"):
+    """ Add the arguments of the taylorgreen runs to the
+    argparse.ArgumentParser parser. """
+    parser.add_argument("-N", "--resolution", type=int, default=resolution,
+                        help="Mesh resolution.")
+    parser.add_argument("-T", "--end_time", type=float, default=0.01,
+                        help="End time.")
+    parser.add_argument("--dt", type=float, default=0.001,
+                        help="Timestep.")
+    parser.add_argument("-s", "--solver", type=str, default=solver,
+                        help="Solver.")
+    parser.add_argument("-a", "--args", type=str, default="",
+                        help="Additional (space-separated) arguments "
+                        "to sauce.py.")
+
+
+def run_taylorgreen(args, folder, options, num_proc=None,
+                    iterations_prefix=None):
+    """ Run the taylorgreen test with the arguments args and the list of
+    additional options to sauce.py, on num_proc MPI processes if given.
+    Returns the error norms, the mean number of Krylov iterations of the
+    solver with the options prefix iterations_prefix (which must be run
+    with ksp_converged_reason), and the total computing time. """
+    cmd = [sys.executable, "sauce.py", "problem=taylorgreen",
+           "testing=True",
+           "solver={}".format(args.solver),
+           "N={}".format(args.resolution),
+           "T={}".format(args.end_time),
+           "dt={}".format(args.dt),
+           "folder={}".format(folder)] + options + args.args.split()
+    if num_proc is not None:
+        cmd = ["mpiexec", "-n", str(num_proc)] + cmd
+    output = subprocess.check_output(cmd).decode("utf-8")
+
+    errors = dict()
+    iterations = []
+    time = float("nan")
+    for line in output.splitlines():
+        if "Final error norms:" in line:
+            for field, value in re.findall(
+                    r"(\w+) = ([-+0-9.eE]+)", line):
+                errors[field] = float(value)
+        if iterations_prefix is not None:
+            match = re.search(r"Linear {} ?solve converged due to \w+ "
+                              r"iterations ([0-9]+)".format(
+                                  iterations_prefix), line)
+            if match:
+                iterations.append(int(match.group(1)))
+        match = re.search(r"Total computing time .* ([0-9.]+) seconds \(",
+                          line)
+        if match:
+            time = float(match.group(1))
+    return (errors, float(sum(iterations))/max(len(iterations), 1),
+            time)
@@ -0,0 +1,74 @@
+""" Compare the computing time of geometric multigrid and AMG (hypre) for
+the pressure Poisson step of the fractional step solvers, on the
+taylorgreen test. The mesh given by -N is the coarsest level, so both
+preconditioners solve on the mesh refined levels-1 times, i.e. with
+resolution N*2**(levels-1). The Krylov iterations of the pressure step
+are reported along with the timings.
+
+Run from the main folder, e.g.
+
+    python utilities/multigrid_benchmark.py -N 16 -l 2,3,4 -n 4
+"""
+from __future__ import print_function
+import argparse
+from benchmark import add_taylorgreen_arguments, run_taylorgreen
+
+__author__ = "Gaute Linga"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark geometric multigrid against AMG on the "
+        "taylorgreen test, with the solver TDLUES, basic_IPCS or "
+        "stable_single_fracstep")
+    parser.add_argument("-l", "--levels", type=str, default="2,3,4",
+                        help="Comma-separated numbers of multigrid levels.")
+    parser.add_argument("-n", "--num_proc", type=int, default=1,
+                        help="Number of MPI processes.")
+    add_taylorgreen_arguments(parser, resolution=16, solver="TDLUES")
+    args = parser.parse_args()
+    return args
+
+
+def run(levels, preconditioner, args):
+    """ Run the taylorgreen test on the mesh refined levels-1 times, with
+    the pressure step preconditioned by geometric multigrid or
+    AMG. Returns the error norms, the mean number of Krylov iterations of
+    the pressure step and the total computing time. """
+    options = ["use_iterative_solvers=True",
+               "multigrid_levels={}".format(levels)]
+    if preconditioner == "gmg":
+        options.append("preconditioners={\"NSp\": \"gmg\"}")
+        options.append("petsc_options={\"NSp\": "
+                       "{\"ksp_converged_reason\": null}}")
+    else:
+        options.append("petsc_options={\"NSp\": {\"ksp_type\": \"cg\", "
+                       "\"pc_type\": \"hypre\", "
+                       "\"pc_hypre_type\": \"boomeramg\", "
+                       "\"ksp_converged_reason\": null}}")
+    return run_taylorgreen(args, "results_multigrid_benchmark", options,
+                           num_proc=args.num_proc, iterations_prefix="NSp_")
+
+
+def main():
+    args = parse_args()
+    levels = [int(level) for level in args.levels.split(",")]
+
+    results = []
+    for level in levels:
+        for preconditioner in ["hypre", "gmg"]:
+            print("Running with {} levels and {}...".format(
+                level, preconditioner))
+            results.append((level, preconditioner) +
+                           run(level, preconditioner, args))
+
+    print("\n{:>8s} {:>8s} {:>10s} {:>10s} {:>12s}".format(
+        "levels", "pc", "its", "time (s)", "u"))
+    for level, preconditioner, errors, iterations, time in results:
+        print("{:>8d} {:>8s} {:10.1f} {:10.3f} {:12.4e}".format(
+            level, preconditioner, iterations, time,
+            errors.get("u", float("nan"))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+""" Compare the accuracy and computing time of the taylorgreen test for
+different quadrature degrees.
+
+Run from the main folder, e.g.
+
+    python utilities/quadrature_benchmark.py -d none,2,3,4,6 -N 32
+"""
+from __future__ import print_function
+import argparse
+from benchmark import add_taylorgreen_arguments, run_taylorgreen
+
+__author__ = "Gaute Linga"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark quadrature degrees on the taylorgreen test")
+    parser.add_argument("-d", "--degrees", type=str, default="none,2,3,4,6",
+                        help="Comma-separated quadrature degrees "
+                        "(none for the estimated degree).")
+    add_taylorgreen_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def run(degree, args):
+    """ Run the taylorgreen test with the given quadrature degree.
+    Returns the error norms and the total computing time. """
+    options = []
+    if degree != "none":
+        options.append("quadrature_degree={}".format(degree))
+    errors, _, time = run_taylorgreen(
+        args, "results_quadrature_benchmark", options)
+    return errors, time
+
+
+def main():
+    args = parse_args()
+    degrees = args.degrees.split(",")
+
+    results = []
+    for degree in degrees:
+        print("Running with quadrature degree {}...".format(degree))
+        results.append((degree,) + run(degree, args))
+
+    fields = ["u", "phi", "c_p", "c_m", "V"]
+    print("\n{:>8s} {:>10s}".format("degree", "time (s)") +
+          "".join([" {:>12s}".format(field) for field in fields]))
+    for degree, errors, time in results:
+        print("{:>8s} {:10.3f}".format(degree, time) +
+              "".join([" {:12.4e}".format(errors.get(field, float("nan")))
+                       for field in fields]))
+
+
+if __name__ == "__main__":
+    main()